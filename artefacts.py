@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+
+import multiprocessing
+import os
+from typing import Optional, Sequence
+
+import matplotlib
+# Artefacts are only ever written to files, often from worker processes with no display
+matplotlib.use('Agg')
+import matplotlib.pyplot
+import numpy as np
+
+
+def artefact_stem(output_directory: str, words: Sequence[str]) -> str:
+    return os.path.join(output_directory, ','.join(words))
+
+
+def save_histogram(output_directory: str, words: Sequence[str], distances: np.ndarray) -> None:
+    word1, word2, word3 = words
+    fig, ax = matplotlib.pyplot.subplots()
+    try:
+        ax.hist(distances)
+        ax.set_title(f"Distribution of distances from the plane through\n{word1}, {word2} and {word3}")
+        ax.set_xlabel("Distance from the plane")
+        fig.savefig(f"{artefact_stem(output_directory, words)}.png")
+    finally:
+        matplotlib.pyplot.close(fig)
+
+
+def fit_distributions(output_directory: Optional[str], words: Sequence[str], distances: np.ndarray) -> None:
+    """Find the distributions that best fit the distances, printing (and maybe saving) the summary."""
+    import fitter
+    f = fitter.Fitter(distances)
+    f.fit()
+    summary = f.summary(plot=False)
+    print(','.join(words))
+    print(summary)
+    if output_directory:
+        with open(f"{artefact_stem(output_directory, words)}.fitter.json", 'w') as o:
+            o.write(summary.to_json())
+
+
+def save_artefacts(output_directory: Optional[str], fitter: bool, words: Sequence[str],
+                   distances: np.ndarray) -> None:
+    """Write the histogram and/or the fitter summary for one plane."""
+    if output_directory:
+        save_histogram(output_directory, words, distances)
+    if fitter:
+        fit_distributions(output_directory, words, distances)
+
+
+def artefact_worker(tasks: multiprocessing.Queue, output_directory: Optional[str], fitter: bool) -> None:
+    """Produce artefacts for (words, distances) tasks until a None arrives."""
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+        words, distances = task
+        try:
+            save_artefacts(output_directory, fitter, words, distances)
+        except Exception as e:
+            print(f"Could not produce artefacts for {','.join(words)}: {type(e).__name__}: {e}")
+
+
+class ArtefactPipeline:
+    def __init__(self, output_directory: Optional[str], fitter: bool, workers: int = 2, queue_size: int = 64):
+        """
+        Histograms and distribution fits made in background processes.
+
+        submit() puts a plane's distances on a bounded queue that `workers`
+        processes drain, so plotting and fitting happen alongside the search
+        instead of inside it. When the queue is full, submit() waits: the
+        search is held back rather than letting the queue grow without
+        limit. With workers=0 everything is done inline by submit().
+        """
+        self.output_directory = output_directory
+        self.fitter = fitter
+        if output_directory:
+            os.makedirs(output_directory, exist_ok=True)
+        self.tasks = multiprocessing.Queue(maxsize=queue_size) if workers else None
+        self.processes = [multiprocessing.Process(target=artefact_worker,
+                                                  args=(self.tasks, output_directory, fitter))
+                          for _ in range(workers)]
+        for process in self.processes:
+            process.start()
+
+    def submit(self, words: Sequence[str], distances: np.ndarray) -> None:
+        """Queue one plane; NaN entries (the words defining it) are dropped here."""
+        distances = np.asarray(distances)
+        distances = distances[~np.isnan(distances)]
+        if self.tasks is None:
+            save_artefacts(self.output_directory, self.fitter, tuple(words), distances)
+        else:
+            self.tasks.put((tuple(words), distances))
+
+    def close(self) -> None:
+        """Wait for everything queued so far to be written."""
+        for _ in self.processes:
+            self.tasks.put(None)
+        for process in self.processes:
+            process.join()
+        self.processes = []
+
+    def __enter__(self) -> "ArtefactPipeline":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
@@ -0,0 +1,529 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+
+from embeddingstore import create_embedding_table, encode_embedding, load_embedding_matrix, set_table_format
+from plane import REDUCED_PRECISION_MIN_SEPARATION, Plane, PlaneBatch, triple_distances
+from planegram import GramEngine, gram_bytes
+from planeindex import PlaneIndex, nearest_to_plane
+from planesearch import SEARCH_OBJECTIVES, BeamSearch
+from planestats import batch_statistics
+
+
+def synthetic_points(count: int, dimension: int, seed: int = 0, decay: float = 0.0) -> np.ndarray:
+    """
+    Random unit vectors standing in for real embeddings.
+
+    With decay > 0 the variance of coordinate i falls off as (i+1)^(-2 decay),
+    which is closer to the spectrum of real embeddings than isotropic noise.
+    """
+    rng = np.random.default_rng(seed)
+    points = rng.normal(size=(count, dimension)) * np.arange(1, dimension + 1) ** -decay
+    return points / np.linalg.norm(points, axis=1, keepdims=True)
+
+
+def time_plane_construction(points: np.ndarray, planes: int, lightweight: bool) -> Dict[str, float]:
+    """Build `planes` planes from consecutive rows and report time and peak memory."""
+    tracemalloc.start()
+    start = time.perf_counter()
+    for i in range(planes):
+        j = 3 * i % (len(points) - 2)
+        Plane(points[j], points[j + 1], points[j + 2], lightweight=lightweight)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        'seconds_per_plane': elapsed / planes,
+        'peak_mib': peak / 2**20,
+    }
+
+
+def construction(args: argparse.Namespace) -> None:
+    points = synthetic_points(3 * args.planes, args.dimension, args.random_seed)
+    for label, lightweight in [('eager', False), ('lightweight', True)]:
+        result = time_plane_construction(points, args.planes, lightweight)
+        print(f"{label:12s} {result['seconds_per_plane'] * 1000:10.3f} ms/plane "
+              f"{result['peak_mib']:10.2f} MiB peak")
+
+
+def time_index_queries(points: np.ndarray, rank: int, candidate_counts: List[int], k: int, queries: int,
+                       seed: int) -> Dict[str, float]:
+    """Compare PlaneIndex queries against full scans on random planes through rows of `points`."""
+    rng = np.random.default_rng(seed)
+    start = time.perf_counter()
+    index = PlaneIndex(points, rank)
+    result = {'build_seconds': time.perf_counter() - start}
+    triples = [rng.choice(len(points), 3, replace=False) for _ in range(queries)]
+    planes = [Plane(*points[triple], lightweight=True) for triple in triples]
+
+    start = time.perf_counter()
+    truth = [nearest_to_plane(points, plane, k, triple)[0] for plane, triple in zip(planes, triples)]
+    result['full_scan_ms'] = (time.perf_counter() - start) / queries * 1000
+
+    for candidates in candidate_counts:
+        start = time.perf_counter()
+        found = [index.query(plane, k, candidates, triple)[0] for plane, triple in zip(planes, triples)]
+        result[f'index_{candidates}_ms'] = (time.perf_counter() - start) / queries * 1000
+        result[f'recall_{candidates}'] = np.mean([len(set(f) & set(t)) / len(t) for f, t in zip(found, truth)])
+
+    start = time.perf_counter()
+    found = [index.query(plane, k, max(candidate_counts), triple, exact=True)[0]
+             for plane, triple in zip(planes, triples)]
+    result['exact_ms'] = (time.perf_counter() - start) / queries * 1000
+    result['exact_recall'] = np.mean([len(set(f) & set(t)) / len(t) for f, t in zip(found, truth)])
+    return result
+
+
+def index(args: argparse.Namespace) -> None:
+    if args.database:
+        embeddings = load_points(args)
+    print(f"{'words':>8s} {'build s':>8s} {'scan ms':>8s} " + ' '.join(
+        f"{f'c={c} ms':>10s} {'recall':>6s} {'speedup':>7s}" for c in args.candidates)
+        + f" {'exact ms':>9s} {'speedup':>7s}")
+    for size in args.sizes:
+        if args.database:
+            if size > len(embeddings):
+                print(f"{size:8d} (only {len(embeddings)} embeddings in the database)")
+                continue
+            points = embeddings[np.random.default_rng(args.random_seed).choice(len(embeddings), size, replace=False)]
+        else:
+            points = synthetic_points(size, args.dimension, args.random_seed, args.decay)
+        result = time_index_queries(points, args.rank, args.candidates, args.k, args.queries, args.random_seed)
+        line = f"{size:8d} {result['build_seconds']:8.2f} {result['full_scan_ms']:8.2f} "
+        line += ' '.join(f"{result[f'index_{c}_ms']:10.2f} {result[f'recall_{c}']:6.3f} "
+                         f"{result['full_scan_ms'] / result[f'index_{c}_ms']:7.1f}" for c in args.candidates)
+        line += f" {result['exact_ms']:9.2f} {result['full_scan_ms'] / result['exact_ms']:7.1f}"
+        print(line)
+
+
+def load_points(args: argparse.Namespace) -> np.ndarray:
+    conn = sqlite3.connect(args.database)
+    _, points = load_embedding_matrix(conn, f"{args.embedding_provider}_embeddings", args.gender)
+    conn.close()
+    return points
+
+
+def batched_statistics(points: np.ndarray, triples: np.ndarray, batch_size: int) -> Dict[str, np.ndarray]:
+    """batch_statistics for every triple, computed the way the finder does, in the precision of `points`."""
+    row_norms = np.einsum('ij,ij->i', points, points)
+    float64_row_norms = np.einsum('ij,ij->i', points, points, dtype=np.float64)
+    batches = []
+    for start in range(0, len(triples), batch_size):
+        batch = triples[start:start + batch_size]
+        valid, distances = triple_distances(points, batch, row_norms, float64_row_norms)
+        stats = batch_statistics(distances)
+        stats['valid'] = valid
+        batches.append(stats)
+    return {column: np.concatenate([batch[column] for batch in batches]) for column in batches[0]}
+
+
+def precision(args: argparse.Namespace) -> None:
+    rng = np.random.default_rng(args.random_seed)
+    points = load_points(args) if args.database else synthetic_points(args.size, args.dimension, args.random_seed,
+                                                                      args.decay)
+    triples = np.sort(np.array([rng.choice(len(points), 3, replace=False) for _ in range(args.triples)]), axis=1)
+    if args.near_collinear:
+        # Extra words lying almost on the line through two others, at decreasing distances from it
+        pairs = np.array([rng.choice(len(points), 2, replace=False) for _ in range(args.near_collinear)])
+        offsets = np.logspace(-2, -7, args.near_collinear)[:, None] * rng.normal(size=(args.near_collinear,
+                                                                                     points.shape[1]))
+        extra = 0.5 * (points[pairs[:, 0]] + points[pairs[:, 1]]) + offsets
+        triples = np.vstack([triples, np.column_stack([pairs, len(points) + np.arange(args.near_collinear)])])
+        points = np.vstack([points, extra])
+    # The embeddings are stored as float32, so the float64 reference starts from the same values
+    points32 = points.astype(np.float32)
+    points64 = points32.astype(np.float64)
+    fallbacks = np.count_nonzero(PlaneBatch.from_indices(points32, triples).separation
+                                 < REDUCED_PRECISION_MIN_SEPARATION)
+
+    timings = {}
+    results = {}
+    for label, matrix in [('float64', points64), ('float32', points32)]:
+        start = time.perf_counter()
+        results[label] = batched_statistics(matrix, triples, args.batch_size)
+        timings[label] = time.perf_counter() - start
+    reference, reduced = results['float64'], results['float32']
+    both = reference['valid'] & reduced['valid']
+    print(f"{len(points)} words, {len(triples)} triples, {fallbacks} rebuilt in float64, "
+          f"{np.count_nonzero(reference['valid'] != reduced['valid'])} disagreeing on validity")
+    print(f"float64 {timings['float64']:.2f} s, float32 {timings['float32']:.2f} s "
+          f"({timings['float64'] / timings['float32']:.1f}x)")
+    print(f"{'column':16s} {'max abs deviation':>18s} {'max rel deviation':>18s}")
+    for column in ['how_close', 'mean_distance', 'stddev_distance', 'mili', 'percentile1', 'percentile25',
+                   'percentile50', 'percentile75', 'percentile99', 'furthest']:
+        deviation = np.abs(reduced[column][both] - reference[column][both])
+        relative = deviation / np.maximum(np.abs(reference[column][both]), np.finfo(np.float64).tiny)
+        print(f"{column:16s} {deviation.max():18.3e} {relative.max():18.3e}")
+    print(f"closest_adjective differs for {np.count_nonzero(reduced['closest_index'][both] != reference['closest_index'][both])} "
+          f"of {np.count_nonzero(both)} triples")
+
+
+def search(args: argparse.Namespace) -> None:
+    points = load_points(args) if args.database else synthetic_points(args.size, args.dimension, args.random_seed,
+                                                                      args.decay)
+    rng = np.random.default_rng(args.random_seed)
+    start = time.perf_counter()
+    beam = BeamSearch(points, args.objective, args.beam_width, args.swap_candidates, seed=args.random_seed)
+    beam.start()
+    while beam.evaluated < args.budget:
+        triples, _, _, _ = beam.step(min(args.batch_size, args.budget - beam.evaluated))
+        if len(triples) == 0:
+            break
+    beam_seconds = time.perf_counter() - start
+
+    # Uniform sampling with the same number of triples measured
+    start = time.perf_counter()
+    triples = np.sort(np.array([rng.choice(len(points), 3, replace=False) for _ in range(beam.evaluated)]), axis=1)
+    stats = batched_statistics(points, triples, args.batch_size)
+    scores = stats[args.objective][stats['valid']]
+    random_seconds = time.perf_counter() - start
+
+    best = beam.best[0] if beam.best is not None else np.inf
+    print(f"{len(points)} words, {beam.evaluated} triples measured by each, minimising {args.objective}")
+    print(f"beam search:     best {best:.6f} in {beam_seconds:.2f} s ({beam.pruned} more ruled out by bounds)")
+    print(f"random sampling: best {scores.min():.6f} in {random_seconds:.2f} s")
+    print(f"{np.count_nonzero(scores <= best)} of {len(scores)} random triples "
+          f"({np.count_nonzero(scores <= best) / len(scores):.2%}) are as good as the beam's best")
+
+
+def gram(args: argparse.Namespace) -> None:
+    rng = np.random.default_rng(args.random_seed)
+    print(f"{'words':>8s} {'dims':>6s} {'gram MiB':>9s} {'build s':>8s} {'float64 ms':>11s} {'float32 ms':>11s} "
+          f"{'gram ms':>8s} {'speedup':>8s} {'max abs dev':>12s}")
+    for size in args.sizes:
+        for dimension in args.dimensions:
+            points = synthetic_points(size, dimension, args.random_seed, args.decay)
+            triples = np.sort(np.array([rng.choice(size, 3, replace=False) for _ in range(args.batch_size)]), axis=1)
+            start = time.perf_counter()
+            engine = GramEngine(points)
+            build_seconds = time.perf_counter() - start
+            points32 = points.astype(np.float32)
+            timings = {}
+            for label, function in [
+                    ('float64', lambda _: triple_distances(points, triples)),
+                    ('float32', lambda _: triple_distances(points32, triples)),
+                    ('gram', lambda _: engine.triple_distances(triples))]:
+                timings[label] = median_seconds(function, args.repeats)
+            deviation = np.nanmax(np.abs(engine.triple_distances(triples)[1] - triple_distances(points, triples)[1]))
+            fastest_direct = min(timings['float64'], timings['float32'])
+            print(f"{size:8d} {dimension:6d} {gram_bytes(size) / 2 ** 20:9.0f} {build_seconds:8.2f} "
+                  f"{timings['float64'] * 1e3:11.2f} {timings['float32'] * 1e3:11.2f} {timings['gram'] * 1e3:8.2f} "
+                  f"{fastest_direct / timings['gram']:8.1f} {deviation:12.2e}")
+
+
+# Suite metrics where a bigger number is better; for every other one (times, memory) smaller is better
+HIGHER_IS_BETTER = {'finder_triples_per_second'}
+
+
+def median_seconds(function: Callable[[int], Any], repeats: int) -> float:
+    """Median wall time of function(i) over i = 0 .. repeats-1."""
+    times = []
+    for i in range(repeats):
+        start = time.perf_counter()
+        function(i)
+        times.append(time.perf_counter() - start)
+    return float(np.median(times))
+
+
+def peak_rss_mib(usage: resource.struct_rusage) -> float:
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    return usage.ru_maxrss / (2**20 if sys.platform == 'darwin' else 2**10)
+
+
+def write_suite_database(path: str, points: np.ndarray, gender: str = 'male') -> None:
+    """An openai_embeddings table holding `points` (as float32 BLOBs, like migrated databases) for the finder."""
+    conn = sqlite3.connect(path)
+    with conn:
+        create_embedding_table(conn, 'openai')
+        set_table_format(conn, 'openai_embeddings', points.shape[1])
+        conn.executemany('INSERT INTO openai_embeddings (adjective, gender, embedding) VALUES (?, ?, ?)',
+                         ((f"word{i}", gender, encode_embedding(point)) for i, point in enumerate(points)))
+    conn.close()
+
+
+def suite_case(size: int, dimension: int, options: Dict[str, Any], database: Optional[str],
+               results: multiprocessing.Queue) -> None:
+    """
+    The in-process measurements for one (size, dimension), run in a fresh process.
+
+    Puts a dict of results on `results`, including this process's peak RSS.
+    Afterwards, if `database` is given, writes the same points there for the
+    finder run.
+    """
+    dtype = np.dtype(options['dtype'])
+    rng = np.random.default_rng(options['random_seed'])
+    points = synthetic_points(size, dimension, options['random_seed'], options['decay']).astype(dtype)
+    row_norms = np.einsum('ij,ij->i', points, points)
+    float64_row_norms = np.einsum('ij,ij->i', points, points, dtype=np.float64)
+    triples = np.sort(np.array([rng.choice(size, 3, replace=False)
+                                for _ in range(max(options['queries'], options['batch_size']))]), axis=1)
+
+    result = {'size': size, 'dimension': dimension}
+    result['plane_construction_ms'] = median_seconds(
+        lambda i: Plane(*points[triples[i]]), options['planes']) * 1000
+    result['lightweight_plane_construction_ms'] = median_seconds(
+        lambda i: Plane(*points[triples[i]], lightweight=True), options['planes']) * 1000
+    planes = [Plane(*points[triple], lightweight=True) for triple in triples[:options['queries']]]
+    result['single_query_ms'] = median_seconds(
+        lambda i: planes[i].distances_to_plane(points), options['queries']) * 1000
+    batch = triples[:options['batch_size']]
+    result['batched_query_ms_per_plane'] = median_seconds(
+        lambda i: triple_distances(points, batch, row_norms, float64_row_norms),
+        options['batch_repeats']) * 1000 / len(batch)
+    result['peak_rss_mib'] = peak_rss_mib(resource.getrusage(resource.RUSAGE_SELF))
+    results.put(result)
+    if database:
+        write_suite_database(database, points)
+
+
+def run_finder(database: str, options: Dict[str, Any]) -> Dict[str, float]:
+    """Run language_plane_finder.py on `database` and report its throughput and peak RSS."""
+    metrics_path = f"{database}.metrics.jsonl"
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'language_plane_finder.py'),
+               '--database', database, '--embedding-provider', 'openai', '--gender', 'male',
+               '--schedule', 'enumerate', '--random-seed', str(options['random_seed']),
+               '--stop-after', str(options['finder_triples']), '--batch-size', str(options['batch_size']),
+               '--dtype', options['dtype'], '--metrics', metrics_path, '--metrics-interval', '1e9']
+    start = time.perf_counter()
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    # Reading stderr to the end before waiting keeps a chatty finder from blocking on a full pipe
+    errors = process.stderr.read()
+    _, status, usage = os.wait4(process.pid, 0)
+    elapsed = time.perf_counter() - start
+    if status != 0:
+        raise RuntimeError(f"The finder failed on {database}:\n{errors.decode(errors='replace')}")
+    with open(metrics_path) as f:
+        summary = json.loads(f.readlines()[-1])
+    return {
+        'finder_triples_per_second': summary['triples_per_second'],
+        'finder_wall_seconds': elapsed,
+        'finder_peak_rss_mib': peak_rss_mib(usage),
+    }
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_history(path: str) -> Dict[str, List[Dict[str, Any]]]:
+    if not os.path.exists(path):
+        return {'runs': []}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_history(path: str, history: Dict[str, List[Dict[str, Any]]]) -> None:
+    directory = os.path.dirname(os.path.abspath(path))
+    with tempfile.NamedTemporaryFile('w', dir=directory, suffix='.json', delete=False) as f:
+        json.dump(history, f, indent=1)
+    os.replace(f.name, path)
+
+
+def suite(args: argparse.Namespace) -> None:
+    options = {name: getattr(args, name) for name in ['random_seed', 'decay', 'dtype', 'planes', 'queries',
+                                                      'batch_size', 'batch_repeats', 'finder_triples']}
+    run = {
+        'label': args.label or time.strftime('%Y-%m-%d %H:%M:%S'),
+        'time': time.time(),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': f"{platform.system()} {platform.machine()}, {os.cpu_count()} CPUs",
+        'options': options,
+        'cases': [],
+    }
+    # Spawned rather than forked, so that each case's peak RSS is its own and not this process's
+    context = multiprocessing.get_context('spawn')
+    print(f"{'words':>7s} {'dim':>5s} {'plane ms':>9s} {'light ms':>9s} {'query ms':>9s} {'batch ms':>9s} "
+          f"{'RSS MiB':>8s} {'triples/s':>10s} {'finder MiB':>10s}")
+    for dimension in args.dimensions:
+        for size in args.sizes:
+            with tempfile.TemporaryDirectory() as directory:
+                database = None if args.no_finder else os.path.join(directory, 'suite.sqlite')
+                results = context.Queue()
+                process = context.Process(target=suite_case, args=(size, dimension, options, database, results))
+                process.start()
+                case = results.get()
+                process.join()
+                if process.exitcode != 0:
+                    raise RuntimeError(f"The benchmark for {size} words of dimension {dimension} failed")
+                if database:
+                    case.update(run_finder(database, options))
+            run['cases'].append(case)
+            print(f"{size:7d} {dimension:5d} {case['plane_construction_ms']:9.3f} "
+                  f"{case['lightweight_plane_construction_ms']:9.3f} {case['single_query_ms']:9.3f} "
+                  f"{case['batched_query_ms_per_plane']:9.3f} {case['peak_rss_mib']:8.0f} "
+                  f"{case.get('finder_triples_per_second', float('nan')):10.1f} "
+                  f"{case.get('finder_peak_rss_mib', float('nan')):10.0f}")
+    history = load_history(args.history)
+    history['runs'].append(run)
+    save_history(args.history, history)
+    print(f"Saved as run {len(history['runs']) - 1} ({run['label']}) in {args.history}")
+
+
+def find_run(runs: List[Dict[str, Any]], which: str) -> Dict[str, Any]:
+    """A run by its position in the history (negative counts from the end) or by its label."""
+    try:
+        return runs[int(which)]
+    except ValueError:
+        pass
+    except IndexError:
+        raise SystemExit(f"There are only {len(runs)} runs in the history")
+    for run in reversed(runs):
+        if run['label'] == which:
+            return run
+    raise SystemExit(f"No run labelled {which!r} in the history")
+
+
+def compare(args: argparse.Namespace) -> None:
+    runs = load_history(args.history)['runs']
+    if args.list:
+        for i, run in enumerate(runs):
+            print(f"{i:4d} {run['label']:24s} {run['commit'] or '':10s} {len(run['cases']):3d} cases  {run['machine']}")
+        return
+    baseline, candidate = find_run(runs, args.baseline), find_run(runs, args.candidate)
+    print(f"baseline:  {baseline['label']} ({baseline['commit']})")
+    print(f"candidate: {candidate['label']} ({candidate['commit']})")
+    if baseline['options'] != candidate['options']:
+        print("Warning: the two runs used different options")
+    baseline_cases = {(case['size'], case['dimension']): case for case in baseline['cases']}
+    regressions = 0
+    print(f"{'words':>7s} {'dim':>5s} {'metric':36s} {'baseline':>12s} {'candidate':>12s} {'change':>8s}")
+    for case in candidate['cases']:
+        before = baseline_cases.get((case['size'], case['dimension']))
+        if before is None:
+            continue
+        for metric, value in case.items():
+            if metric in ('size', 'dimension') or metric not in before or not before[metric]:
+                continue
+            change = value / before[metric] - 1
+            worse = -change if metric in HIGHER_IS_BETTER else change
+            flag = ''
+            if worse > args.threshold:
+                flag = 'REGRESSION'
+                regressions += 1
+            elif worse < -args.threshold:
+                flag = 'improved'
+            print(f"{case['size']:7d} {case['dimension']:5d} {metric:36s} {before[metric]:12.4g} {value:12.4g} "
+                  f"{change:+8.1%} {flag}")
+    print(f"{regressions} regressions beyond {args.threshold:.0%}")
+    if regressions:
+        sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmarks for the plane code.')
+    parser.add_argument('--random-seed', type=int, default=0)
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    construction_parser = subparsers.add_parser(
+        'construction', help='Eager vs lightweight Plane construction')
+    construction_parser.add_argument('--dimension', type=int, default=1536)
+    construction_parser.add_argument('--planes', type=int, default=20)
+    construction_parser.set_defaults(func=construction)
+
+    index_parser = subparsers.add_parser(
+        'index', help='PlaneIndex top-k queries vs full scans: speedup and recall as the vocabulary grows')
+    index_parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 5000, 20000])
+    index_parser.add_argument('--dimension', type=int, default=1536)
+    index_parser.add_argument('--decay', type=float, default=0.5,
+                              help='Spectral decay of the synthetic embeddings (0 is isotropic)')
+    index_parser.add_argument('--database', help='Sample real embeddings from here instead')
+    index_parser.add_argument('--embedding-provider', default='openai')
+    index_parser.add_argument('--gender', default='male')
+    index_parser.add_argument('--rank', type=int, default=64)
+    index_parser.add_argument('--candidates', type=int, nargs='+', default=[50, 200, 1000])
+    index_parser.add_argument('-k', type=int, default=10)
+    index_parser.add_argument('--queries', type=int, default=20)
+    index_parser.set_defaults(func=index)
+
+    precision_parser = subparsers.add_parser(
+        'precision', help='Largest deviation of every planar_statistics column in float32 from float64')
+    precision_parser.add_argument('--database', help='Use real embeddings from here instead of synthetic ones')
+    precision_parser.add_argument('--embedding-provider', default='openai')
+    precision_parser.add_argument('--gender', default='male')
+    precision_parser.add_argument('--size', type=int, default=10000)
+    precision_parser.add_argument('--dimension', type=int, default=1536)
+    precision_parser.add_argument('--decay', type=float, default=0.5)
+    precision_parser.add_argument('--triples', type=int, default=2000)
+    precision_parser.add_argument('--near-collinear', type=int, default=20,
+                                  help='Also add this many nearly collinear triples, to exercise the fallback')
+    precision_parser.add_argument('--batch-size', type=int, default=256)
+    precision_parser.set_defaults(func=precision)
+
+    search_parser = subparsers.add_parser(
+        'search', help='Best objective reached by the beam search vs uniform random sampling, for the same budget')
+    search_parser.add_argument('--database', help='Use real embeddings from here instead of synthetic ones')
+    search_parser.add_argument('--embedding-provider', default='openai')
+    search_parser.add_argument('--gender', default='male')
+    search_parser.add_argument('--size', type=int, default=5000)
+    search_parser.add_argument('--dimension', type=int, default=256)
+    search_parser.add_argument('--decay', type=float, default=0.5)
+    search_parser.add_argument('--objective', choices=SEARCH_OBJECTIVES, default='mean_distance')
+    search_parser.add_argument('--budget', type=int, default=5000, help='Triples each method may measure')
+    search_parser.add_argument('--beam-width', type=int, default=16)
+    search_parser.add_argument('--swap-candidates', type=int, default=24)
+    search_parser.add_argument('--batch-size', type=int, default=256)
+    search_parser.set_defaults(func=search)
+
+    gram_parser = subparsers.add_parser(
+        'gram', help='Distances for a batch of triples from the Gram matrix vs the direct float64 and float32 paths')
+    gram_parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 3000, 5000])
+    gram_parser.add_argument('--dimensions', type=int, nargs='+', default=[64, 128, 256, 768, 1536])
+    gram_parser.add_argument('--decay', type=float, default=0.5)
+    gram_parser.add_argument('--batch-size', type=int, default=256)
+    gram_parser.add_argument('--repeats', type=int, default=5)
+    gram_parser.set_defaults(func=gram)
+
+    suite_parser = subparsers.add_parser(
+        'suite', help='Time Plane, batched distances and the finder on synthetic embeddings of many sizes, '
+        'and add the results to a history file')
+    suite_parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    suite_parser.add_argument('--dimensions', type=int, nargs='+', default=[384, 768, 1536, 3072])
+    suite_parser.add_argument('--decay', type=float, default=0.5)
+    suite_parser.add_argument('--dtype', choices=['float64', 'float32'], default='float64')
+    suite_parser.add_argument('--planes', type=int, default=10, help='Planes built per construction timing')
+    suite_parser.add_argument('--queries', type=int, default=10, help='Single-plane distance queries timed')
+    suite_parser.add_argument('--batch-size', type=int, default=256)
+    suite_parser.add_argument('--batch-repeats', type=int, default=3)
+    suite_parser.add_argument('--finder-triples', type=int, default=2048,
+                              help='Triples the finder evaluates on a temporary database')
+    suite_parser.add_argument('--no-finder', action='store_true', help='Skip the end-to-end finder runs')
+    suite_parser.add_argument('--history', default='benchmark_history.json')
+    suite_parser.add_argument('--label', help='Name for this run (the current time by default)')
+    suite_parser.set_defaults(func=suite)
+
+    compare_parser = subparsers.add_parser(
+        'compare', help='Compare two suite runs from the history and flag regressions')
+    compare_parser.add_argument('--history', default='benchmark_history.json')
+    compare_parser.add_argument('--baseline', default='-2', help='Run number or label (the one before last by default)')
+    compare_parser.add_argument('--candidate', default='-1', help='Run number or label (the last by default)')
+    compare_parser.add_argument('--threshold', type=float, default=0.1,
+                                help='Relative change that counts as a regression')
+    compare_parser.add_argument('--list', action='store_true', help='List the runs in the history instead')
+    compare_parser.set_defaults(func=compare)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,130 +1,228 @@
 import sqlite3
 import numpy as np
 import openai
-import requests
-import json
+import httpx
 import os
 import argparse
-from typing import List, Dict, Tuple, Optional
-import time
+import asyncio
+from typing import Awaitable, Callable, List, Dict, Tuple, Optional
 from tqdm import tqdm
 
+from embeddingstore import create_embedding_table, decode_embedding, encode_embedding, migrate_table, set_table_format
+from ratelimit import TokenBucket, retry_with_backoff
+from responsecache import ResponseCache, add_cache_arguments, open_cache
+
+MODELS = {'openai': 'text-embedding-3-small', 'ollama': 'nomic-embed-text'}
+
+
+class OllamaRateLimitError(httpx.HTTPStatusError):
+    """Ollama (or a proxy in front of it) answered HTTP 429."""
+
+
 class EmbeddingGenerator:
-    def __init__(self, db_path: str, ollama_host: str, stop_after: Optional[int] = None):
+    def __init__(self, db_path: str, ollama_host: str, stop_after: Optional[int] = None,
+                 ollama_port: int = 11434, openai_api_key: Optional[str] = None,
+                 openai_base_url: Optional[str] = None, batch_size: int = 100,
+                 max_in_flight: Optional[Dict[str, int]] = None,
+                 requests_per_second: Optional[Dict[str, Optional[float]]] = None,
+                 cache: Optional[ResponseCache] = None):
         self.db_path = db_path
         self.ollama_host = ollama_host
+        self.ollama_port = ollama_port
         self.stop_after = stop_after
+        self.openai_api_key = openai_api_key
+        self.openai_base_url = openai_base_url
+        # Sentences per request, to either provider
+        self.batch_size = batch_size
+        self.max_in_flight = max_in_flight or {'openai': 4, 'ollama': 8}
+        # No need to rate limit our own machines. We can't DoS ourselves: we are the service.
+        self.requests_per_second = requests_per_second or {'openai': 5.0, 'ollama': None}
+        # Sentences already embedded by any earlier run, whatever database it wrote to
+        self.cache = cache
+        # One connection for the whole run
+        self.conn = sqlite3.connect(db_path)
         self.setup_database()
         
     def setup_database(self):
         """Set up the database tables for embeddings."""
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
+        conn = self.conn
         
         # Create tables for each embedding source
         for source in ['openai', 'ollama']:
-            c.execute(f'''
-                CREATE TABLE IF NOT EXISTS {source}_embeddings (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    adjective TEXT NOT NULL,
-                    gender TEXT NOT NULL,
-                    embedding TEXT NOT NULL,
-                    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-                    UNIQUE(adjective, gender)
-                )
-            ''')
+            create_embedding_table(conn, source)
+            # Older databases kept JSON text; convert them so every row is a BLOB
+            converted = migrate_table(conn, f"{source}_embeddings")
+            if converted:
+                print(f"Converted {converted} JSON embeddings in {source}_embeddings to float32")
         
         conn.commit()
-        conn.close()
 
     def get_adjectives(self) -> List[str]:
         """Get all adjectives from the original analysis table."""
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
+        c = self.conn.cursor()
         c.execute('SELECT adjective FROM adjective_analysis where he_is_personality or she_is_personality')
-        adjectives = [row[0] for row in c.fetchall()]
-        conn.close()
-        return adjectives
+        return [row[0] for row in c.fetchall()]
+
+    def missing_embeddings(self, sources: List[str], genders: List[str]) -> List[Tuple[str, str, str]]:
+        """
+        Every (source, adjective, gender) still without an embedding, found with one anti-join query.
+
+        The order is the one the generator has always used: by adjective, then
+        gender, then source.
+        """
+        wanted = ' union all '.join(f'select {i} as gender_order, ? as gender' for i in range(len(genders)))
+        missing = ' union all '.join(f'''
+            select {i} as source_order, '{source}' as source, w.adjective_order, w.gender_order,
+                   w.adjective, w.gender
+            from wanted w
+            where not exists (select 1 from {source}_embeddings e
+                              where e.adjective = w.adjective and e.gender = w.gender)'''
+            for i, source in enumerate(sources))
+        c = self.conn.cursor()
+        c.execute(f'''
+            with wanted as (
+                select a.rowid as adjective_order, g.gender_order, a.adjective, g.gender
+                from adjective_analysis a cross join ({wanted}) g
+                where a.he_is_personality or a.she_is_personality
+            )
+            select source, adjective, gender from ({missing})
+            order by adjective_order, gender_order, source_order''', genders)
+        return c.fetchall()
 
     def create_sentence(self, adjective: str, gender: str) -> str:
         """Create the sentence for embedding."""
         pronoun = "He" if gender.lower() == "male" else "She"
         return f"{pronoun} is {adjective}"
 
-    def get_openai_embedding(self, text: str) -> np.ndarray:
-        """Get embedding from OpenAI API."""
-        response = openai.embeddings.create(
-                model="text-embedding-3-small",
-                input=text
-        )
-        embedding = response.data[0].embedding
-        return json.dumps(embedding)
-
-
-    def get_ollama_embedding(self, text: str) -> np.ndarray:
-        """Get embedding from Ollama API."""
-        response = requests.post(
-            f'http://{self.ollama_host}:11434/api/embeddings',
-            json={
-            "model": "nomic-embed-text",
-                "prompt": text
-            }
-        )
-        embedding = response.json()['embedding']
-        return json.dumps(embedding)
-
-    def store_embedding(self, source: str, adjective: str, gender: str, embedding: np.ndarray):
-        """Store the embedding in the appropriate database table."""
-        if embedding is None:
+    async def send(self, source: str, call: Callable[[], Awaitable]):
+        """Make one request to a source, within its concurrency and rate limits, retrying failures."""
+        async def attempt():
+            await self.rate_limiters[source].acquire()
+            return await call()
+
+        async with self.in_flight[source]:
+            return await retry_with_backoff(attempt, retry_on=(openai.APIError, httpx.HTTPError),
+                                            throttled_on=(openai.RateLimitError, OllamaRateLimitError))
+
+    async def get_openai_embeddings(self, texts: List[str]) -> List[np.ndarray]:
+        """Get embeddings for many texts from one OpenAI API request."""
+        response = await self.send('openai', lambda: self.openai_client.embeddings.create(
+                model=MODELS['openai'],
+                input=texts
+        ))
+        ordered = sorted(response.data, key=lambda item: item.index)
+        return [np.array(item.embedding, dtype=np.float32) for item in ordered]
+
+    async def get_ollama_embeddings(self, texts: List[str]) -> List[np.ndarray]:
+        """Get embeddings for many texts from one request to Ollama's batched /api/embed."""
+        async def call():
+            response = await self.ollama_client.post('/api/embed', json={"model": MODELS['ollama'], "input": texts})
+            if response.status_code == 429:
+                raise OllamaRateLimitError("Ollama is rate limiting", request=response.request, response=response)
+            response.raise_for_status()
+            return response.json()['embeddings']
+
+        embeddings = await self.send('ollama', call)
+        return [np.array(embedding, dtype=np.float32) for embedding in embeddings]
+
+    async def fetch_embeddings(self, source: str, texts: List[str]) -> List[Optional[np.ndarray]]:
+        """
+        Embed texts in one request, or text by text if that request keeps failing.
+
+        Texts that fail on their own as well are reported and left as None,
+        so one bad input does not lose the rest of its batch.
+        """
+        fetch = {'openai': self.get_openai_embeddings, 'ollama': self.get_ollama_embeddings}[source]
+        try:
+            return await fetch(texts)
+        except (openai.APIError, httpx.HTTPError) as e:
+            if len(texts) == 1:
+                print(f"Skipping {texts[0]!r} for {source}: {type(e).__name__}: {e}")
+                return [None]
+        print(f"A batch of {len(texts)} failed for {source}; sending its texts one at a time")
+        singles = await asyncio.gather(*[self.fetch_embeddings(source, [text]) for text in texts])
+        return [embedding for (embedding,) in singles]
+
+    def store_embeddings(self, source: str, rows: List[Tuple[str, str, np.ndarray]]):
+        """Store a batch of (adjective, gender, embedding) in the source's table, in one transaction."""
+        rows = [row for row in rows if row[2] is not None]
+        if not rows:
             return
-            
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
-        
-        c.execute(f'''
-                INSERT OR REPLACE INTO {source}_embeddings (adjective, gender, embedding)
-                VALUES (?, ?, ?)
-        ''', (adjective, gender, embedding))
-        conn.commit()
+        with self.conn:
+            set_table_format(self.conn, f"{source}_embeddings", len(rows[0][2]))
+            self.conn.executemany(f'''
+                    INSERT OR REPLACE INTO {source}_embeddings (adjective, gender, embedding)
+                    VALUES (?, ?, ?)
+            ''', [(adjective, gender, encode_embedding(embedding)) for adjective, gender, embedding in rows])
 
-    def embedding_already_exists(self, source: str, adjective: str, gender: str):
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
-        c.execute(f"select count(*) from {source}_embeddings where adjective = ? and gender = ?", [adjective, gender])
-        row = c.fetchone()
-        if row[0] == 0:
-            return False
-        return True
+    async def embed_batch(self, source: str, batch: List[Tuple[str, str]], progress: tqdm) -> None:
+        """Fetch and store the embeddings of one batch of (adjective, gender) pairs."""
+        sentences = [self.create_sentence(adjective, gender) for adjective, gender in batch]
+        if self.cache is None:
+            embeddings = await self.fetch_embeddings(source, sentences)
+        else:
+            cached = self.cache.get_many(source, MODELS[source], sentences)
+            embeddings = [None if blob is None else decode_embedding(blob) for blob in cached]
+            uncached = [i for i, embedding in enumerate(embeddings) if embedding is None]
+            if uncached:
+                fetched = await self.fetch_embeddings(source, [sentences[i] for i in uncached])
+                answered = [(sentences[i], embedding) for i, embedding in zip(uncached, fetched)
+                            if embedding is not None]
+                self.cache.put_many(source, MODELS[source], [sentence for sentence, _ in answered],
+                                    [encode_embedding(embedding) for _, embedding in answered])
+                for i, embedding in zip(uncached, fetched):
+                    embeddings[i] = embedding
+        self.store_embeddings(source, [(adjective, gender, embedding)
+                                       for (adjective, gender), embedding in zip(batch, embeddings)])
+        progress.set_description(sentences[-1])
+        progress.update(len(batch))
+
+    async def process_all_async(self):
+        """Generate every missing embedding, with a bounded number of requests in flight per source."""
+        # Created here so that they belong to the running event loop
+        self.openai_client = openai.AsyncOpenAI(api_key=self.openai_api_key, base_url=self.openai_base_url,
+                                                max_retries=0)
+        self.in_flight = {source: asyncio.Semaphore(limit) for source, limit in self.max_in_flight.items()}
+        self.rate_limiters = {source: TokenBucket(rate) for source, rate in self.requests_per_second.items()}
+        self.ollama_client = httpx.AsyncClient(base_url=f'http://{self.ollama_host}:{self.ollama_port}', timeout=120)
+        try:
+            work = self.missing_embeddings(['openai', 'ollama'], ['male', 'female'])
+            if self.stop_after:
+                work = first_embeddings(work, self.stop_after)
+
+            progress = tqdm(total=len(work), desc="Processing adjectives")
+            tasks = []
+            for source in ['openai', 'ollama']:
+                pending = [(adjective, gender) for s, adjective, gender in work if s == source]
+                for start in range(0, len(pending), self.batch_size):
+                    tasks.append(self.embed_batch(source, pending[start:start + self.batch_size], progress))
+            await asyncio.gather(*tasks)
+            progress.close()
+            if self.cache is not None:
+                print(self.cache.summary())
+        finally:
+            await self.ollama_client.aclose()
+            await self.openai_client.close()
 
     def process_all(self):
         """Process all adjectives and generate embeddings from all sources."""
-        adjectives = self.get_adjectives()
-        genders = ['male', 'female']
-        processed_count = 0
-
-        iterator = tqdm(adjectives, desc="Processing adjectives")
-        for adjective in iterator:
-            for gender in genders:
-                sentence = self.create_sentence(adjective, gender)
-                iterator.set_description(sentence)
-                if self.embedding_already_exists('openai', adjective, gender):
-                    pass
-                else:
-                    openai_embedding = self.get_openai_embedding(sentence)
-                    self.store_embedding('openai', adjective, gender, openai_embedding)
-                    # Rate limiting
-                    processed_count += 1
-                    time.sleep(0.1)
-                    
-                if self.embedding_already_exists('ollama', adjective, gender):
-                    pass
-                else:
-                    ollama_embedding = self.get_ollama_embedding(sentence)
-                    self.store_embedding('ollama', adjective, gender, ollama_embedding)
-                    processed_count += 1
-                    # No need to rate limit our own machines. We can't DoS ourselves: we are the service.
-                if self.stop_after and processed_count >= self.stop_after:
-                    return
+        asyncio.run(self.process_all_async())
+
+    def close(self):
+        self.conn.close()
+
+
+def first_embeddings(work: List[Tuple[str, str, str]], stop_after: int) -> List[Tuple[str, str, str]]:
+    """
+    The start of the missing_embeddings work that --stop-after allows.
+
+    As it always has, that is the first `stop_after` embeddings, plus those
+    needed to finish the (adjective, gender) pair the last of them belongs to.
+    """
+    count = min(stop_after, len(work))
+    while count < len(work) and work[count][1:] == work[count - 1][1:]:
+        count += 1
+    return work[:count]
 
 def read_api_key(filepath: str) -> str:
     """Read API key from file."""
@@ -133,10 +231,18 @@ def read_api_key(filepath: str) -> str:
 
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument("--stop-after", type=int, help="Only process this many adjectives")
+    parser.add_argument("--stop-after", type=int,
+                        help="Stop once this many embeddings are made, finishing the adjective and gender at hand")
     parser.add_argument("--openai-api-key-file", default=os.path.expanduser("~/.openai.key"))
+    parser.add_argument("--openai-base-url", help="Send OpenAI requests somewhere else, e.g. to stubserver.py")
     parser.add_argument("--ollama-host", default="localhost")
+    parser.add_argument("--ollama-port", type=int, default=11434)
     parser.add_argument("--database", default="personality_adjectives.sqlite")
+    parser.add_argument("--batch-size", type=int, default=100, help="Sentences per request batch")
+    parser.add_argument("--openai-concurrency", type=int, default=4, help="OpenAI requests in flight at once")
+    parser.add_argument("--ollama-concurrency", type=int, default=8, help="Ollama requests in flight at once")
+    parser.add_argument("--openai-requests-per-second", type=float, default=5.0)
+    add_cache_arguments(parser)
     args = parser.parse_args()
 
     openai.api_key = read_api_key(args.openai_api_key_file)
@@ -145,9 +251,19 @@ def main():
     embedder = EmbeddingGenerator(
         db_path=args.database,
         ollama_host=args.ollama_host,
-        stop_after=args.stop_after
+        stop_after=args.stop_after,
+        ollama_port=args.ollama_port,
+        openai_api_key=openai.api_key,
+        openai_base_url=args.openai_base_url,
+        batch_size=args.batch_size,
+        max_in_flight={'openai': args.openai_concurrency, 'ollama': args.ollama_concurrency},
+        requests_per_second={'openai': args.openai_requests_per_second, 'ollama': None},
+        cache=open_cache(args)
     )
-    embedder.process_all()
+    try:
+        embedder.process_all()
+    finally:
+        embedder.close()
     
 if __name__ == "__main__":
     main()
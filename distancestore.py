@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+
+"""
+Append-only store of the full distance vector of every evaluated plane.
+
+    python language_plane_finder.py --distance-store distances ...
+    python distancestore.py info distances/openai.male.0123456789abcdef
+
+A store is a directory holding store.json (the vocabulary the vectors are
+indexed by and their dtype) and any number of segments. Each segment is a
+pair of files written by a single process: {segment}.triples, the packed
+triple ids (int64, see triples.pack_triple), and {segment}.distances, one row
+of len(vocab) distances per id, NaN for the words defining the plane. Both
+are only ever appended to, and a segment is closed after `segment_rows` rows,
+so several processes can write to one store at once and a crash can at worst
+leave a partial last row, which readers ignore. Readers memory-map every
+segment, so looking up one plane reads one row.
+"""
+
+import argparse
+import json
+import os
+import time
+from typing import Iterator, Optional, Sequence, Tuple
+
+import numpy as np
+
+from triples import pack_triples
+
+STORE_DTYPES = ['float16', 'float32']
+
+
+def store_directory(root: str, embedding_provider: str, gender: str, vocabulary: str) -> str:
+    """One store per vocabulary (see vocabulary.py), since every vector is indexed by it."""
+    return os.path.join(root, f"{embedding_provider}.{gender}.{vocabulary[:16]}")
+
+
+class DistanceStore:
+    def __init__(self, directory: str, vocab: Optional[Sequence[str]] = None, dtype: str = 'float32',
+                 segment_rows: int = 65536):
+        """
+        Open (or, given a vocabulary, create) a distance store.
+
+        Args:
+            directory (str): Directory of the store
+            vocab (list): The vocabulary the vectors are indexed by. A new store
+                needs it; an existing one checks it matches.
+            dtype (str): 'float16' or 'float32', for a new store
+            segment_rows (int): Rows per segment before writing moves on to a new one
+        """
+        self.directory = directory
+        self.segment_rows = segment_rows
+        metadata_path = os.path.join(directory, 'store.json')
+        if os.path.exists(metadata_path):
+            with open(metadata_path) as f:
+                metadata = json.load(f)
+            if vocab is not None and list(vocab) != metadata['vocab']:
+                raise ValueError(f"{directory} was written for a different vocabulary")
+        elif vocab is None:
+            raise FileNotFoundError(f"No distance store in {directory}")
+        else:
+            if dtype not in STORE_DTYPES:
+                raise ValueError(f"Distances can be stored as {' or '.join(STORE_DTYPES)}, not {dtype}")
+            metadata = {'vocab': list(vocab), 'dtype': dtype}
+            os.makedirs(directory, exist_ok=True)
+            temporary = f"{metadata_path}.{os.getpid()}"
+            with open(temporary, 'w') as f:
+                json.dump(metadata, f)
+            os.replace(temporary, metadata_path)
+        self.vocab = metadata['vocab']
+        self.dtype = np.dtype(metadata['dtype'])
+        self.row_bytes = len(self.vocab) * self.dtype.itemsize
+        self._writer = None
+        self._written = 0
+        self._segments = None
+
+    # Writing
+
+    def _open_segment(self) -> None:
+        self.close()
+        segment = f"{time.time_ns():020d}-{os.getpid()}"
+        base = os.path.join(self.directory, segment)
+        self._writer = (open(f"{base}.triples", 'ab'), open(f"{base}.distances", 'ab'))
+        self._written = 0
+
+    def append(self, triples: np.ndarray, distances: np.ndarray) -> None:
+        """Append the (K, N) distance vectors of K planes given by their (K, 3) word indices."""
+        if len(triples) == 0:
+            return
+        if self._writer is None or self._written >= self.segment_rows:
+            self._open_segment()
+        triples_file, distances_file = self._writer
+        # Distances first: a row without its id is ignored, an id without its row would not be
+        distances_file.write(np.ascontiguousarray(distances, dtype=self.dtype).tobytes())
+        distances_file.flush()
+        triples_file.write(pack_triples(triples, len(self.vocab)).astype('<i8').tobytes())
+        triples_file.flush()
+        self._written += len(triples)
+        self._segments = None
+
+    def close(self) -> None:
+        if self._writer is not None:
+            for f in self._writer:
+                f.close()
+            self._writer = None
+
+    # Reading
+
+    def _load_segments(self) -> None:
+        """Map every segment and index the stored triples, the first copy of each winning."""
+        ids, locations = [], []
+        self._segments = []
+        for name in sorted(os.listdir(self.directory)):
+            if not name.endswith('.triples'):
+                continue
+            base = os.path.join(self.directory, name[:-len('.triples')])
+            segment_ids = np.fromfile(f"{base}.triples", dtype='<i8')
+            rows = min(len(segment_ids), os.path.getsize(f"{base}.distances") // self.row_bytes)
+            if rows == 0:
+                continue
+            self._segments.append(np.memmap(f"{base}.distances", dtype=self.dtype, mode='r',
+                                            shape=(rows, len(self.vocab))))
+            ids.append(segment_ids[:rows])
+            locations.append(np.column_stack([np.full(rows, len(self._segments) - 1), np.arange(rows)]))
+        if ids:
+            all_ids = np.concatenate(ids)
+            all_locations = np.concatenate(locations)
+        else:
+            all_ids = np.empty(0, dtype=np.int64)
+            all_locations = np.empty((0, 2), dtype=np.int64)
+        all_ids, first = np.unique(all_ids, return_index=True)
+        self._ids = all_ids
+        self._locations = all_locations[first]
+
+    def _index(self) -> Tuple[np.ndarray, np.ndarray]:
+        if self._segments is None:
+            self._load_segments()
+        return self._ids, self._locations
+
+    def refresh(self) -> None:
+        """Pick up segments other processes have written since the store was opened."""
+        self._segments = None
+
+    def __len__(self) -> int:
+        return len(self._index()[0])
+
+    def find(self, triples: np.ndarray) -> np.ndarray:
+        """Row positions in the index of each (K, 3) triple, -1 where it is not stored."""
+        ids, _ = self._index()
+        packed = pack_triples(np.asarray(triples).reshape(-1, 3), len(self.vocab))
+        positions = np.searchsorted(ids, packed)
+        found = positions < len(ids)
+        found[found] = ids[positions[found]] == packed[found]
+        return np.where(found, positions, -1)
+
+    def __contains__(self, triple: Sequence[int]) -> bool:
+        return self.find(np.array([triple]))[0] >= 0
+
+    def get_many(self, triples: np.ndarray) -> np.ndarray:
+        """The (K, N) float32 distance vectors of K stored triples; KeyError if any is missing."""
+        positions = self.find(triples)
+        if (positions < 0).any():
+            raise KeyError(f"{np.count_nonzero(positions < 0)} of the triples are not stored")
+        _, locations = self._index()
+        return np.array([self._segments[segment][row] for segment, row in locations[positions]],
+                        dtype=np.float32).reshape(len(positions), len(self.vocab))
+
+    def get(self, triple: Sequence[int]) -> np.ndarray:
+        return self.get_many(np.array([triple]))[0]
+
+    def triples(self) -> np.ndarray:
+        """Every stored triple as a (M, 3) array of sorted word indices, in packed order."""
+        ids, _ = self._index()
+        n = len(self.vocab)
+        return np.column_stack([ids // (n * n), ids // n % n, ids % n])
+
+    def iter_batches(self, batch_size: int = 256) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+        """Yield (triples, float32 distances) for everything stored, batch_size planes at a time."""
+        triples = self.triples()
+        for start in range(0, len(triples), batch_size):
+            batch = triples[start:start + batch_size]
+            yield batch, self.get_many(batch)
+
+    def size_on_disk(self) -> int:
+        return sum(os.path.getsize(os.path.join(self.directory, name)) for name in os.listdir(self.directory))
+
+    def __enter__(self) -> "DistanceStore":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+def info(args: argparse.Namespace) -> None:
+    store = DistanceStore(args.directory)
+    print(f"{args.directory}: {len(store)} planes over {len(store.vocab)} words as {store.dtype.name}, "
+          f"{len(store._segments)} segments, {store.size_on_disk() / 1e6:.1f} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Inspect a store of plane distance vectors.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    info_parser = subparsers.add_parser('info', help='How many planes are stored, and how big the store is')
+    info_parser.add_argument('directory')
+    info_parser.set_defaults(func=info)
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import os
+import sqlite3
+import tempfile
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+# Embeddings are stored as little-endian float32 BLOBs
+EMBEDDING_DTYPE = np.dtype('<f4')
+
+
+def create_formats_table(conn: sqlite3.Connection) -> None:
+    """Create the table recording the dimension and dtype of each binary embeddings table."""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS embedding_formats (
+            table_name TEXT PRIMARY KEY,
+            dimension INTEGER NOT NULL,
+            dtype TEXT NOT NULL
+        )
+    ''')
+
+
+def create_embedding_table(conn: sqlite3.Connection, source: str) -> None:
+    """Create {source}_embeddings (if needed) and the table that describes its BLOB format."""
+    conn.execute(f'''
+        CREATE TABLE IF NOT EXISTS {source}_embeddings (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            adjective TEXT NOT NULL,
+            gender TEXT NOT NULL,
+            embedding BLOB NOT NULL,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE(adjective, gender)
+        )
+    ''')
+    create_formats_table(conn)
+
+
+def table_format(conn: sqlite3.Connection, table: str) -> Optional[Tuple[int, np.dtype]]:
+    """Return (dimension, dtype) of a binary embeddings table, or None if it still holds JSON."""
+    try:
+        row = conn.execute('SELECT dimension, dtype FROM embedding_formats WHERE table_name = ?',
+                           [table]).fetchone()
+    except sqlite3.OperationalError:
+        return None
+    if row is None:
+        return None
+    return row[0], np.dtype(row[1])
+
+
+def set_table_format(conn: sqlite3.Connection, table: str, dimension: int) -> None:
+    """Record the dimension of a table, refusing to change it once set."""
+    existing = table_format(conn, table)
+    if existing is not None:
+        if existing[0] != dimension:
+            raise ValueError(f"{table} holds {existing[0]}-dimensional embeddings, not {dimension}")
+        return
+    conn.execute('INSERT INTO embedding_formats (table_name, dimension, dtype) VALUES (?, ?, ?)',
+                 [table, dimension, EMBEDDING_DTYPE.str])
+
+
+def encode_embedding(embedding) -> bytes:
+    """Convert a vector (list or array) into the BLOB stored in the embedding column."""
+    return np.asarray(embedding, dtype=EMBEDDING_DTYPE).tobytes()
+
+
+def decode_embedding(blob: bytes) -> np.ndarray:
+    return np.frombuffer(blob, dtype=EMBEDDING_DTYPE)
+
+
+def load_embedding_matrix(conn: sqlite3.Connection, table: str, gender: str,
+                          dtype=np.float64) -> Tuple[List[str], np.ndarray]:
+    """
+    Load every embedding for one gender into a vocabulary list and one (N, d) matrix.
+
+    Binary tables are read with a single np.frombuffer over the concatenated
+    BLOBs. Tables that have not been migrated yet fall back to parsing JSON.
+    """
+    rows = conn.execute(f'SELECT adjective, embedding FROM {table} WHERE gender = ? ORDER BY id',
+                        [gender]).fetchall()
+    vocab = [adjective for adjective, _ in rows]
+    stored = table_format(conn, table)
+    if stored is None:
+        matrix = np.array([json.loads(embedding) for _, embedding in rows], dtype=dtype)
+        return vocab, matrix.reshape(len(rows), -1)
+    dimension, stored_dtype = stored
+    matrix = np.frombuffer(b''.join(embedding for _, embedding in rows), dtype=stored_dtype)
+    matrix = matrix.reshape(len(rows), dimension)
+    if matrix.dtype != dtype:
+        matrix = matrix.astype(dtype)
+    return vocab, matrix
+
+
+def table_version(conn: sqlite3.Connection, table: str, gender: str) -> Dict[str, Any]:
+    """Cheap fingerprint of one gender's rows: any insert or replace, or migrating them to BLOBs, changes it."""
+    row_count, max_timestamp, max_id, json_rows = conn.execute(
+        f"SELECT count(*), max(timestamp), max(id), total(typeof(embedding) = 'text') FROM {table} WHERE gender = ?",
+        [gender]).fetchone()
+    return {'row_count': row_count, 'max_timestamp': max_timestamp, 'max_id': max_id, 'json_rows': int(json_rows)}
+
+
+def load_cached_matrix(sidecar_path: str, **expected) -> Optional[Tuple[Dict[str, Any], np.ndarray]]:
+    """
+    The sidecar and memory-mapped matrix saved by save_cached_matrix, if the sidecar has the `expected` values.
+
+    Returns None when there is no usable cache, including when the matrix
+    file was removed by a concurrent rebuild after the sidecar was read.
+    """
+    try:
+        with open(sidecar_path) as f:
+            sidecar = json.load(f)
+        if all(sidecar[key] == value for key, value in expected.items()):
+            return sidecar, np.load(os.path.join(os.path.dirname(sidecar_path), sidecar['matrix']), mmap_mode='r')
+    except (OSError, ValueError, KeyError):
+        pass
+    return None
+
+
+def save_cached_matrix(sidecar_path: str, matrix: np.ndarray, **sidecar) -> np.ndarray:
+    """
+    Save a matrix under a fresh name, then atomically replace the sidecar that names it.
+
+    A reader of the sidecar therefore always finds the matrix it was written
+    with. The matrix the previous sidecar named is removed afterwards; processes
+    that already mapped it keep their copy.
+    """
+    cache_directory = os.path.dirname(sidecar_path)
+    os.makedirs(cache_directory, exist_ok=True)
+    prefix = os.path.basename(sidecar_path).rsplit('.', 1)[0] + '.'
+    with tempfile.NamedTemporaryFile(dir=cache_directory, prefix=prefix, suffix='.npy', delete=False) as f:
+        np.save(f, matrix)
+    matrix_name = os.path.basename(f.name)
+    try:
+        with open(sidecar_path) as f:
+            previous = json.load(f).get('matrix')
+    except (OSError, ValueError, AttributeError):
+        previous = None
+    with tempfile.NamedTemporaryFile('w', dir=cache_directory, suffix='.json', delete=False) as f:
+        json.dump(dict(sidecar, matrix=matrix_name), f)
+    os.replace(f.name, sidecar_path)
+    if previous and previous != matrix_name:
+        try:
+            os.remove(os.path.join(cache_directory, previous))
+        except OSError:
+            pass
+    return np.load(os.path.join(cache_directory, matrix_name), mmap_mode='r')
+
+
+def cached_embedding_matrix(conn: sqlite3.Connection, table: str, gender: str, cache_directory: str,
+                            dtype=np.float64) -> Tuple[List[str], np.ndarray]:
+    """
+    Like load_embedding_matrix, but through a memory-mapped .npy cache file.
+
+    The cache is a {table}.{gender}.{dtype}.vocab.json sidecar that lists the
+    words (in row order), the table_version they were loaded at and the .npy
+    file holding the matrix (see save_cached_matrix). It is only rebuilt when
+    that version changes, and concurrent readers never see a half-written or
+    mismatched cache. Every process mapping the same file shares one copy in
+    the page cache.
+    """
+    dtype = np.dtype(dtype)
+    sidecar_path = os.path.join(cache_directory, f"{table}.{gender}.{dtype.str.lstrip('<>=|')}.vocab.json")
+    version = table_version(conn, table, gender)
+    cached = load_cached_matrix(sidecar_path, version=version)
+    if cached is not None:
+        sidecar, matrix = cached
+        return sidecar['vocab'], matrix
+    vocab, matrix = load_embedding_matrix(conn, table, gender, dtype)
+    return vocab, save_cached_matrix(sidecar_path, matrix, version=version, vocab=vocab)
+
+
+def migrate_table(conn: sqlite3.Connection, table: str) -> int:
+    """Rewrite the JSON embeddings of one table as float32 BLOBs, in one transaction."""
+    rows = conn.execute(f"SELECT id, embedding FROM {table} WHERE typeof(embedding) = 'text'").fetchall()
+    dimension = None
+    with conn:
+        for row_id, embedding_as_json in rows:
+            embedding = json.loads(embedding_as_json)
+            if dimension is None:
+                dimension = len(embedding)
+                set_table_format(conn, table, dimension)
+            elif len(embedding) != dimension:
+                raise ValueError(f"{table} row {row_id} has {len(embedding)} dimensions, expected {dimension}")
+            conn.execute(f'UPDATE {table} SET embedding = ? WHERE id = ?',
+                         [encode_embedding(embedding), row_id])
+    return len(rows)
+
+
+def migrate(args: argparse.Namespace) -> None:
+    conn = sqlite3.connect(args.database)
+    create_formats_table(conn)
+    for source in args.sources:
+        table = f"{source}_embeddings"
+        exists = conn.execute("SELECT count(*) FROM sqlite_master WHERE type = 'table' AND name = ?",
+                              [table]).fetchone()[0]
+        if not exists:
+            print(f"{table}: no such table")
+            continue
+        converted = migrate_table(conn, table)
+        print(f"{table}: converted {converted} rows")
+    if args.vacuum:
+        conn.execute('VACUUM')
+    conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Manage the binary storage of embeddings.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    migrate_parser = subparsers.add_parser('migrate', help='Convert JSON embeddings into float32 BLOBs')
+    migrate_parser.add_argument('--database', default='personality_adjectives.sqlite')
+    migrate_parser.add_argument('--sources', nargs='+', default=['openai', 'ollama'])
+    migrate_parser.add_argument('--vacuum', action='store_true',
+                                help='Reclaim the space the JSON text used afterwards')
+    migrate_parser.set_defaults(func=migrate)
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,373 @@
+#!/usr/bin/env python3
+
+"""
+Static word embeddings (GloVe or word2vec text files) as a memory-mapped matrix.
+
+    python glovestore.py ingest glove.840B.300d.txt glove840b
+    python glovestore.py lookup glove840b kind gentle cruel
+    python glovestore.py export glove840b --database personality_adjectives.sqlite
+
+ingest streams the text file in chunks of lines, parses each chunk's numbers
+with one NumPy call and appends them to a directory holding:
+
+    store.json       dimension, row count and where the vectors came from
+    vectors.f32      the (count, dimension) little-endian float32 matrix
+    terms.bin        every term, UTF-8, one after the other
+    terms.offsets    int64 offsets of each term in terms.bin (count + 1)
+    index.hashes     sorted 64-bit hashes of the terms (uint64)
+    index.rows       the row of the term behind each hash (int64)
+
+GloveLookup memory-maps the vectors and terms and reads only the index (16
+bytes a term), so opening a store of millions of words costs no parsing. The
+first copy of a repeated term wins. export copies the vectors of chosen words
+into a {provider}_embeddings table, for language_plane_finder.py to use like
+any other provider.
+"""
+
+import argparse
+import hashlib
+import itertools
+import json
+import os
+import shutil
+import sqlite3
+from collections import OrderedDict
+from typing import Iterable, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+import tqdm
+
+from embeddingstore import create_embedding_table, encode_embedding, set_table_format
+
+
+def term_hash(term: str) -> int:
+    return int.from_bytes(hashlib.blake2b(term.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def term_hashes(terms: Iterable[str]) -> np.ndarray:
+    return np.fromiter((term_hash(term) for term in terms), dtype=np.uint64)
+
+
+def parse_chunk(lines: List[str], dimension: int) -> Tuple[List[str], np.ndarray, int]:
+    """
+    Split "term v1 ... vd" lines into terms and a (K, d) float32 matrix.
+
+    Usually the term is everything before the first space and every line
+    has exactly d numbers after it, so the whole chunk is converted in one
+    np.array call. Otherwise (a term containing spaces, or a malformed line)
+    the chunk is parsed again line by line, taking the last d fields as the
+    vector, and lines that still do not fit are dropped. Returns (terms,
+    vectors, lines dropped).
+    """
+    parts = [line.rstrip('\n').split(' ', 1) for line in lines]
+    if all(len(part) == 2 for part in parts):
+        fields = [part[1].split() for part in parts]
+        if all(len(row) == dimension for row in fields):
+            try:
+                return [part[0] for part in parts], np.array(fields, dtype=np.float32).reshape(-1, dimension), 0
+            except ValueError:
+                pass
+    terms, rows = [], []
+    for line in lines:
+        fields = line.rstrip().rsplit(' ', dimension)
+        if len(fields) != dimension + 1:
+            continue
+        try:
+            rows.append(np.array(fields[1:], dtype=np.float32))
+        except ValueError:
+            continue
+        terms.append(fields[0])
+    return terms, np.array(rows, dtype=np.float32).reshape(len(rows), dimension), len(lines) - len(rows)
+
+
+def read_chunks(lines: Iterable[str], chunk_lines: int) -> Iterator[List[str]]:
+    """Group lines into lists of up to `chunk_lines`, leaving out blank ones."""
+    lines = iter(lines)
+    while True:
+        chunk = list(itertools.islice(lines, chunk_lines))
+        if not chunk:
+            return
+        chunk = [line for line in chunk if line.strip()]
+        if chunk:
+            yield chunk
+
+
+def ingest(source: str, directory: str, chunk_lines: int = 20000, progress: bool = False) -> int:
+    """
+    Convert a GloVe (or word2vec text) file into a store in `directory`.
+
+    The dimension comes from the first line: a word2vec "count dimension"
+    header, or the number of fields after the first term. The store is
+    built next to `directory` and moved into place when complete, replacing
+    any store already there. Returns the number of terms stored.
+    """
+    building = f"{directory.rstrip(os.sep)}.building-{os.getpid()}"
+    shutil.rmtree(building, ignore_errors=True)
+    os.makedirs(building)
+    count = dropped = 0
+    hashes = []
+    term_offset = 0
+    with open(source, encoding='utf-8', errors='replace') as f, \
+            open(os.path.join(building, 'vectors.f32'), 'wb') as vectors_file, \
+            open(os.path.join(building, 'terms.bin'), 'wb') as terms_file, \
+            open(os.path.join(building, 'terms.offsets'), 'wb') as offsets_file, \
+            tqdm.tqdm(total=os.path.getsize(source), unit='B', unit_scale=True, disable=not progress) as bar:
+        first = f.readline()
+        fields = first.split()
+        if len(fields) == 2 and all(field.isdigit() for field in fields):
+            dimension = int(fields[1])
+            lines = f
+        else:
+            dimension = len(fields) - 1
+            lines = itertools.chain([first], f)
+        offsets_file.write(np.array([0], dtype='<i8').tobytes())
+        for lines in read_chunks(lines, chunk_lines):
+            terms, vectors, chunk_dropped = parse_chunk(lines, dimension)
+            dropped += chunk_dropped
+            vectors_file.write(vectors.astype('<f4').tobytes())
+            encoded = [term.encode('utf-8') for term in terms]
+            terms_file.write(b''.join(encoded))
+            offsets = term_offset + np.cumsum([len(term) for term in encoded], dtype=np.int64)
+            if len(offsets):
+                term_offset = int(offsets[-1])
+            offsets_file.write(offsets.astype('<i8').tobytes())
+            hashes.append(term_hashes(terms))
+            count += len(terms)
+            bar.update(sum(len(line) for line in lines))
+
+    hashes = np.concatenate(hashes) if hashes else np.empty(0, dtype=np.uint64)
+    # A stable sort keeps repeated terms in file order, so np.unique's first index is the first copy
+    order = np.argsort(hashes, kind='stable')
+    unique_hashes, first = np.unique(hashes[order], return_index=True)
+    rows = order[first].astype('<i8')
+    if len(unique_hashes) < count:
+        _check_repeats(building, hashes, order, first, count)
+    unique_hashes.astype('<u8').tofile(os.path.join(building, 'index.hashes'))
+    rows.tofile(os.path.join(building, 'index.rows'))
+    with open(os.path.join(building, 'store.json'), 'w') as f:
+        json.dump({'dimension': dimension, 'count': count, 'terms': len(rows), 'dtype': '<f4',
+                   'source': os.path.abspath(source), 'dropped_lines': dropped}, f)
+    shutil.rmtree(directory, ignore_errors=True)
+    os.replace(building, directory)
+    return len(rows)
+
+
+def _check_repeats(building: str, hashes: np.ndarray, order: np.ndarray, first: np.ndarray, count: int) -> None:
+    """Terms sharing a hash must be repeats of one term; two different terms with one hash cannot be indexed."""
+    offsets = np.fromfile(os.path.join(building, 'terms.offsets'), dtype='<i8')
+    terms = np.memmap(os.path.join(building, 'terms.bin'), dtype=np.uint8, mode='r') if offsets[-1] else b''
+    group_starts = np.append(first, count)
+    for start, stop in zip(group_starts[:-1], group_starts[1:]):
+        if stop - start < 2:
+            continue
+        rows = order[start:stop]
+        spelled = {bytes(terms[offsets[row]:offsets[row + 1]]) for row in rows}
+        if len(spelled) > 1:
+            raise ValueError(f"Hash collision between {sorted(spelled)}")
+
+
+class GloveLookup:
+    def __init__(self, directory: str, cache_size: int = 65536):
+        """
+        Look up vectors in a store made by ingest().
+
+        The whole store is memory-mapped. The last `cache_size` vectors looked
+        up are also kept in an LRU cache, so a working set of words stays in
+        memory however large the store is.
+
+        Args:
+            directory (str): The store's directory
+            cache_size (int): Vectors kept in the LRU cache (0 for none)
+        """
+        with open(os.path.join(directory, 'store.json')) as f:
+            self.metadata = json.load(f)
+        self.directory = directory
+        self.dimension = self.metadata['dimension']
+        self.count = self.metadata['count']
+        self.vectors = np.memmap(os.path.join(directory, 'vectors.f32'), dtype='<f4', mode='r',
+                                 shape=(self.count, self.dimension))
+        self.offsets = np.fromfile(os.path.join(directory, 'terms.offsets'), dtype='<i8')
+        self.terms_blob = np.memmap(os.path.join(directory, 'terms.bin'), dtype=np.uint8, mode='r') \
+            if self.offsets[-1] else np.empty(0, dtype=np.uint8)
+        self.hashes = np.fromfile(os.path.join(directory, 'index.hashes'), dtype='<u8')
+        self.index_rows = np.fromfile(os.path.join(directory, 'index.rows'), dtype='<i8')
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self.hashes)
+
+    def term(self, row: int) -> str:
+        return bytes(self.terms_blob[self.offsets[row]:self.offsets[row + 1]]).decode('utf-8')
+
+    def iter_terms(self) -> Iterator[str]:
+        """Every stored term, in file order (a repeated term appears each time it was in the file)."""
+        for row in range(self.count):
+            yield self.term(row)
+
+    def rows(self, terms: Sequence[str]) -> np.ndarray:
+        """The row of each term in the matrix, -1 for terms that are not stored."""
+        wanted = term_hashes(terms)
+        positions = np.minimum(np.searchsorted(self.hashes, wanted), max(len(self.hashes) - 1, 0))
+        rows = np.full(len(terms), -1, dtype=np.int64)
+        if len(self.hashes) == 0:
+            return rows
+        matched = self.hashes[positions] == wanted
+        for i in np.flatnonzero(matched):
+            # Checking the spelling rules out a 64-bit hash collision with a word that is not stored
+            row = self.index_rows[positions[i]]
+            if self.term(row) == terms[i]:
+                rows[i] = row
+        return rows
+
+    def __contains__(self, term: str) -> bool:
+        return self.rows([term])[0] >= 0
+
+    def lookup_many(self, terms: Sequence[str]) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Vectors for many terms at once.
+
+        Terms in the LRU cache come from there; all the others are read with
+        one fancy-indexing pass over the memory-mapped matrix, in row order.
+
+        Returns:
+            tuple: (found, vectors), a mask over `terms` and a float32 matrix
+            with one row per term found, in the order of `terms`
+        """
+        terms = list(terms)
+        vectors = np.empty((len(terms), self.dimension), dtype=np.float32)
+        found = np.zeros(len(terms), dtype=bool)
+        uncached = []
+        for i, term in enumerate(terms):
+            vector = self.cache.get(term)
+            if vector is None:
+                uncached.append(i)
+                continue
+            self.cache.move_to_end(term)
+            vectors[i] = vector
+            found[i] = True
+        self.hits += len(terms) - len(uncached)
+        self.misses += len(uncached)
+        if uncached:
+            rows = self.rows([terms[i] for i in uncached])
+            present = rows >= 0
+            indices = np.array(uncached)[present]
+            order = np.argsort(rows[present])
+            read = np.empty((len(indices), self.dimension), dtype=np.float32)
+            read[order] = self.vectors[rows[present][order]]
+            vectors[indices] = read
+            found[indices] = True
+            if self.cache_size:
+                for i in indices[-self.cache_size:]:
+                    self.cache[terms[i]] = vectors[i].copy()
+                while len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+        return found, vectors[found]
+
+    def lookup(self, term: str) -> np.ndarray:
+        found, vectors = self.lookup_many([term])
+        if not found[0]:
+            raise KeyError(f"Term '{term}' not found in the database.")
+        return vectors[0]
+
+    # The interface of the GloveLookup in archive/wordnet_vocab.py
+
+    def lookup_synset(self, synset_name: str) -> np.ndarray:
+        return self.lookup(synset_name.split('.')[0])
+
+    def dump_as_glove(self, synset_name: str) -> str:
+        vector = self.lookup_synset(synset_name)
+        return f"{synset_name.split('.')[0]} " + ' '.join(map(str, vector))
+
+
+def export(lookup: GloveLookup, conn: sqlite3.Connection, provider: str, genders: List[str],
+           words: Optional[List[str]], batch_size: int = 10000) -> Tuple[int, int]:
+    """
+    Write vectors into {provider}_embeddings, the same vector for every gender.
+
+    With words=None every stored term is exported. Returns (exported, missing).
+    """
+    table = f"{provider}_embeddings"
+    create_embedding_table(conn, provider)
+    set_table_format(conn, table, lookup.dimension)
+    if words is None:
+        rows = lookup.index_rows[np.argsort(lookup.index_rows)]
+        words = [lookup.term(row) for row in rows]
+    exported = missing = 0
+    for start in range(0, len(words), batch_size):
+        batch = words[start:start + batch_size]
+        found, vectors = lookup.lookup_many(batch)
+        present = [word for word, ok in zip(batch, found) if ok]
+        with conn:
+            conn.executemany(f'INSERT OR REPLACE INTO {table} (adjective, gender, embedding) VALUES (?, ?, ?)',
+                             [(word, gender, encode_embedding(vector)) for gender in genders
+                              for word, vector in zip(present, vectors)])
+        exported += len(present)
+        missing += len(batch) - len(present)
+    return exported, missing
+
+
+def ingest_command(args: argparse.Namespace) -> None:
+    terms = ingest(args.source, args.directory, args.chunk_lines, args.progress_bar)
+    with open(os.path.join(args.directory, 'store.json')) as f:
+        metadata = json.load(f)
+    print(f"Stored {terms} terms of dimension {metadata['dimension']} in {args.directory}"
+          + (f" ({metadata['dropped_lines']} malformed lines skipped)" if metadata['dropped_lines'] else ''))
+
+
+def lookup_command(args: argparse.Namespace) -> None:
+    lookup = GloveLookup(args.directory)
+    for term in args.terms:
+        try:
+            vector = lookup.lookup(term)
+        except KeyError as e:
+            print(e.args[0])
+            continue
+        print(f"{term} " + ' '.join(f"{value:.5f}" for value in vector[:args.show]) + (' ...' if args.show < len(vector) else ''))
+
+
+def export_command(args: argparse.Namespace) -> None:
+    lookup = GloveLookup(args.directory)
+    conn = sqlite3.connect(args.database)
+    words = None
+    if not args.all:
+        words = [row[0] for row in conn.execute(
+            'SELECT adjective FROM adjective_analysis where he_is_personality or she_is_personality')]
+    exported, missing = export(lookup, conn, args.embedding_provider, args.genders, words)
+    print(f"Exported {exported} words to {args.embedding_provider}_embeddings"
+          + (f"; {missing} are not in {args.directory}" if missing else ''))
+    conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Ingest and query static word embeddings.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    ingest_parser = subparsers.add_parser('ingest', help='Convert a GloVe or word2vec text file into a store')
+    ingest_parser.add_argument('source')
+    ingest_parser.add_argument('directory')
+    ingest_parser.add_argument('--chunk-lines', type=int, default=20000)
+    ingest_parser.add_argument('--progress-bar', action='store_true')
+    ingest_parser.set_defaults(func=ingest_command)
+    lookup_parser = subparsers.add_parser('lookup', help='Print the vectors of some terms')
+    lookup_parser.add_argument('directory')
+    lookup_parser.add_argument('terms', nargs='+')
+    lookup_parser.add_argument('--show', type=int, default=8, help='Components to print')
+    lookup_parser.set_defaults(func=lookup_command)
+    export_parser = subparsers.add_parser(
+        'export', help='Copy vectors into a {provider}_embeddings table for language_plane_finder.py')
+    export_parser.add_argument('directory')
+    export_parser.add_argument('--database', default='personality_adjectives.sqlite')
+    export_parser.add_argument('--embedding-provider', default='glove')
+    export_parser.add_argument('--genders', nargs='+', default=['male', 'female'],
+                               help='Static embeddings have no gender, so the same vectors go in for each')
+    export_parser.add_argument('--all', action='store_true',
+                               help='Export every stored term, not just the personality adjectives')
+    export_parser.set_defaults(func=export_command)
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+
+import contextlib
+import json
+import sys
+import time
+from collections import defaultdict
+from typing import Dict, Iterator, Optional, TextIO
+
+
+class Metrics:
+    def __init__(self, stream: Optional[TextIO] = None, interval: float = 60.0):
+        """
+        Per-stage timers and counters for a long-running loop.
+
+        Time spent inside each `with metrics.stage(name)` block is added to
+        that stage; count() bumps named counters. Every `interval` seconds
+        maybe_emit() writes one JSON line with the totals and the rates since
+        the previous line to `stream` (stderr by default).
+
+        Args:
+            stream (file): Where the JSON lines go
+            interval (float): Seconds between JSON lines
+        """
+        self.stream = stream if stream is not None else sys.stderr
+        self.interval = interval
+        self.seconds = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.counters = defaultdict(int)
+        self.started = time.perf_counter()
+        self.last_emit = self.started
+        self.last_counters = {}
+
+    @contextlib.contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[name] += time.perf_counter() - start
+            self.calls[name] += 1
+
+    def count(self, name: str, n: int = 1) -> None:
+        self.counters[name] += int(n)
+
+    def take(self) -> Dict[str, Dict[str, float]]:
+        """Everything recorded so far, resetting it; for a worker to send to the process that reports."""
+        delta = {'seconds': dict(self.seconds), 'calls': dict(self.calls), 'counters': dict(self.counters)}
+        self.seconds.clear()
+        self.calls.clear()
+        self.counters.clear()
+        return delta
+
+    def merge(self, delta: Dict[str, Dict[str, float]]) -> None:
+        """Add what another Metrics take() returned, e.g. from a worker process."""
+        for name, seconds in delta['seconds'].items():
+            self.seconds[name] += seconds
+        for name, calls in delta['calls'].items():
+            self.calls[name] += calls
+        for name, n in delta['counters'].items():
+            self.counters[name] += n
+
+    def record(self, event: str = 'progress') -> Dict:
+        """The JSON line as a dict: totals, per-stage times, and rates since the last line."""
+        now = time.perf_counter()
+        elapsed = now - self.started
+        since = now - self.last_emit
+        evaluated = self.counters.get('triples_evaluated', 0)
+        rejected = self.counters.get('duplicates_rejected', 0)
+        recent = evaluated - self.last_counters.get('triples_evaluated', 0)
+        return {
+            'event': event,
+            'time': time.time(),
+            'elapsed_seconds': round(elapsed, 3),
+            'triples_per_second': round(evaluated / elapsed, 2) if elapsed else None,
+            'recent_triples_per_second': round(recent / since, 2) if since else None,
+            'duplicate_rejection_rate': round(rejected / (rejected + evaluated), 4) if rejected + evaluated else None,
+            'counters': dict(self.counters),
+            'stages': {name: {'seconds': round(seconds, 4), 'calls': self.calls[name],
+                              'share': round(seconds / elapsed, 4) if elapsed else None}
+                       for name, seconds in sorted(self.seconds.items())},
+        }
+
+    def emit(self, event: str = 'progress') -> None:
+        self.stream.write(json.dumps(self.record(event)) + '\n')
+        self.stream.flush()
+        self.last_emit = time.perf_counter()
+        self.last_counters = dict(self.counters)
+
+    def maybe_emit(self) -> None:
+        if time.perf_counter() - self.last_emit >= self.interval:
+            self.emit()
+
+    def summary(self) -> str:
+        """A human-readable table of the same numbers, for the end of a run."""
+        record = self.record('summary')
+        lines = [f"{record['elapsed_seconds']:.1f} s, {record['triples_per_second'] or 0:.1f} triples/s, "
+                 f"duplicate rejection rate {record['duplicate_rejection_rate'] or 0:.2%}"]
+        for name, n in sorted(record['counters'].items()):
+            lines.append(f"  {name:24s} {n:12d}")
+        for name, stage in sorted(record['stages'].items(), key=lambda item: -item[1]['seconds']):
+            lines.append(f"  {name:24s} {stage['seconds']:10.2f} s {stage['share'] or 0:7.1%} "
+                         f"{stage['calls']:10d} calls")
+        return '\n'.join(lines)
@@ -1,133 +1,1139 @@
 #!/usr/bin/env python3
 
 import argparse
+import contextlib
+import cProfile
+import functools
+import heapq
+import itertools
+import os
 import random
+import sys
 import sqlite3
-import json
-import os
+import time
+import multiprocessing
+from multiprocessing import shared_memory
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
 import numpy as np
-import pandas as pd
-import matplotlib.pyplot
 import tqdm
-from plane import Plane
-
-parser = argparse.ArgumentParser()
-parser.add_argument("--database", default='personality_adjectives.sqlite')
-parser.add_argument("--embedding-provider", default='openai')
-parser.add_argument("--gender", default='male')
-parser.add_argument("--random-seed", type=int)
-parser.add_argument("--stop-after", type=int)
-parser.add_argument("--output-directory")
-parser.add_argument("--progress-bar", action="store_true")
-parser.add_argument("--fitter", action="store_true")
-args = parser.parse_args()
-
-conn = sqlite3.connect(args.database)
-cursor = conn.cursor()
-table = f"{args.embedding_provider}_embeddings"
-cursor.execute(f"select adjective, embedding from {table} where gender = ?", [args.gender])
-adjective_lookup = {}
-for adjective, embedding_as_json in cursor:
-    embedding_as_list = json.loads(embedding_as_json)
-    embedding_as_numpy_array = np.array(embedding_as_list)
-    adjective_lookup[adjective] = embedding_as_numpy_array
-
-cursor.execute("""create table if not exists planar_statistics (
-  adjective1 text,
-  adjective2 text,
-  adjective3 text,
-  gender text,
-  embedding_provider text,
-  closest_adjective text,
-  how_close float,
-  mean_distance float,
-  stddev_distance float,
-  mili float,
-  percentile1 float,
-  percentile25 float,
-  percentile50 float,
-  percentile75 float,
-  percentile99 float,
-  furthest float,
-  primary key (adjective1, adjective2, adjective3, gender, embedding_provider)
-)""")
-
-
-  
-
-vocab = list(adjective_lookup.keys())
-
-if args.random_seed:
-    random.seed(args.random_seed)
-
-triples_processed = 0
-
-while True:
-    if args.stop_after and triples_processed >= args.stop_after:
-        break
-    word1, word2, word3 = sorted(random.sample(vocab, 3))
-    print(f"{word1}, {word2}, {word3}")
-    cursor.execute("""select count(*) from planar_statistics where
-      adjective1 = ? and adjective2 = ? and adjective3 = ?
-      and gender = ? and embedding_provider = ?""",
-                   [word1, word2, word3, args.gender, args.embedding_provider])
-    row = cursor.fetchone()
-    if row[0] > 0:
-        print(" -- already in the database")
-        continue
-    point1 = adjective_lookup[word1]
-    point2 = adjective_lookup[word2]
-    point3 = adjective_lookup[word3]
+from artefacts import ArtefactPipeline
+from distancestore import STORE_DTYPES, DistanceStore, store_directory
+from embeddingstore import cached_embedding_matrix, load_embedding_matrix
+from instrumentation import Metrics
+from plane import PlaneBatch, triple_distances
+from planegram import ENGINES, GramEngine, cached_gram, choose_engine, compute_gram
+from planesearch import SEARCH_OBJECTIVES, BeamSearch
+from planestats import batch_statistics
+from sketches import (PlaneSketches, Summary, create_sketch_table, load_sketches, rebuild_column_summaries,
+                      save_sketches)
+from triples import (CompletedTriples, TripleScheduler, create_checkpoint_table, load_checkpoint, pack_triples,
+                     save_checkpoint, vocab_fingerprint)
+from vocabulary import (VocabularyChange, create_vocabulary_table, latest_vocabulary, load_vocabulary,
+                        register_vocabulary, stale_counts)
+
+
+def parse_target(text: str) -> Tuple[str, str]:
+    """Parse provider:gender, e.g. openai:female."""
+    provider, _, gender = text.partition(':')
+    if not provider or not gender:
+        raise argparse.ArgumentTypeError(f"Invalid embeddings {text}. Must be provider:gender, e.g. openai:male.")
+    return provider, gender
+
+
+def parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--database", default='personality_adjectives.sqlite')
+    parser.add_argument("--embedding-provider", default='openai')
+    parser.add_argument("--gender", default='male')
+    parser.add_argument("--random-seed", type=int)
+    parser.add_argument("--stop-after", type=int)
+    parser.add_argument("--output-directory")
+    parser.add_argument("--progress-bar", action="store_true")
+    parser.add_argument("--fitter", action="store_true")
+    parser.add_argument("--batch-size", type=int, default=256,
+                        help="How many triples to evaluate together in one matrix pass")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of search processes; the main process only writes to the database")
+    parser.add_argument("--embedding-cache",
+                        help="Directory of memory-mapped embedding matrices, rebuilt when the table changes")
+    parser.add_argument("--schedule", choices=["random", "enumerate", "beam"], default="random",
+                        help="Sample triples at random, enumerate every triple once in a seeded "
+                        "random order that resumes where the last run stopped, or beam-search for the "
+                        "lowest --objective")
+    parser.add_argument("--anchor", help="Only enumerate triples containing this word (implies --schedule enumerate)")
+    parser.add_argument("--objective", choices=SEARCH_OBJECTIVES, default="mean_distance",
+                        help="Column the beam search minimises, and the one compare reports on")
+    parser.add_argument("--beam-width", type=int, default=16)
+    parser.add_argument("--swap-candidates", type=int, default=24,
+                        help="Words nearest a beam triple's plane tried in place of each of its words")
+    parser.add_argument("--keep", type=int, default=1000,
+                        help="The beam search only writes triples that are among the best this many")
+    parser.add_argument("--commit-every", type=int, default=1000,
+                        help="Commit after this many new rows")
+    parser.add_argument("--commit-seconds", type=float, default=30,
+                        help="Commit at least this often while rows are waiting")
+    parser.add_argument("--dtype", choices=["float64", "float32"], default="float64",
+                        help="Precision of the distance computations; float32 halves the memory traffic, "
+                        "and nearly collinear triples are still done in float64")
+    parser.add_argument("--engine", choices=ENGINES, default="auto",
+                        help="Compute distances from the embeddings directly, or from the vocabulary's Gram matrix "
+                        "(always float64); auto uses the Gram matrix when it fits in --gram-memory-mb and the "
+                        "embeddings are wide enough for it to pay")
+    parser.add_argument("--gram-memory-mb", type=float, default=1024,
+                        help="Largest Gram matrix to keep in memory")
+    parser.add_argument("--artefact-workers", type=int, default=2,
+                        help="Processes making the --output-directory plots and --fitter fits in the "
+                        "background (0 makes them inline)")
+    parser.add_argument("--artefact-queue", type=int, default=64,
+                        help="Planes waiting for artefacts before the search waits for them")
+    parser.add_argument("--distance-store",
+                        help="Directory in which to keep every plane's full distance vector (one store per "
+                        "provider, gender and vocabulary); render and refresh read from it")
+    parser.add_argument("--distance-store-dtype", choices=STORE_DTYPES, default="float32",
+                        help="float16 halves the store, but refresh cannot carry its vectors over")
+    parser.add_argument("--metrics", help="Append the periodic JSON metrics lines to this file instead of stderr")
+    parser.add_argument("--metrics-interval", type=float, default=60,
+                        help="Seconds between JSON metrics lines")
+    parser.add_argument("--profile", action="store_true",
+                        help="Run under cProfile and save the statistics next to the results "
+                        "(worker processes are not profiled)")
+    subparsers = parser.add_subparsers(dest="command")
+    render_parser = subparsers.add_parser(
+        "render", help="Make the plots and fits for planes already in planar_statistics, without searching")
+    render_parser.add_argument("--triple", action="append", default=[],
+                               help="word1,word2,word3 to render (may be repeated)")
+    render_parser.add_argument("--order", choices=["how_close", "random"], default="how_close",
+                               help="Which stored planes to render when no --triple is given")
+    render_parser.add_argument("--limit", type=int, default=100)
+    refresh_parser = subparsers.add_parser(
+        "refresh", help="Bring planes computed against an older vocabulary up to date with the current one")
+    refresh_parser.add_argument("--adopt", action="store_true",
+                                help="Take rows that predate vocabulary tracking to be current instead of "
+                                "recomputing them")
+    refresh_parser.add_argument("--dry-run", action="store_true", help="Only report what is out of date")
+    compare_parser = subparsers.add_parser(
+        "compare", help="Evaluate the same triples against several providers and genders in one pass, so that "
+        "their rows can be paired up in the paired_statistics view")
+    compare_parser.add_argument("--embeddings", type=parse_target, nargs="+",
+                                default=[("openai", "male"), ("openai", "female"),
+                                         ("ollama", "male"), ("ollama", "female")],
+                                help="provider:gender pairs to compare (all four by default)")
+    args = parser.parse_args()
+    if args.anchor:
+        args.schedule = "enumerate"
+    if args.workers > 1 and (args.output_directory or args.fitter):
+        parser.error("--output-directory and --fitter need --workers 1")
+    if args.workers > 1 and args.schedule == "beam":
+        parser.error("--schedule beam runs in a single process")
+    if args.command == "render" and not (args.output_directory or args.fitter):
+        parser.error("render needs --output-directory and/or --fitter")
+    if args.command == "refresh" and (args.output_directory or args.fitter):
+        parser.error("refresh makes no plots or fits; leave out --output-directory and --fitter")
+    if args.command == "compare":
+        if args.workers > 1 or args.schedule == "beam" or args.output_directory or args.fitter:
+            parser.error("compare runs in a single process with --schedule random or enumerate, without artefacts")
+        if len(set(args.embeddings)) < 2:
+            parser.error("compare needs at least two different --embeddings")
+    return args
+
+
+def load_embeddings(conn: sqlite3.Connection, embedding_provider: str, gender: str,
+                    cache_directory: Optional[str] = None, dtype=np.float64) -> Tuple[List[str], np.ndarray]:
+    """Read one (provider, gender) table into a vocabulary list and an (N, d) matrix."""
+    table = f"{embedding_provider}_embeddings"
+    if cache_directory:
+        return cached_embedding_matrix(conn, table, gender, cache_directory, dtype)
+    return load_embedding_matrix(conn, table, gender, dtype)
+
+
+def squared_norms(embedding_matrix: np.ndarray) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    """Squared row norms in the matrix's precision and, for reduced precision, in float64 too."""
+    row_norms = np.einsum('ij,ij->i', embedding_matrix, embedding_matrix)
+    float64_row_norms = None
+    if embedding_matrix.dtype != np.float64:
+        float64_row_norms = np.einsum('ij,ij->i', embedding_matrix, embedding_matrix, dtype=np.float64)
+    return row_norms, float64_row_norms
+
+
+def create_statistics_table(cursor: sqlite3.Cursor) -> None:
+    cursor.execute("""create table if not exists planar_statistics (
+      adjective1 text,
+      adjective2 text,
+      adjective3 text,
+      gender text,
+      embedding_provider text,
+      closest_adjective text,
+      how_close float,
+      mean_distance float,
+      stddev_distance float,
+      mili float,
+      percentile1 float,
+      percentile25 float,
+      percentile50 float,
+      percentile75 float,
+      percentile99 float,
+      furthest float,
+      vocabulary text,
+      primary key (adjective1, adjective2, adjective3, gender, embedding_provider)
+    )""")
+    columns = [row[1] for row in cursor.execute("pragma table_info(planar_statistics)").fetchall()]
+    if 'vocabulary' not in columns:
+        # Rows written before vocabularies were recorded are left NULL; refresh deals with them
+        cursor.execute("alter table planar_statistics add column vocabulary text")
+
+
+def statistics_row(args: argparse.Namespace, triple: Tuple[str, str, str], closest_adjective: str,
+                   stats: Dict[str, np.ndarray], k: int, vocabulary: str) -> list:
+    """The planar_statistics row for entry k of a batch_statistics result, computed against `vocabulary`."""
+    word1, word2, word3 = sorted(triple)
+    return [word1, word2, word3, args.gender, args.embedding_provider,
+            closest_adjective, stats['how_close'][k],
+            stats['mean_distance'][k], stats['stddev_distance'][k],
+            stats['mili'][k], stats['percentile1'][k], stats['percentile25'][k],
+            stats['percentile50'][k], stats['percentile75'][k],
+            stats['percentile99'][k], stats['furthest'][k], vocabulary]
+
+
+class StatisticsWriter:
+    def __init__(self, conn: sqlite3.Connection, commit_every: int, commit_seconds: float):
+        """
+        Buffer planar_statistics rows and write them with executemany.
+
+        The buffer is written and committed once it holds `commit_every` rows
+        or `commit_seconds` have passed since the last commit, so a crash
+        loses at most one buffer's worth of work. If `checkpoint` is set to
+        (key, next_position), it is saved in the same transaction, and so are
+        `sketches` if set to a list of (gender, provider, PlaneSketches).
+        Commits are timed and counted in `metrics` if it is set.
+        """
+        self.conn = conn
+        self.commit_every = commit_every
+        self.commit_seconds = commit_seconds
+        self.rows = []
+        self.checkpoint = None
+        self.sketches = None
+        self.metrics = None
+        self.last_commit = time.monotonic()
+
+    def add(self, row: list) -> None:
+        self.rows.append(row)
+        if (len(self.rows) >= self.commit_every
+                or time.monotonic() - self.last_commit >= self.commit_seconds):
+            self.flush()
+
+    def flush(self) -> None:
+        if self.rows or self.checkpoint or self.sketches:
+            with self.metrics.stage('sqlite_commit') if self.metrics else contextlib.nullcontext(), self.conn:
+                if self.checkpoint:
+                    save_checkpoint(self.conn.cursor(), *self.checkpoint)
+                for sketches in self.sketches or []:
+                    save_sketches(self.conn.cursor(), *sketches)
+                self.conn.executemany("""insert or ignore into planar_statistics (
+                   adjective1, adjective2, adjective3, gender, embedding_provider,
+                   closest_adjective, how_close, mean_distance, stddev_distance,
+                   mili, percentile1, percentile25, percentile50, percentile75,
+                   percentile99, furthest, vocabulary) values (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)""", self.rows)
+            if self.metrics:
+                self.metrics.count('rows_written', len(self.rows))
+            self.rows = []
+        self.last_commit = time.monotonic()
+
+
+def random_triples(vocab: List[str], vocab_index: Dict[str, int], completed: CompletedTriples,
+                   wanted: int, metrics: Optional[Metrics] = None) -> np.ndarray:
+    """Sample `wanted` triples not yet in `completed`, the way the finder always has."""
+    triples = []
+    while len(triples) < wanted:
+        word1, word2, word3 = sorted(random.sample(vocab, 3))
+        print(f"{word1}, {word2}, {word3}")
+        triple_index = (vocab_index[word1], vocab_index[word2], vocab_index[word3])
+        if triple_index in completed:
+            print(" -- already in the database")
+            if metrics:
+                metrics.count('duplicates_rejected')
+            continue
+        completed.add(triple_index)
+        triples.append(triple_index)
+    return np.array(triples)
+
+
+def unseen_triples(scheduler: TripleScheduler, start: int, stop: int, completed: CompletedTriples,
+                   metrics: Optional[Metrics] = None) -> np.ndarray:
+    """The scheduled triples at positions start .. stop-1 that are not in `completed`."""
+    candidates = scheduler.triples(start, stop)
+    keep = np.array([tuple(triple) not in completed for triple in candidates], dtype=bool)
+    if metrics:
+        metrics.count('duplicates_rejected', len(keep) - np.count_nonzero(keep))
+    return candidates[keep].reshape(-1, 3)
+
+
+def schedule_key(args: argparse.Namespace, vocab: List[str]) -> Tuple[str, str, int, str, str]:
+    return (args.gender, args.embedding_provider, args.random_seed or 0, args.anchor or '',
+            vocab_fingerprint(vocab))
+
+
+def make_scheduler(args: argparse.Namespace, vocab: List[str]) -> TripleScheduler:
+    anchor = None
+    if args.anchor:
+        if args.anchor not in vocab:
+            raise SystemExit(f"{args.anchor} is not in the {args.embedding_provider} {args.gender} vocabulary")
+        anchor = vocab.index(args.anchor)
+    return TripleScheduler(len(vocab), args.random_seed or 0, anchor)
+
+
+def load_gram(args: argparse.Namespace, conn: sqlite3.Connection, vocab: List[str],
+              embedding_matrix: np.ndarray) -> Optional[np.ndarray]:
+    """
+    The Gram matrix of the embeddings if --engine picks it (kept in the embedding cache if there is one).
+
+    `vocab` names the matrix's rows, which need not be the table's own order (see compare).
+    """
     try:
-        plane = Plane(point1, point2, point3)
-    except ValueError:
-        print(f"Error: Cannot form a valid plane with points {word1}, {word2}, and {word3}")
-        continue
-    triples_processed += 1
-    distances = []
-    distance_vocab = []
+        engine = choose_engine(args.engine, *embedding_matrix.shape, args.gram_memory_mb)
+    except ValueError as e:
+        raise SystemExit(str(e))
+    if engine == 'direct':
+        return None
+    print(f"Measuring distances from the {len(embedding_matrix)} x {len(embedding_matrix)} Gram matrix",
+          file=sys.stderr)
+    if args.embedding_cache:
+        return cached_gram(conn, f"{args.embedding_provider}_embeddings", args.gender, args.embedding_cache,
+                           embedding_matrix, vocab_fingerprint(vocab))
+    return compute_gram(embedding_matrix)
+
+
+def distance_function(embedding_matrix: np.ndarray,
+                      gram: Optional[np.ndarray]) -> Callable[[np.ndarray], Tuple[np.ndarray, np.ndarray]]:
+    """triples -> (valid, distances), through the Gram matrix if there is one and triple_distances otherwise."""
+    if gram is not None:
+        return GramEngine(embedding_matrix, gram).triple_distances
+    row_norms, float64_row_norms = squared_norms(embedding_matrix)
+    return lambda triples: triple_distances(embedding_matrix, triples, row_norms, float64_row_norms)
+
+
+def run_single_process(args: argparse.Namespace, conn: sqlite3.Connection, writer: StatisticsWriter,
+                       vocab: List[str], embedding_matrix: np.ndarray, gram: Optional[np.ndarray],
+                       sketches: PlaneSketches, artefacts: Optional[ArtefactPipeline],
+                       store: Optional[DistanceStore], metrics: Metrics) -> None:
+    cursor = conn.cursor()
+    vocab_index = {word: i for i, word in enumerate(vocab)}
+    vocab_array = np.array(vocab, dtype=object)
+    vocabulary = vocab_fingerprint(vocab)
+    measure = distance_function(embedding_matrix, gram)
+    completed = CompletedTriples.from_database(cursor, args.gender, args.embedding_provider, vocab_index)
+
+    if args.schedule == "enumerate":
+        scheduler = make_scheduler(args, vocab)
+        key = schedule_key(args, vocab)
+        position = load_checkpoint(cursor, key)
+        print(f"Resuming the schedule at {position} of {scheduler.size}")
+    elif args.random_seed:
+        random.seed(args.random_seed)
+
+    triples_processed = 0
     if args.progress_bar:
-        iterator = tqdm.tqdm(vocab)
+        progress = tqdm.tqdm(total=args.stop_after)
+
+    while True:
+        if args.stop_after and triples_processed >= args.stop_after:
+            break
+        wanted = args.batch_size
+        if args.stop_after:
+            wanted = min(wanted, args.stop_after - triples_processed)
+        if args.schedule == "enumerate":
+            if position >= scheduler.size:
+                print("Every triple has been evaluated")
+                break
+            with metrics.stage('schedule'):
+                triple_indices = unseen_triples(scheduler, position, position + wanted, completed, metrics)
+            position = min(position + wanted, scheduler.size)
+            if len(triple_indices) == 0:
+                writer.checkpoint = (key, position)
+                continue
+        else:
+            with metrics.stage('schedule'):
+                triple_indices = random_triples(vocab, vocab_index, completed, wanted, metrics)
+        with metrics.stage('distances'):
+            valid, all_distances = measure(triple_indices)
+        with metrics.stage('statistics'):
+            stats = batch_statistics(all_distances)
+        with metrics.stage('sketches'):
+            sketches.add_distances(all_distances[valid])
+            sketches.add_statistics(stats, valid)
+        if store is not None:
+            with metrics.stage('distance_store'):
+                store.append(triple_indices[valid], all_distances[valid])
+        metrics.count('triples_evaluated', np.count_nonzero(valid))
+        metrics.count('collinear_skipped', len(valid) - np.count_nonzero(valid))
+        for k, triple in enumerate(triple_indices):
+            word1, word2, word3 = vocab_array[triple]
+            if not valid[k]:
+                print(f"Error: Cannot form a valid plane with points {word1}, {word2}, and {word3}")
+                continue
+            triples_processed += 1
+            if args.progress_bar:
+                progress.update(1)
+            closest_adjective = vocab_array[stats['closest_index'][k]]
+            print(word1, word2, word3)
+            print(f"{closest_adjective=}, {stats['how_close'][k]=}")
+            print(f"{stats['mean_distance'][k]=}, {stats['stddev_distance'][k]=}")
+            writer.add(statistics_row(args, (word1, word2, word3), closest_adjective, stats, k, vocabulary))
+            if artefacts is not None:
+                with metrics.stage('artefact_queue'):
+                    artefacts.submit((word1, word2, word3), all_distances[k])
+        if args.schedule == "enumerate":
+            # Only now: the writer can commit part way through the batch, and the saved position
+            # must never run ahead of the rows committed with it
+            writer.checkpoint = (key, position)
+        metrics.maybe_emit()
+
+
+def run_beam_search(args: argparse.Namespace, conn: sqlite3.Connection, writer: StatisticsWriter,
+                    vocab: List[str], embedding_matrix: np.ndarray, gram: Optional[np.ndarray],
+                    sketches: PlaneSketches, artefacts: Optional[ArtefactPipeline],
+                    store: Optional[DistanceStore], metrics: Metrics) -> None:
+    """
+    Search for the triples with the lowest --objective instead of sampling them.
+
+    The beam starts from the best triples already stored and from seeds along
+    the principal directions (see planesearch.py). A measured triple is only
+    written if it is among the best --keep found so far, stored ones
+    included. --stop-after limits the number of triples measured; otherwise
+    the search runs until it converges.
+    """
+    cursor = conn.cursor()
+    vocab_index = {word: i for i, word in enumerate(vocab)}
+    vocab_array = np.array(vocab, dtype=object)
+    vocabulary = vocab_fingerprint(vocab)
+    completed = CompletedTriples.from_database(cursor, args.gender, args.embedding_provider, vocab_index)
+    search = BeamSearch(embedding_matrix, args.objective, args.beam_width, args.swap_candidates,
+                        seed=args.random_seed or 0, distances=distance_function(embedding_matrix, gram))
+
+    cursor.execute(f"""select adjective1, adjective2, adjective3, {args.objective} from planar_statistics
+      where gender = ? and embedding_provider = ? order by {args.objective} limit ?""",
+                   [args.gender, args.embedding_provider, args.keep])
+    stored = [(score, tuple(sorted(vocab_index[word] for word in words))) for *words, score in cursor.fetchall()
+              if all(word in vocab_index for word in words)]
+    # The best --keep so far as a max-heap of (-score, triple)
+    kept = [(-score, triple) for score, triple in stored]
+    heapq.heapify(kept)
+    search.start(np.array([triple for _, triple in stored[:args.beam_width]], dtype=np.int64))
+
+    progress = tqdm.tqdm(total=args.stop_after, disable=not args.progress_bar)
+    while not (args.stop_after and search.evaluated >= args.stop_after):
+        with metrics.stage('beam_search'):
+            triple_indices, valid, all_distances, stats = search.step(args.batch_size)
+        if len(triple_indices) == 0:
+            print("The search has converged")
+            break
+        progress.update(len(triple_indices))
+        metrics.count('triples_evaluated', np.count_nonzero(valid))
+        metrics.count('collinear_skipped', len(valid) - np.count_nonzero(valid))
+        written = []
+        for k, triple in enumerate(map(tuple, triple_indices.tolist())):
+            score = stats[args.objective][k]
+            if not valid[k] or triple in completed or (len(kept) >= args.keep and score >= -kept[0][0]):
+                continue
+            if len(kept) >= args.keep:
+                heapq.heapreplace(kept, (-score, triple))
+            else:
+                heapq.heappush(kept, (-score, triple))
+            completed.add(triple)
+            written.append(k)
+            words = tuple(vocab_array[list(triple)])
+            writer.add(statistics_row(args, words, vocab[stats['closest_index'][k]], stats, k, vocabulary))
+            if artefacts is not None:
+                with metrics.stage('artefact_queue'):
+                    artefacts.submit(words, all_distances[k])
+        if written:
+            written = np.array(written)
+            with metrics.stage('sketches'):
+                sketches.add_distances(all_distances[written])
+                sketches.add_statistics(stats, written)
+            if store is not None:
+                with metrics.stage('distance_store'):
+                    store.append(triple_indices[written], all_distances[written])
+        metrics.maybe_emit()
+    progress.close()
+    metrics.count('pruned', search.pruned)
+    if search.best is not None:
+        score, triple = search.best
+        print(f"Best {args.objective} found: {score:.6f} for {', '.join(vocab[i] for i in triple)} "
+              f"({search.evaluated} triples measured, {search.pruned} ruled out by their bounds)")
+
+
+def attach_matrix(matrix_source: Tuple[Any, ...]) -> Tuple[np.ndarray, Optional[shared_memory.SharedMemory]]:
+    """
+    Open the embedding matrix described by `matrix_source` without copying it.
+
+    Either ('npy', path) for a memory-mapped cache file, or
+    ('shm', name, shape, dtype) for a shared memory block.
+    """
+    if matrix_source[0] == 'npy':
+        return np.load(matrix_source[1], mmap_mode='r'), None
+    _, name, shape, dtype = matrix_source
+    shm = shared_memory.SharedMemory(name=name)
+    return np.ndarray(shape, dtype=dtype, buffer=shm.buf), shm
+
+
+def search_worker(matrix_source: Tuple[Any, ...], gram_source: Optional[Tuple[Any, ...]], completed_packed: np.ndarray, worker_id: int, workers: int,
+                  batch_size: int, schedule: Tuple[int, Optional[int], int],
+                  store_dtype: Optional[str], results: multiprocessing.Queue, stop: multiprocessing.Event) -> None:
+    """
+    Evaluate batches of triples against the shared embedding matrix until told to stop.
+
+    With `schedule` = (seed, anchor, start), batch b covers schedule positions
+    start + b*batch_size onwards and this worker takes batches b = worker_id,
+    worker_id + workers, ... until the schedule runs out. The random schedule
+    is the same walk from position 0 of a permutation that is never
+    checkpointed, so the workers' slices are disjoint and follow --random-seed.
+
+    `gram_source` describes the Gram matrix in the same way, when the
+    distances are to come from it.
+
+    Each batch goes onto `results` as (b, triple_indices, valid, stats,
+    distance_summary, distances, metrics): a Summary of the batch's
+    distances and the worker's Metrics since its last batch, for the writer
+    to merge. `distances` is the batch's distance matrix in `store_dtype`
+    when there is a distance store (None otherwise), so that the writer can
+    store the rows it actually writes. A final None tells the writer that
+    this worker has finished.
+    """
+    embedding_matrix, shm = attach_matrix(matrix_source)
+    gram, gram_shm = attach_matrix(gram_source) if gram_source else (None, None)
+    metrics = Metrics()
+    measure = None
+    try:
+        measure = distance_function(embedding_matrix, gram)
+        completed = CompletedTriples(len(embedding_matrix), completed_packed)
+        seed, anchor, start = schedule
+        scheduler = TripleScheduler(len(embedding_matrix), seed, anchor)
+        batch_number = worker_id
+        while not stop.is_set():
+            batch_start = start + batch_number * batch_size
+            if batch_start >= scheduler.size:
+                break
+            with metrics.stage('schedule'):
+                triple_indices = unseen_triples(scheduler, batch_start, batch_start + batch_size, completed, metrics)
+            if len(triple_indices) == 0:
+                results.put((batch_number, triple_indices, np.zeros(0, dtype=bool), {}, Summary(), None,
+                             metrics.take()))
+            else:
+                with metrics.stage('distances'):
+                    valid, all_distances = measure(triple_indices)
+                with metrics.stage('statistics'):
+                    stats = batch_statistics(all_distances)
+                with metrics.stage('sketches'):
+                    distance_summary = Summary()
+                    distance_summary.update(all_distances[valid])
+                metrics.count('triples_evaluated', np.count_nonzero(valid))
+                metrics.count('collinear_skipped', len(valid) - np.count_nonzero(valid))
+                with metrics.stage('result_queue'):
+                    results.put((batch_number, triple_indices, valid, stats, distance_summary,
+                                 None if store_dtype is None else all_distances.astype(store_dtype),
+                                 metrics.take()))
+            batch_number += workers
+    finally:
+        del embedding_matrix, gram, measure
+        for block in (shm, gram_shm):
+            if block is not None:
+                block.close()
+        results.put(None)
+
+
+def share_matrix(matrix: np.ndarray) -> Tuple[Tuple[Any, ...], Optional[shared_memory.SharedMemory]]:
+    """A source for attach_matrix: the file of a memory-mapped matrix, or a shared memory copy of any other."""
+    if isinstance(matrix, np.memmap):
+        return ('npy', matrix.filename), None
+    shm = shared_memory.SharedMemory(create=True, size=matrix.nbytes)
+    shared_matrix = np.ndarray(matrix.shape, dtype=matrix.dtype, buffer=shm.buf)
+    shared_matrix[:] = matrix
+    del shared_matrix
+    return ('shm', shm.name, matrix.shape, matrix.dtype.str), shm
+
+
+def run_workers(args: argparse.Namespace, conn: sqlite3.Connection, writer: StatisticsWriter,
+                vocab: List[str], embedding_matrix: np.ndarray, gram: Optional[np.ndarray],
+                sketches: PlaneSketches, store: Optional[DistanceStore], metrics: Metrics) -> None:
+    """
+    Fan the search out over worker processes sharing one copy of the embeddings (and Gram matrix).
+
+    A memory-mapped cache file is simply mapped again by each worker; otherwise
+    the matrix is copied once into shared memory. This process keeps the only
+    SQLite connection and does all the writing.
+    """
+    cursor = conn.cursor()
+    vocab_index = {word: i for i, word in enumerate(vocab)}
+    vocabulary = vocab_fingerprint(vocab)
+    completed = CompletedTriples.from_database(cursor, args.gender, args.embedding_provider, vocab_index)
+    if args.schedule == "enumerate":
+        scheduler = make_scheduler(args, vocab)
+        key = schedule_key(args, vocab)
+        start = load_checkpoint(cursor, key)
+        print(f"Resuming the schedule at {start} of {scheduler.size}")
+        schedule = (scheduler.permutation_seed, scheduler.anchor, start)
+        # Batches finished so far; everything before `frontier` is done
+        finished_batches = set()
+        frontier = 0
     else:
-        iterator = vocab
-    for word in iterator:
-        if word in {word1, word2, word3}:
+        # Without --random-seed every run walks a different permutation
+        seed = args.random_seed if args.random_seed is not None else random.randrange(2**32)
+        schedule = (seed, None, 0)
+    blocks = []
+    processes = []
+    try:
+        matrix_source, shm = share_matrix(embedding_matrix)
+        blocks.append(shm)
+        gram_source = None
+        if gram is not None:
+            gram_source, shm = share_matrix(gram)
+            blocks.append(shm)
+        results = multiprocessing.Queue(maxsize=4 * args.workers)
+        stop = multiprocessing.Event()
+        for worker_id in range(args.workers):
+            process = multiprocessing.Process(
+                target=search_worker,
+                args=(matrix_source, gram_source, completed.packed(), worker_id, args.workers, args.batch_size,
+                      schedule, store.dtype.name if store is not None else None, results, stop))
+            process.start()
+            processes.append(process)
+
+        triples_processed = 0
+        if args.progress_bar:
+            progress = tqdm.tqdm(total=args.stop_after)
+        finished = 0
+        while finished < args.workers:
+            with metrics.stage('writer_waiting'):
+                item = results.get()
+            if item is None:
+                finished += 1
+                continue
+            # Stage times add up over all the workers, so their shares can exceed 100%
+            metrics.merge(item[-1])
+            if stop.is_set():
+                continue
+            batch_number, triple_indices, valid, stats, distance_summary, distances, _ = item
+            written = []
+            for k, triple in enumerate(triple_indices):
+                if not valid[k]:
+                    continue
+                if tuple(triple) in completed:
+                    # Another worker got there first
+                    metrics.count('duplicates_rejected')
+                    continue
+                completed.add(tuple(triple))
+                written.append(k)
+                words = tuple(vocab[i] for i in triple)
+                closest_adjective = vocab[stats['closest_index'][k]]
+                writer.add(statistics_row(args, words, closest_adjective, stats, k, vocabulary))
+                triples_processed += 1
+                if args.progress_bar:
+                    progress.update(1)
+                if args.stop_after and triples_processed >= args.stop_after:
+                    stop.set()
+                    break
+            else:
+                # A batch cut short by --stop-after is left out of the distance summary
+                sketches['distances'].merge(distance_summary)
+                if args.schedule == "enumerate":
+                    finished_batches.add(batch_number)
+                    while frontier in finished_batches:
+                        finished_batches.remove(frontier)
+                        frontier += 1
+                    writer.checkpoint = (key, min(start + frontier * args.batch_size, scheduler.size))
+            if written:
+                written = np.array(written)
+                sketches.add_statistics(stats, written)
+                if store is not None:
+                    # Only the rows written above, so the store holds nothing planar_statistics does not
+                    with metrics.stage('distance_store'):
+                        store.append(triple_indices[written], distances[written])
+        for process in processes:
+            process.join()
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        for shm in blocks:
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+
+
+def stored_triples(args: argparse.Namespace, cursor: sqlite3.Cursor) -> List[Tuple[str, str, str]]:
+    """The planes `render` should draw: those named with --triple, or the first --limit stored ones."""
+    if args.triple:
+        return [tuple(sorted(triple.split(','))) for triple in args.triple]
+    order = "how_close" if args.order == "how_close" else "random()"
+    cursor.execute(f"""select adjective1, adjective2, adjective3 from planar_statistics
+      where gender = ? and embedding_provider = ? order by {order} limit ?""",
+                   [args.gender, args.embedding_provider, args.limit])
+    return cursor.fetchall()
+
+
+def render(args: argparse.Namespace, conn: sqlite3.Connection, store: Optional[DistanceStore],
+           artefacts: ArtefactPipeline) -> None:
+    """
+    Hand the distances of already evaluated planes to the artefact pipeline.
+
+    They are read from the distance store; planes missing from it (or every
+    plane, without a store) are recomputed from the embeddings, which are
+    only loaded if that is needed.
+    """
+    if store is not None:
+        vocab, embedding_matrix = store.vocab, None
+    else:
+        vocab, embedding_matrix = load_embeddings(conn, args.embedding_provider, args.gender, args.embedding_cache,
+                                                  np.dtype(args.dtype))
+    vocab_index = {word: i for i, word in enumerate(vocab)}
+    triples = []
+    for words in stored_triples(args, conn.cursor()):
+        if len(words) != 3 or any(word not in vocab_index for word in words):
+            print(f"Skipping {','.join(words)}: not three words of the {args.embedding_provider} {args.gender} vocabulary")
+            continue
+        triples.append(sorted(vocab_index[word] for word in words))
+    triples = np.array(triples, dtype=np.int64).reshape(-1, 3)
+    if store is not None:
+        stored = store.find(triples) >= 0
+        for start in range(0, np.count_nonzero(stored), args.batch_size):
+            batch = triples[stored][start:start + args.batch_size]
+            for triple, distances in zip(batch, store.get_many(batch)):
+                artefacts.submit(tuple(vocab[i] for i in triple), distances)
+        triples = triples[~stored]
+        if len(triples) == 0:
+            return
+        print(f"Recomputing {len(triples)} planes that are not in the distance store")
+        vocab, embedding_matrix = load_embeddings(conn, args.embedding_provider, args.gender, args.embedding_cache,
+                                                  np.dtype(args.dtype))
+        if vocab != store.vocab:
+            raise SystemExit(f"The embeddings have changed since {store.directory} was written")
+    row_norms, float64_row_norms = squared_norms(embedding_matrix)
+    for start in tqdm.tqdm(range(0, len(triples), args.batch_size), disable=not args.progress_bar):
+        batch = triples[start:start + args.batch_size]
+        valid, all_distances = triple_distances(embedding_matrix, batch, row_norms, float64_row_norms)
+        for k, triple in enumerate(batch):
+            if valid[k]:
+                artefacts.submit(tuple(vocab[i] for i in triple), all_distances[k])
+
+
+def refresh(args: argparse.Namespace, conn: sqlite3.Connection) -> None:
+    """
+    Bring planar_statistics rows computed against an older vocabulary up to date.
+
+    Rows whose three words are not all in the current vocabulary any more
+    are deleted. For the others, when the old vocabulary was recorded and
+    the row's distance vector is in that vocabulary's distance store (a
+    float32 one; float16 vectors would degrade the float64 statistics),
+    only the distances to the added words are computed. They are merged with
+    the stored ones, minus the removed words, and the statistics are
+    recomputed from the merged vector. Every other row is recomputed from
+    scratch, and deleted if its words are now collinear, as a search would
+    not have written it. The refreshed vectors go into the current
+    vocabulary's store, so the next refresh can be incremental too.
+    """
+    cursor = conn.cursor()
+    vocab, embedding_matrix = load_embeddings(conn, args.embedding_provider, args.gender, args.embedding_cache,
+                                              np.dtype(args.dtype))
+    vocabulary = register_vocabulary(cursor, args.gender, args.embedding_provider, vocab)
+    conn.commit()
+    stale = stale_counts(cursor, args.gender, args.embedding_provider, vocabulary)
+    if args.adopt and None in stale and not args.dry_run:
+        with conn:
+            conn.execute("""update planar_statistics set vocabulary = ?
+              where gender = ? and embedding_provider = ? and vocabulary is null""",
+                         [vocabulary, args.gender, args.embedding_provider])
+        print(f"Took {stale.pop(None)} rows without a recorded vocabulary to be current")
+    if not stale:
+        print(f"Every {args.embedding_provider} {args.gender} plane is up to date with the vocabulary")
+        return
+
+    vocab_index = {word: i for i, word in enumerate(vocab)}
+    vocab_array = np.array(vocab, dtype=object)
+    row_norms, float64_row_norms = squared_norms(embedding_matrix)
+    if float64_row_norms is None:
+        float64_row_norms = row_norms
+    store = None
+    if args.distance_store and not args.dry_run:
+        store = DistanceStore(store_directory(args.distance_store, args.embedding_provider, args.gender, vocabulary),
+                              vocab, args.distance_store_dtype)
+    create_sketch_table(cursor)
+    sketches = load_sketches(cursor, args.gender, args.embedding_provider)
+    totals = {'incremental': 0, 'recomputed': 0, 'deleted': 0, 'collinear': 0}
+    for old_vocabulary, count in stale.items():
+        old_vocab = load_vocabulary(cursor, old_vocabulary) if old_vocabulary else None
+        change = VocabularyChange(old_vocab, vocab) if old_vocab is not None else None
+        old_store = None
+        if change is not None and args.distance_store:
+            directory = store_directory(args.distance_store, args.embedding_provider, args.gender, old_vocabulary)
+            if os.path.isdir(directory):
+                old_store = DistanceStore(directory)
+                if old_store.dtype != np.float32:
+                    print(f"{directory} holds {old_store.dtype.name} distances, too coarse to carry over; "
+                          "its planes are recomputed in full", file=sys.stderr)
+                    old_store.close()
+                    old_store = None
+        if change is None:
+            print(f"{count} rows computed against an unrecorded vocabulary")
+        else:
+            print(f"{count} rows computed against vocabulary {old_vocabulary[:16]}: {len(change.added)} words added, "
+                  f"{len(change.removed)} removed, {len(old_store) if old_store is not None else 0} planes in its distance store")
+        if args.dry_run:
             continue
-        point = adjective_lookup[word]
-        distance, _ = plane.distance_to_plane(point)
-        distances.append(distance)
-        distance_vocab.append(word)
-    distances = pd.Series(index=distance_vocab, data=distances)
-    print(word1, word2, word3)
-    print(f"{distances.idxmin()=}, {distances.min()=}")
-    print(f"{distances.mean()=}, {distances.std()=}")
-    stats = np.percentile(distances, [0.1, 1, 25, 50, 75, 99])
-    print(f"{stats}")
-    cursor.execute("""insert into planar_statistics (
-       adjective1, adjective2, adjective3, gender, embedding_provider,
-       closest_adjective, how_close, mean_distance, stddev_distance,
-       mili, percentile1, percentile25, percentile50, percentile75,
-       percentile99, furthest) values (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)""",
-                   [word1, word2, word3, args.gender, args.embedding_provider,
-                    distances.idxmin(), distance.min(), distances.mean(), distances.std(),
-                    stats[0], stats[1], stats[2], stats[3], stats[4], stats[5],
-                    distances.max()])
+
+        cursor.execute("""select adjective1, adjective2, adjective3 from planar_statistics
+          where gender = ? and embedding_provider = ? and vocabulary is ?""",
+                       [args.gender, args.embedding_provider, old_vocabulary])
+        rows = cursor.fetchall()
+        gone = [row for row in rows if any(word not in vocab_index for word in row)]
+        with conn:
+            conn.executemany("""delete from planar_statistics where adjective1 = ? and adjective2 = ? and adjective3 = ?
+              and gender = ? and embedding_provider = ?""",
+                             [list(row) + [args.gender, args.embedding_provider] for row in gone])
+        totals['deleted'] += len(gone)
+        words = [row for row in rows if all(word in vocab_index for word in row)]
+        triples = np.array([[vocab_index[word] for word in row] for row in words], dtype=np.int64).reshape(-1, 3)
+        if old_store is not None:
+            old_index = {word: i for i, word in enumerate(old_vocab)}
+            old_triples = np.array([[old_index[word] for word in row] for row in words],
+                                   dtype=np.int64).reshape(-1, 3)
+
+        for start in tqdm.tqdm(range(0, len(triples), args.batch_size), disable=not args.progress_bar):
+            batch = triples[start:start + args.batch_size]
+            stored = np.zeros(len(batch), dtype=bool)
+            if old_store is not None:
+                old_batch = old_triples[start:start + args.batch_size]
+                stored = old_store.find(old_batch) >= 0
+            valid = np.ones(len(batch), dtype=bool)
+            distances = np.empty((len(batch), len(vocab)))
+            if stored.any():
+                distances[stored] = change.carry_over(old_store.get_many(old_batch[stored]))
+                if len(change.added):
+                    # Few enough distances that they may as well be in full precision
+                    planes = PlaneBatch.from_indices(embedding_matrix, batch[stored], dtype=np.float64)
+                    added = planes.distances_to_planes(np.asarray(embedding_matrix[change.added], dtype=np.float64),
+                                                       float64_row_norms[change.added])
+                    distances[np.ix_(stored, change.added)] = added
+            if not stored.all():
+                valid[~stored], distances[~stored] = triple_distances(embedding_matrix, batch[~stored], row_norms,
+                                                                      float64_row_norms)
+            if change is not None and len(change.added):
+                sketches.add_distances(distances[valid][:, change.added])
+            stats = batch_statistics(distances)
+            updates = []
+            for k, triple in enumerate(batch):
+                if valid[k]:
+                    row = statistics_row(args, tuple(vocab_array[triple]), vocab[stats['closest_index'][k]], stats, k,
+                                         vocabulary)
+                    updates.append(row[5:] + row[:5])
+            with conn:
+                conn.executemany("""delete from planar_statistics where adjective1 = ? and adjective2 = ?
+                  and adjective3 = ? and gender = ? and embedding_provider = ?""",
+                                 [list(vocab_array[triple]) + [args.gender, args.embedding_provider]
+                                  for triple in batch[~valid]])
+                conn.executemany("""update planar_statistics set
+                  closest_adjective = ?, how_close = ?, mean_distance = ?, stddev_distance = ?,
+                  mili = ?, percentile1 = ?, percentile25 = ?, percentile50 = ?, percentile75 = ?,
+                  percentile99 = ?, furthest = ?, vocabulary = ?
+                  where adjective1 = ? and adjective2 = ? and adjective3 = ? and gender = ?
+                  and embedding_provider = ?""", updates)
+            if store is not None:
+                store.append(batch[valid], distances[valid])
+            totals['incremental'] += np.count_nonzero(stored)
+            totals['recomputed'] += np.count_nonzero(valid & ~stored)
+            totals['collinear'] += np.count_nonzero(~valid)
+    if args.dry_run:
+        return
+    if store is not None:
+        store.close()
+    # The column summaries are simply recomputed; the distance summary gained the added words' distances
+    # but still holds those of removed words and deleted planes
+    rebuild_column_summaries(cursor, args.gender, args.embedding_provider, sketches)
+    with conn:
+        save_sketches(cursor, args.gender, args.embedding_provider, sketches)
+    print(f"Updated {totals['incremental']} planes incrementally and recomputed {totals['recomputed']}; "
+          f"deleted {totals['deleted']} whose words are gone and {totals['collinear']} that are now collinear")
+
+
+# planar_statistics columns that paired_statistics puts side by side
+PAIRED_COLUMNS = ['how_close', 'mean_distance', 'stddev_distance', 'mili', 'percentile1', 'percentile25',
+                  'percentile50', 'percentile75', 'percentile99', 'furthest']
+
+
+def create_paired_statistics_view(cursor: sqlite3.Cursor) -> None:
+    """
+    A view pairing the rows of every triple across (provider, gender) combinations.
+
+    Each pair of rows for the same triple appears once, ordered so that
+    (embedding_provider1, gender1) sorts before (embedding_provider2,
+    gender2). Rows are paired by their words alone, whatever vocabulary
+    each was measured against, so that rows from ordinary runs pair with
+    those from compare (refresh brings stale rows up to date). It is
+    recreated every time, replacing older definitions. Every column has both
+    values and their difference, e.g. mean_distance1, mean_distance2 and
+    mean_distance_difference (the second minus the first).
+    """
+    columns = ',\n      '.join(f"a.{column} as {column}1, b.{column} as {column}2, "
+                               f"b.{column} - a.{column} as {column}_difference" for column in PAIRED_COLUMNS)
+    cursor.execute("drop view if exists paired_statistics")
+    cursor.execute(f"""create view paired_statistics as select
+      a.adjective1, a.adjective2, a.adjective3,
+      a.embedding_provider as embedding_provider1, a.gender as gender1,
+      b.embedding_provider as embedding_provider2, b.gender as gender2,
+      a.closest_adjective as closest_adjective1, b.closest_adjective as closest_adjective2,
+      {columns}
+      from planar_statistics a join planar_statistics b
+      on a.adjective1 = b.adjective1 and a.adjective2 = b.adjective2 and a.adjective3 = b.adjective3
+      and (a.embedding_provider < b.embedding_provider
+           or (a.embedding_provider = b.embedding_provider and a.gender < b.gender))""")
+
+
+def compare(args: argparse.Namespace, conn: sqlite3.Connection) -> None:
+    """
+    Evaluate one schedule of triples against every --embeddings matrix.
+
+    The matrices are restricted to the words they all share, so that one
+    vocabulary index, one sequence of triples and one duplicate check serve
+    them all. A triple counts as done only once every matrix has a row for
+    it; one that some matrices already have is measured and written only
+    for the others. Its rows are only written if it is a plane in every
+    matrix that measures it; all of them go through one StatisticsWriter,
+    so they are committed together. The rows are ordinary planar_statistics
+    rows, and paired_statistics lines them up. The shared vocabulary is
+    registered under the comparison's own key (e.g. gender 'male+female'),
+    so that it never becomes the latest vocabulary of any one matrix.
+    """
+    cursor = conn.cursor()
+    targets = list(dict.fromkeys(args.embeddings))
+    loaded = [load_embeddings(conn, provider, gender, args.embedding_cache, np.dtype(args.dtype))
+              for provider, gender in targets]
+    shared = set.intersection(*(set(own_vocab) for own_vocab, _ in loaded))
+    vocab = [word for word in loaded[0][0] if word in shared]
+    if len(vocab) < 3:
+        raise SystemExit(f"The {', '.join(f'{p}:{g}' for p, g in targets)} embeddings share {len(vocab)} words")
+    for (provider, gender), (own_vocab, _) in zip(targets, loaded):
+        if len(own_vocab) != len(vocab):
+            print(f"Comparing on the {len(vocab)} shared words; {len(own_vocab) - len(vocab)} "
+                  f"{provider} {gender} words are left out", file=sys.stderr)
+    vocab_index = {word: i for i, word in enumerate(vocab)}
+    vocab_array = np.array(vocab, dtype=object)
+    vocabulary = vocab_fingerprint(vocab)
+
+    create_checkpoint_table(cursor)
+    create_sketch_table(cursor)
+    create_paired_statistics_view(cursor)
+    genders, providers = '+'.join(gender for _, gender in targets), '+'.join(provider for provider, _ in targets)
+    register_vocabulary(cursor, genders, providers, vocab)
+    # The triples each matrix already has rows for, packed
+    target_args, measures, stores, all_sketches, done = [], [], [], [], []
+    for (provider, gender), (own_vocab, embedding_matrix) in zip(targets, loaded):
+        own_index = {word: i for i, word in enumerate(own_vocab)}
+        rows = np.array([own_index[word] for word in vocab], dtype=np.int64)
+        if not np.array_equal(rows, np.arange(len(own_vocab))):
+            embedding_matrix = np.asarray(embedding_matrix)[rows]
+        # The per-matrix helpers all read the provider and gender from args
+        target = argparse.Namespace(**{**vars(args), 'embedding_provider': provider, 'gender': gender})
+        target_args.append(target)
+        measures.append(distance_function(embedding_matrix, load_gram(target, conn, vocab, embedding_matrix)))
+        if args.distance_store:
+            stores.append(DistanceStore(store_directory(args.distance_store, provider, gender, vocabulary),
+                                        vocab, args.distance_store_dtype))
+        all_sketches.append(load_sketches(cursor, gender, provider))
+        done.append(CompletedTriples.from_database(cursor, gender, provider, vocab_index).packed())
     conn.commit()
-    if args.output_directory:
-        fname = os.path.join(args.output_directory, f"{word1},{word2},{word3}.png")
-        fig, ax = matplotlib.pyplot.subplots()
-        distances.plot.hist(ax=ax)
-        ax.set_title(f"Distribution of distances from the plane through\n{word1}, {word2} and {word3}")
-        ax.set_xlabel("Distance from the plane")
-        fig.savefig(fname)
-    if args.fitter:
-        import fitter
-        f = fitter.Fitter(distances)
-        f.fit()
-        print(f.summary())
-        if args.output_directory:
-            fname = os.path.join(args.output_directory, f"{word1},{word2},{word3}.fitter.json")
-            with open(fname, 'w') as o:
-                o.write(f.summary().to_json())
-            
+    completed = CompletedTriples(len(vocab), functools.reduce(np.intersect1d, done))
+
+    writer = StatisticsWriter(conn, args.commit_every, args.commit_seconds)
+    writer.sketches = [(target.gender, target.embedding_provider, sketches)
+                       for target, sketches in zip(target_args, all_sketches)]
+    metrics_file = open(args.metrics, 'a') if args.metrics else None
+    metrics = Metrics(metrics_file, args.metrics_interval)
+    writer.metrics = metrics
+    if args.schedule == "enumerate":
+        scheduler = make_scheduler(args, vocab)
+        key = (genders, providers, args.random_seed or 0, args.anchor or '', vocabulary)
+        position = load_checkpoint(cursor, key)
+        print(f"Resuming the schedule at {position} of {scheduler.size}")
+    elif args.random_seed:
+        random.seed(args.random_seed)
+    # Each matrix's --objective for every triple written for all of them, to report on at the end
+    objectives = [[] for _ in targets]
+    triples_paired = 0
+    triples_processed = 0
+    progress = tqdm.tqdm(total=args.stop_after, disable=not args.progress_bar)
+    try:
+        while not (args.stop_after and triples_processed >= args.stop_after):
+            wanted = args.batch_size
+            if args.stop_after:
+                wanted = min(wanted, args.stop_after - triples_processed)
+            if args.schedule == "enumerate":
+                if position >= scheduler.size:
+                    print("Every triple has been evaluated")
+                    break
+                with metrics.stage('schedule'):
+                    triple_indices = unseen_triples(scheduler, position, position + wanted, completed, metrics)
+                position = min(position + wanted, scheduler.size)
+                if len(triple_indices) == 0:
+                    writer.checkpoint = (key, position)
+                    continue
+            else:
+                with metrics.stage('schedule'):
+                    triple_indices = random_triples(vocab, vocab_index, completed, wanted, metrics)
+            packed = pack_triples(triple_indices, len(vocab))
+            # For each matrix, the positions in the batch of the triples it has no row for yet
+            results = []
+            for measure, own_done in zip(measures, done):
+                positions = np.flatnonzero(~np.isin(packed, own_done))
+                if len(positions) == 0:
+                    results.append((positions, None, None, None))
+                    continue
+                with metrics.stage('distances'):
+                    own_valid, all_distances = measure(triple_indices[positions])
+                with metrics.stage('statistics'):
+                    stats = batch_statistics(all_distances)
+                results.append((positions, own_valid, all_distances, stats))
+            # Only triples that are planes in every matrix, so that every row written has its pairs; those
+            # already stored were planes when they were written
+            valid = np.ones(len(triple_indices), dtype=bool)
+            measured = np.zeros(len(triple_indices), dtype=np.int64)
+            for positions, own_valid, _, _ in results:
+                if len(positions):
+                    valid[positions[~own_valid]] = False
+                    measured[positions] += 1
+            metrics.count('triples_evaluated', np.count_nonzero(valid))
+            metrics.count('collinear_skipped', len(valid) - np.count_nonzero(valid))
+            everywhere = np.flatnonzero(valid & (measured == len(targets)))
+            for i, (positions, _, all_distances, stats) in enumerate(results):
+                if len(positions) == 0:
+                    continue
+                keep = valid[positions]
+                with metrics.stage('sketches'):
+                    all_sketches[i].add_distances(all_distances[keep])
+                    all_sketches[i].add_statistics(stats, keep)
+                if stores:
+                    with metrics.stage('distance_store'):
+                        stores[i].append(triple_indices[positions[keep]], all_distances[keep])
+                if len(everywhere):
+                    objectives[i].append(stats[args.objective][np.searchsorted(positions, everywhere)])
+                for k in np.flatnonzero(keep):
+                    writer.add(statistics_row(target_args[i], tuple(vocab_array[triple_indices[positions[k]]]),
+                                              vocab[stats['closest_index'][k]], stats, k, vocabulary))
+            if args.schedule == "enumerate":
+                # As in run_single_process, not before the batch's rows have all been added
+                writer.checkpoint = (key, position)
+            triples_processed += np.count_nonzero(valid)
+            triples_paired += len(everywhere)
+            progress.update(np.count_nonzero(valid))
+            metrics.maybe_emit()
+    finally:
+        progress.close()
+        writer.flush()
+        for store in stores:
+            store.close()
+        metrics.emit('summary')
+        print(metrics.summary(), file=sys.stderr)
+        if metrics_file is not None:
+            metrics_file.close()
+
+    objectives = [np.concatenate(values) if values else np.empty(0) for values in objectives]
+    if triples_paired < 2:
+        return
+    print(f"{args.objective} over the {triples_paired} triples this run wrote for every matrix "
+          f"(paired_statistics has every run's pairs):")
+    for i, j in itertools.combinations(range(len(targets)), 2):
+        difference = objectives[j] - objectives[i]
+        correlation = np.corrcoef(objectives[i], objectives[j])[0, 1]
+        print(f"  {':'.join(targets[j])} - {':'.join(targets[i])}: mean difference {difference.mean():+.6f} "
+              f"(stddev {difference.std():.6f}), correlation {correlation:.3f}")
+
+
+def run(args: argparse.Namespace) -> None:
+    conn = sqlite3.connect(args.database)
+    conn.execute('pragma journal_mode=wal')
+    cursor = conn.cursor()
+    create_statistics_table(cursor)
+    create_vocabulary_table(cursor)
+    if args.command == "render":
+        store = None
+        latest = latest_vocabulary(cursor, args.gender, args.embedding_provider)
+        if args.distance_store and latest:
+            store = DistanceStore(store_directory(args.distance_store, args.embedding_provider, args.gender, latest))
+        with ArtefactPipeline(args.output_directory, args.fitter, args.artefact_workers,
+                              args.artefact_queue) as artefacts:
+            render(args, conn, store, artefacts)
+        return
+    if args.command == "refresh":
+        refresh(args, conn)
+        return
+    if args.command == "compare":
+        compare(args, conn)
+        return
+    artefacts = None
+    # Any exit must close the pipeline, or its (non-daemon) workers keep the process alive
+    try:
+        if args.output_directory or args.fitter:
+            artefacts = ArtefactPipeline(args.output_directory, args.fitter, args.artefact_workers,
+                                         args.artefact_queue)
+        vocab, embedding_matrix = load_embeddings(conn, args.embedding_provider, args.gender, args.embedding_cache,
+                                                  np.dtype(args.dtype))
+        vocabulary = register_vocabulary(cursor, args.gender, args.embedding_provider, vocab)
+        conn.commit()
+        stale = sum(stale_counts(cursor, args.gender, args.embedding_provider, vocabulary).values())
+        if stale:
+            print(f"{stale} planar_statistics rows were computed against another vocabulary; "
+                  "`language_plane_finder.py refresh` brings them up to date", file=sys.stderr)
+        gram = load_gram(args, conn, vocab, embedding_matrix)
+        store = None
+        if args.distance_store:
+            store = DistanceStore(store_directory(args.distance_store, args.embedding_provider, args.gender,
+                                                  vocabulary), vocab, args.distance_store_dtype)
+        create_checkpoint_table(cursor)
+        create_sketch_table(cursor)
+        sketches = load_sketches(cursor, args.gender, args.embedding_provider)
+        writer = StatisticsWriter(conn, args.commit_every, args.commit_seconds)
+        writer.sketches = [(args.gender, args.embedding_provider, sketches)]
+        metrics_file = open(args.metrics, 'a') if args.metrics else None
+        metrics = Metrics(metrics_file, args.metrics_interval)
+        writer.metrics = metrics
+        try:
+            if args.schedule == "beam":
+                run_beam_search(args, conn, writer, vocab, embedding_matrix, gram, sketches, artefacts, store, metrics)
+            elif args.workers > 1:
+                run_workers(args, conn, writer, vocab, embedding_matrix, gram, sketches, store, metrics)
+            else:
+                run_single_process(args, conn, writer, vocab, embedding_matrix, gram, sketches, artefacts, store,
+                                   metrics)
+        finally:
+            writer.flush()
+            if store is not None:
+                store.close()
+            if artefacts is not None:
+                with metrics.stage('artefact_drain'):
+                    artefacts.close()
+            metrics.emit('summary')
+            print(metrics.summary(), file=sys.stderr)
+            if metrics_file is not None:
+                metrics_file.close()
+
+    finally:
+        if artefacts is not None:
+            artefacts.close()
+
+def main():
+    args = parse_arguments()
+    if not args.profile:
+        run(args)
+        return
+    profile_directory = args.output_directory or os.path.dirname(os.path.abspath(args.database))
+    profile_path = os.path.join(profile_directory, f"language_plane_finder.{time.strftime('%Y%m%d-%H%M%S')}.prof")
+    profiler = cProfile.Profile()
+    try:
+        profiler.runcall(run, args)
+    finally:
+        os.makedirs(profile_directory, exist_ok=True)
+        profiler.dump_stats(profile_path)
+        print(f"Profile written to {profile_path} (python -m pstats {profile_path})", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,18 @@
 #!/usr/bin/env python3
 
-import nltk
-from nltk.corpus import wordnet as wn
 import sqlite3
 import anthropic
-import json
-import time
+import asyncio
 import os
-from typing import List, Dict
+from typing import Callable, List, Dict, Optional
 import argparse
+from tqdm import tqdm
+
+from ratelimit import AdaptiveTokenBucket, retry_with_backoff
+from responsecache import ResponseCache, add_cache_arguments, open_cache
+from wordnetvocab import DEFAULT_SNAPSHOT, wordnet_adjectives
+
+MODEL = "claude-3-5-haiku-20241022"
 
 def setup_database(dbpath) -> sqlite3.Connection:
     """Create the SQLite database and necessary tables."""
@@ -27,21 +31,10 @@ def setup_database(dbpath) -> sqlite3.Connection:
     conn.commit()
     return conn
 
-def get_all_adjectives() -> List[str]:
-    """Extract all adjectives from WordNet."""
-    # Download required NLTK data if not already present
-    #nltk.download('wordnet')
-    
-    adjectives = set()
-    for synset in list(wn.all_synsets(pos=wn.ADJ)):
-        # Get the main lemma name
-        adjectives.add(synset.name().split('.')[0])
-        
-        # Get all lemma names
-        for lemma in synset.lemmas():
-            adjectives.add(lemma.name())
-    
-    return list(adjectives)
+def get_all_adjectives(snapshot: str = DEFAULT_SNAPSHOT, refresh: bool = False) -> List[str]:
+    """Extract all adjectives from WordNet, through the snapshot so that NLTK is usually not loaded at all."""
+    # Sorted, so that --adjectives-per-request groups them (and their cache keys) the same way every run
+    return wordnet_adjectives(snapshot, refresh)
 
 def create_tool_schema():
     """Create the tool choice schema for Claude."""
@@ -64,94 +57,219 @@ def create_tool_schema():
     }
 
 
-def query_claude(client: anthropic.Client, adjective: str) -> Dict[bool, bool]:
-    """Query Claude Haiku about whether an adjective can describe personality."""
-    tool_schema = create_tool_schema()
-    messages = [
-        {
-            "role": "user",
-            "content": f"Could the sentence 'He is {adjective}' be a statement about a person's personality or character?"
-        },
-        {
-            "role": "user",
-            "content": f"Could the sentence 'She is {adjective}' be a statement about a person's personality or character?"
+def create_batch_tool_schema():
+    """Create the tool schema for classifying several adjectives in one call."""
+    return {
+        "name": "classify_personality_adjectives",
+        "description": "Determine, for each adjective, whether 'He is ...' and 'She is ...' describe personality",
+        "input_schema": {
+            "type": "object",
+            "properties": {
+                "classifications": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "adjective": {"type": "string"},
+                            "he_is_personality": {
+                                "type": "boolean",
+                                "description": "Whether 'He is <adjective>' describes personality or character"
+                            },
+                            "she_is_personality": {
+                                "type": "boolean",
+                                "description": "Whether 'She is <adjective>' describes personality or character"
+                            }
+                        },
+                        "required": ["adjective", "he_is_personality", "she_is_personality"]
+                    }
+                }
+            },
+            "required": ["classifications"]
         }
-    ]
-    
-    results = {}
-    
-    for is_he, prompt in enumerate(messages):
-        print(prompt)
-        response = client.messages.create(
-            model="claude-3-5-haiku-20241022",
-            max_tokens=100,
-            temperature=0,
-            messages=[prompt],
-            tools=[tool_schema['function']],
-            tool_choice = {'name': 'classify_personality_adjective', 'type': 'tool', 'disable_parallel_tool_use': True }
-            
-        )
-        
-        # Extract and parse the JSON response
-        print(response.content[0].input)
-        tool_call = response.content[0].input
-        results[bool(is_he == 0)] = tool_call["is_personality"]
-        if tool_call['is_personality']:
-            print(f"The sentence '{prompt['content']}' could be a personality sentence")
-        
-        # Rate limiting - be nice to the API
-        time.sleep(0.5)
-            
-    return results
+    }
+
+
+class Classifier:
+    def __init__(self, client: anthropic.AsyncAnthropic, workers: int, requests_per_second: float,
+                 cache: Optional[ResponseCache] = None):
+        """
+        Sends classification requests with at most `workers` in flight, at a rate
+        that backs off when the API answers 429 and creeps back up afterwards.
+        Answers found in `cache` are not requested again.
+        """
+        self.client = client
+        self.cache = cache
+        self.in_flight = asyncio.Semaphore(workers)
+        self.limiter = AdaptiveTokenBucket(requests_per_second)
+
+    async def call_tool(self, prompt: str, tool: Dict, max_tokens: int,
+                        complete: Callable[[Dict], bool] = lambda answer: True) -> Dict:
+        """
+        Send one prompt that must be answered with `tool`, and return the tool's input.
+
+        Only answers for which complete(answer) holds are cached, so that an
+        incomplete one is asked for again rather than replayed.
+        """
+        request = {"prompt": prompt, "tool": tool, "max_tokens": max_tokens, "temperature": 0}
+        if self.cache is not None:
+            cached = self.cache.get_json("anthropic", MODEL, request)
+            if cached is not None:
+                return cached
+
+        async def attempt():
+            await self.limiter.acquire()
+            try:
+                response = await self.client.messages.create(
+                    model=MODEL,
+                    max_tokens=max_tokens,
+                    temperature=0,
+                    messages=[{"role": "user", "content": prompt}],
+                    tools=[tool],
+                    tool_choice = {'name': tool['name'], 'type': 'tool', 'disable_parallel_tool_use': True }
+                )
+            except anthropic.RateLimitError:
+                self.limiter.throttled()
+                raise
+            self.limiter.succeeded()
+            return response.content[0].input
+
+        async with self.in_flight:
+            answer = await retry_with_backoff(attempt, retry_on=(anthropic.APIConnectionError,
+                                                                 anthropic.InternalServerError),
+                                              throttled_on=(anthropic.RateLimitError,))
+        if self.cache is not None and complete(answer):
+            self.cache.put_json("anthropic", MODEL, request, answer)
+        return answer
+
+    async def classify(self, adjective: str) -> Dict[bool, bool]:
+        """Ask about 'He is ...' and 'She is ...' separately; keys are True for he, False for she."""
+        tool = create_tool_schema()['function']
+        prompts = [
+            f"Could the sentence 'He is {adjective}' be a statement about a person's personality or character?",
+            f"Could the sentence 'She is {adjective}' be a statement about a person's personality or character?"
+        ]
+        answers = await asyncio.gather(*[self.call_tool(prompt, tool, 100) for prompt in prompts])
+        return {True: answers[0]["is_personality"], False: answers[1]["is_personality"]}
+
+    async def classify_many(self, adjectives: List[str]) -> Dict[str, Dict[bool, bool]]:
+        """Classify several adjectives with a single tool call; adjectives missing from the answer are left out."""
+        listing = "\n".join(f"- {adjective}" for adjective in adjectives)
+        prompt = ("For each adjective below, could the sentence 'He is <adjective>' be a statement about "
+                  "a person's personality or character? And could 'She is <adjective>'? "
+                  f"Classify every adjective in the list.\n{listing}")
+        wanted = set(adjectives)
+        answer = await self.call_tool(
+            prompt, create_batch_tool_schema(), 100 + 60 * len(adjectives),
+            complete=lambda answer: wanted <= {item["adjective"] for item in answer["classifications"]})
+        return {item["adjective"]: {True: item["he_is_personality"], False: item["she_is_personality"]}
+                for item in answer["classifications"] if item["adjective"] in wanted}
+
+
+class ResultWriter:
+    def __init__(self, conn: sqlite3.Connection, commit_every: int):
+        """Buffer adjective_analysis rows and insert them with executemany, one transaction per batch."""
+        self.conn = conn
+        self.commit_every = commit_every
+        self.rows = []
+
+    def add(self, adjective: str, results: Dict[bool, bool]) -> None:
+        self.rows.append((adjective, results.get(True), results.get(False)))
+        if len(self.rows) >= self.commit_every:
+            self.flush()
+
+    def flush(self) -> None:
+        if not self.rows:
+            return
+        with self.conn:
+            self.conn.executemany('''
+                INSERT OR IGNORE INTO adjective_analysis (adjective, he_is_personality, she_is_personality)
+                VALUES (?, ?, ?)
+            ''', self.rows)
+        self.rows = []
+
+
+def unclassified(conn: sqlite3.Connection, adjectives: List[str]) -> List[str]:
+    """The adjectives without an adjective_analysis row yet, in their original order."""
+    done = {row[0] for row in conn.execute('SELECT adjective FROM adjective_analysis')}
+    return [adjective for adjective in adjectives if adjective not in done]
+
+
+async def classify_all(classifier: Classifier, adjectives: List[str], writer: ResultWriter,
+                       adjectives_per_request: int) -> None:
+    """Classify every adjective, storing results as they arrive."""
+    progress = tqdm(total=len(adjectives), desc="Classifying adjectives")
+
+    async def one(adjective: str) -> None:
+        writer.add(adjective, await classifier.classify(adjective))
+        progress.update(1)
+
+    async def several(chunk: List[str]) -> None:
+        results = await classifier.classify_many(chunk)
+        for adjective in chunk:
+            if adjective in results:
+                writer.add(adjective, results[adjective])
+            else:
+                progress.write(f"No answer for {adjective}; it will be retried next time")
+        progress.update(len(chunk))
+
+    if adjectives_per_request > 1:
+        tasks = [several(adjectives[start:start + adjectives_per_request])
+                 for start in range(0, len(adjectives), adjectives_per_request)]
+    else:
+        tasks = [one(adjective) for adjective in adjectives]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        writer.flush()
+        progress.close()
+
 
 def main() -> None:
     parser = argparse.ArgumentParser()
     parser.add_argument("--stop-after", type=int, help="Only process this many adjectives")
     parser.add_argument("--anthropic-api-key-file", default=os.path.expanduser("~/.anthropic.key"))
+    parser.add_argument("--anthropic-base-url", help="Send requests somewhere else, e.g. to stubserver.py")
     parser.add_argument("--database", default="personality_adjectives.sqlite")
+    parser.add_argument("--workers", type=int, default=8, help="Requests in flight at once")
+    parser.add_argument("--requests-per-second", type=float, default=2.0,
+                        help="Starting request rate; it adapts to the API's rate limiting")
+    parser.add_argument("--adjectives-per-request", type=int, default=1,
+                        help="Classify this many adjectives in one tool call (1 keeps one question per sentence)")
+    parser.add_argument("--commit-every", type=int, default=50)
+    parser.add_argument("--wordnet-snapshot", default=DEFAULT_SNAPSHOT,
+                        help="File keeping the WordNet adjectives between runs")
+    parser.add_argument("--refresh-wordnet", action="store_true",
+                        help="Read the adjectives from WordNet again even if the snapshot looks current")
+    add_cache_arguments(parser)
     args = parser.parse_args()
     
     # Initialize the database
     conn = setup_database(args.database)
-    cursor = conn.cursor()
     
     # Initialize the Anthropic client
     api_key = open(args.anthropic_api_key_file).read().strip()
-    client = anthropic.Client(api_key=api_key)
+    client = anthropic.AsyncAnthropic(api_key=api_key, base_url=args.anthropic_base_url, max_retries=0)
     
     # Get all adjectives
-    adjectives = get_all_adjectives()
+    adjectives = get_all_adjectives(args.wordnet_snapshot, args.refresh_wordnet)
     print(f"Found {len(adjectives)} adjectives to analyze")
 
-    processed = 0
-    # Process each adjective
-    for i, adjective in enumerate(adjectives):
-        # Check if we've already processed this adjective
-        cursor.execute('SELECT * FROM adjective_analysis WHERE adjective = ?', (adjective,))
-        if cursor.fetchone():
-            continue
-            
-        print(f"Processing {i+1}/{len(adjectives)}: {adjective}")
-        
-        # Query Claude
-        results = query_claude(client, adjective)
-        
-        # Store results
-        cursor.execute('''
-            INSERT INTO adjective_analysis (adjective, he_is_personality, she_is_personality)
-            VALUES (?, ?, ?)
-        ''', (adjective, results.get(True), results.get(False)))
-        
-        # Commit every 10 adjectives
-        if i % 10 == 0:
-            conn.commit()
-
-        processed += 1
-        if args.stop_after and processed >= args.stop_after:
-            break
-            
-    # Final commit
-    conn.commit()
+    adjectives = unclassified(conn, adjectives)
+    print(f"{len(adjectives)} of them still need classifying")
+    if args.stop_after:
+        adjectives = adjectives[:args.stop_after]
+
+    cache = open_cache(args)
+
+    async def run() -> None:
+        classifier = Classifier(client, args.workers, args.requests_per_second, cache)
+        await classify_all(classifier, adjectives, ResultWriter(conn, args.commit_every),
+                           args.adjectives_per_request)
+
+    asyncio.run(run())
+    if cache is not None:
+        print(cache.summary())
+        cache.close()
     conn.close()
 
 if __name__ == "__main__":
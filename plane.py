@@ -1,9 +1,22 @@
 #!/usr/bin/env python3
 
+import argparse
+from typing import Tuple
+
 import numpy as np
 
+# Planes built from float32 (or smaller) points whose two directions are closer
+# than this (as the sine of the angle between them) are rebuilt in float64:
+# the relative error of the second direction grows like eps / sine.
+REDUCED_PRECISION_MIN_SEPARATION = 1e-3
+
+
+def _reduced_precision(array: np.ndarray) -> bool:
+    return np.issubdtype(array.dtype, np.floating) and np.finfo(array.dtype).eps > np.finfo(np.float64).eps
+
+
 class Plane:
-    def __init__(self, point1, point2, point3):
+    def __init__(self, point1, point2, point3, lightweight: bool = False):
         """
         Initialize a plane in high-dimensional space using three points.
         
@@ -11,7 +24,13 @@ class Plane:
             point1 (np.ndarray): First point on the plane
             point2 (np.ndarray): Second point on the plane
             point3 (np.ndarray): Third point on the plane
+            lightweight (bool): If True, the (d-2) x d normal basis is only
+                computed the first time something asks for it
+
+        Float32 points are kept in float32, unless they are so close to
+        collinear that the plane is rebuilt in float64.
         """
+        point1, point2, point3 = np.asarray(point1), np.asarray(point2), np.asarray(point3)
         self.origin = point1
         
         # Compute direction vectors from the points
@@ -25,14 +44,31 @@ class Plane:
         proj = np.dot(direction2, self.direction1) * self.direction1
         orthogonal_dir2 = direction2 - proj
         
+        if (_reduced_precision(orthogonal_dir2)
+                and np.linalg.norm(orthogonal_dir2) < REDUCED_PRECISION_MIN_SEPARATION * np.linalg.norm(direction2)):
+            self.__init__(point1.astype(np.float64), point2.astype(np.float64), point3.astype(np.float64),
+                          lightweight)
+            return
+
         # Check if points are collinear
         if np.linalg.norm(orthogonal_dir2) < 1e-10:
             raise ValueError("The three points appear to be collinear. They must span a 2D plane.")
             
         self.direction2 = orthogonal_dir2 / np.linalg.norm(orthogonal_dir2)
         
-        # Calculate the normal space basis
-        self.normal_basis = self._calculate_normal_basis()
+        # Calculate the normal space basis, unless it can wait until needed
+        self._normal_basis = None
+        if not lightweight:
+            self._normal_basis = self._calculate_normal_basis()
+
+    @property
+    def normal_basis(self) -> np.ndarray:
+        """
+        Orthonormal basis for the normal space of the plane, computed on first use.
+        """
+        if self._normal_basis is None:
+            self._normal_basis = self._calculate_normal_basis()
+        return self._normal_basis
         
     def _calculate_normal_basis(self):
         """
@@ -43,7 +79,6 @@ class Plane:
         # Create matrix for null space calculation
         plane_vectors = np.vstack([self.direction1, self.direction2])
         
-from typing import List, Tuple
         # Get the null space (normal space) using SVD
         _, _, Vh = np.linalg.svd(plane_vectors, full_matrices=True)
         normal_basis = Vh[2:]  # All vectors except the first two form the normal space basis
@@ -63,14 +98,11 @@ from typing import List, Tuple
         # Vector from origin to point
         vector = point - self.origin
         
-        # Project the vector onto the normal space
-        #normal_projection = np.sum(np.dot(vector, self.normal_basis.T) * self.normal_basis, axis=0)
-        
-        # Project the vector onto each normal vector and sum the components
-        normal_projection = np.zeros_like(vector)
-        for normal_vec in self.normal_basis:
-            proj = np.dot(vector, normal_vec) * normal_vec
-            normal_projection += proj
+        # The part of the vector lying in the plane; whatever is left over
+        # is the projection onto the normal space
+        in_plane = (np.dot(vector, self.direction1) * self.direction1
+                    + np.dot(vector, self.direction2) * self.direction2)
+        normal_projection = vector - in_plane
         
         # Distance is the magnitude of the normal projection
         distance = np.linalg.norm(normal_projection)
@@ -80,6 +112,27 @@ from typing import List, Tuple
         
         return distance, projected_point
 
+    def distances_to_plane(self, points: np.ndarray) -> np.ndarray:
+        """
+        Calculate the distance from every row of a matrix to the plane.
+
+        Only the two in-plane directions are needed: the squared residual of
+        v = point - origin is ||v||^2 - (v.e1)^2 - (v.e2)^2.
+
+        Args:
+            points (np.ndarray): Matrix of shape (N, d), one point per row
+
+        Returns:
+            np.ndarray: Array of N distances
+        """
+        vectors = np.atleast_2d(points) - self.origin
+        squared_norms = np.einsum('ij,ij->i', vectors, vectors)
+        coord1 = vectors @ self.direction1
+        coord2 = vectors @ self.direction2
+        residuals = squared_norms - coord1 * coord1 - coord2 * coord2
+        # Rounding can push points lying on the plane very slightly negative
+        return np.sqrt(np.maximum(residuals, 0.0))
+
     def project_point(self, point):
         """
         Project a point onto the plane and return its coordinates in the plane's basis.
@@ -100,6 +153,125 @@ from typing import List, Tuple
         
         return np.array([coord1, coord2]), projected_point
 
+class PlaneBatch:
+    def __init__(self, points1: np.ndarray, points2: np.ndarray, points3: np.ndarray):
+        """
+        Initialize K planes at once, one per row of the three (K, d) matrices.
+
+        The direction vectors of every plane are orthonormalized together with
+        a single batched QR decomposition. Collinear triples do not raise as
+        they do in Plane; they are flagged as False in `valid` instead.
+        `separation` is the sine of the angle between each plane's two
+        directions, which says how much precision the second one lost.
+
+        Args:
+            points1 (np.ndarray): First point of each plane, shape (K, d)
+            points2 (np.ndarray): Second point of each plane, shape (K, d)
+            points3 (np.ndarray): Third point of each plane, shape (K, d)
+        """
+        self.origins = np.atleast_2d(points1)
+        directions = np.stack([points2 - points1, points3 - points1], axis=2)
+        q, r = np.linalg.qr(directions)
+        self.directions1 = q[:, :, 0]
+        self.directions2 = q[:, :, 1]
+        # |r[1, 1]| is the length of direction2 once its direction1 part is removed,
+        # the same quantity Plane checks for collinearity
+        self.valid = (np.abs(r[:, 0, 0]) >= 1e-10) & (np.abs(r[:, 1, 1]) >= 1e-10)
+        lengths2 = np.linalg.norm(directions[:, :, 1], axis=1)
+        self.separation = np.abs(r[:, 1, 1]) / np.where(lengths2 > 0, lengths2, 1)
+
+    @classmethod
+    def from_indices(cls, embedding_matrix: np.ndarray, triples: np.ndarray, dtype=None) -> "PlaneBatch":
+        """
+        Build the planes through rows of an embedding matrix.
+
+        Args:
+            embedding_matrix (np.ndarray): Matrix of shape (N, d)
+            triples (np.ndarray): Integer row indices of shape (K, 3)
+            dtype: Build the planes in this precision rather than the matrix's
+        """
+        triples = np.asarray(triples)
+        return cls(*[np.asarray(embedding_matrix[triples[:, i]], dtype=dtype) for i in range(3)])
+
+    def __len__(self) -> int:
+        return len(self.origins)
+
+    def distances_to_planes(self, points: np.ndarray, row_norms: np.ndarray = None,
+                            exclude: np.ndarray = None) -> np.ndarray:
+        """
+        Calculate the distance from every point to every plane in the batch.
+
+        With x a point, o an origin and e1, e2 its plane's directions, the
+        squared distance is ||x - o||^2 - ((x - o).e1)^2 - ((x - o).e2)^2.
+        Everything involving x comes out of one matrix product of the points
+        with the stacked directions and origins.
+
+        Args:
+            points (np.ndarray): Matrix of shape (N, d), one point per row
+            row_norms (np.ndarray): Precomputed squared norms of the rows of
+                `points`; worth passing in when the same points are reused
+            exclude (np.ndarray): Integer indices of shape (K, m) into `points`;
+                those entries of each plane's row are set to NaN (typically
+                the triple that defines the plane)
+
+        Returns:
+            np.ndarray: Matrix of shape (K, N) of distances
+        """
+        if row_norms is None:
+            row_norms = np.einsum('ij,ij->i', points, points)
+        k = len(self)
+        basis = np.concatenate([self.directions1, self.directions2, self.origins])
+        products = basis @ points.T
+        along1 = products[:k] - np.einsum('ij,ij->i', self.directions1, self.origins)[:, None]
+        along2 = products[k:2 * k] - np.einsum('ij,ij->i', self.directions2, self.origins)[:, None]
+        origin_norms = np.einsum('ij,ij->i', self.origins, self.origins)
+        residuals = row_norms[None, :] - 2 * products[2 * k:] + origin_norms[:, None]
+        residuals -= along1 * along1
+        residuals -= along2 * along2
+        # Rounding can push points lying on the plane very slightly negative
+        distances = np.sqrt(np.maximum(residuals, 0.0))
+        if exclude is not None:
+            np.put_along_axis(distances, np.asarray(exclude), np.nan, axis=1)
+        return distances
+
+
+def triple_distances(embedding_matrix: np.ndarray, triples: np.ndarray, row_norms: np.ndarray = None,
+                     float64_row_norms: np.ndarray = None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Distances from every row of the matrix to the plane through each triple of its rows.
+
+    Everything is computed in the matrix's precision, except that in reduced
+    precision the planes whose directions are nearly parallel (separation
+    below REDUCED_PRECISION_MIN_SEPARATION) are rebuilt and measured in
+    float64. The words of each triple are excluded (NaN).
+
+    Args:
+        embedding_matrix (np.ndarray): Matrix of shape (N, d)
+        triples (np.ndarray): Integer row indices of shape (K, 3)
+        row_norms (np.ndarray): Squared row norms, in the matrix's precision
+        float64_row_norms (np.ndarray): The same in float64, used by the fallback
+
+    Returns:
+        tuple: (valid, distances), a (K,) mask of non-collinear triples and
+        the (K, N) distance matrix
+    """
+    triples = np.asarray(triples)
+    planes = PlaneBatch.from_indices(embedding_matrix, triples)
+    distances = planes.distances_to_planes(embedding_matrix, row_norms, exclude=triples)
+    valid = planes.valid
+    if _reduced_precision(distances):
+        unstable = np.flatnonzero(planes.separation < REDUCED_PRECISION_MIN_SEPARATION)
+        if len(unstable):
+            if float64_row_norms is None:
+                float64_row_norms = np.einsum('ij,ij->i', embedding_matrix, embedding_matrix, dtype=np.float64)
+            exact = PlaneBatch.from_indices(embedding_matrix, triples[unstable], dtype=np.float64)
+            distances[unstable] = exact.distances_to_planes(embedding_matrix, float64_row_norms,
+                                                            exclude=triples[unstable])
+            valid = valid.copy()
+            valid[unstable] = exact.valid
+    return valid, distances
+
+
 def parse_point(point_str: str) -> np.ndarray:
     """
     Parse a comma-separated string of numbers into a numpy array.
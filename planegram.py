@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+
+"""
+Word-to-plane distances from the Gram matrix of the vocabulary instead of the embeddings.
+
+With o, b, c the three words of a triple, u = b - o, v = c - o and w = x - o
+for any word x, everything the distance from x to the plane needs is an
+inner product of vocabulary vectors:
+
+    w.w = G[x, x] - 2 G[x, o] + G[o, o]
+    w.u = G[x, b] - G[x, o] - G[o, b] + G[o, o]
+    w.v = G[x, c] - G[x, o] - G[o, c] + G[o, o]
+
+and u.u, u.v and v.v likewise. Gram-Schmidt on u and v then works on these
+numbers just as PlaneBatch's QR decomposition works on the vectors. Once
+G = E E^T has been computed, a triple's whole distance vector costs three
+rows of G and a few passes over N numbers, however large d is. The price
+is the N x N float64 matrix itself, which is why gram_fits checks it
+against a memory budget.
+
+The Gram matrix is kept in float64 whatever the embeddings' precision. It
+loses precision as the plane's two directions approach parallel a little
+faster than the direct computation does, so the few triples whose
+separation is below GRAM_MIN_SEPARATION are measured directly in float64.
+"""
+
+import os
+import sqlite3
+from typing import Optional, Tuple
+
+import numpy as np
+
+from embeddingstore import load_cached_matrix, save_cached_matrix, table_version
+from plane import PlaneBatch
+
+GRAM_MIN_SEPARATION = 1e-3
+# The auto engine only uses the Gram matrix for embeddings of at least this dimension; below it
+# the direct matrix product is about as cheap (see benchmarks.py gram)
+GRAM_MIN_DIMENSION = 256
+ENGINES = ['auto', 'direct', 'gram']
+
+
+def gram_bytes(vocab_size: int) -> int:
+    return vocab_size * vocab_size * np.dtype(np.float64).itemsize
+
+
+def gram_fits(vocab_size: int, budget_mb: float) -> bool:
+    return gram_bytes(vocab_size) <= budget_mb * 2 ** 20
+
+
+def choose_engine(engine: str, vocab_size: int, dimension: int, budget_mb: float) -> str:
+    """
+    'direct' or 'gram' for a vocabulary of this size and dimension.
+
+    'auto' picks the Gram matrix when it fits in `budget_mb` and the
+    embeddings have at least GRAM_MIN_DIMENSION dimensions. Asking for
+    'gram' when it does not fit raises ValueError.
+    """
+    if engine == 'direct':
+        return 'direct'
+    fits = gram_fits(vocab_size, budget_mb)
+    if engine == 'gram':
+        if not fits:
+            raise ValueError(f"The Gram matrix of {vocab_size} words needs {gram_bytes(vocab_size) / 2 ** 20:.0f} MiB, "
+                             f"more than the {budget_mb:g} MiB budget")
+        return 'gram'
+    return 'gram' if fits and dimension >= GRAM_MIN_DIMENSION else 'direct'
+
+
+def compute_gram(embedding_matrix: np.ndarray, block_rows: int = 4096) -> np.ndarray:
+    """E E^T in float64, a block of rows at a time."""
+    points = np.asarray(embedding_matrix, dtype=np.float64)
+    gram = np.empty((len(points), len(points)), dtype=np.float64)
+    for start in range(0, len(points), block_rows):
+        gram[start:start + block_rows] = points[start:start + block_rows] @ points.T
+    return gram
+
+
+def cached_gram(conn: sqlite3.Connection, table: str, gender: str, cache_directory: str,
+                embedding_matrix: np.ndarray, vocabulary: str) -> np.ndarray:
+    """
+    The Gram matrix through a memory-mapped file in the embedding cache.
+
+    Its sidecar is {table}.{gender}.{vocabulary}.gram.json. `vocabulary` is the vocab_fingerprint of the matrix's rows: the same
+    table restricted to other words, or in another order (as compare uses
+    it), has a Gram matrix of its own. Like
+    embeddingstore.cached_embedding_matrix, it is only rebuilt when the
+    table's version changes (see embeddingstore.save_cached_matrix).
+    """
+    sidecar_path = os.path.join(cache_directory, f"{table}.{gender}.{vocabulary[:16]}.gram.json")
+    version = table_version(conn, table, gender)
+    cached = load_cached_matrix(sidecar_path, version=version, vocabulary=vocabulary)
+    if cached is not None:
+        return cached[1]
+    return save_cached_matrix(sidecar_path, compute_gram(embedding_matrix), version=version, vocabulary=vocabulary)
+
+
+class GramEngine:
+    def __init__(self, embedding_matrix: np.ndarray, gram: Optional[np.ndarray] = None):
+        """
+        Distances to planes through triples of rows of `embedding_matrix`, from its Gram matrix.
+
+        Args:
+            embedding_matrix (np.ndarray): The (N, d) embeddings; only read for
+                the nearly degenerate triples measured directly
+            gram (np.ndarray): Their (N, N) float64 Gram matrix, computed here if not given
+        """
+        self.embedding_matrix = embedding_matrix
+        self.gram = compute_gram(embedding_matrix) if gram is None else gram
+        # The squared norms in float64, which is also what the direct fallback needs
+        self.diagonal = np.ascontiguousarray(np.diagonal(self.gram))
+
+    def triple_distances(self, triples: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        The same (valid, distances) as plane.triple_distances, in float64.
+
+        Args:
+            triples (np.ndarray): Integer row indices of shape (K, 3)
+        """
+        triples = np.asarray(triples)
+        o, b, c = triples[:, 0], triples[:, 1], triples[:, 2]
+        gram, diagonal = self.gram, self.diagonal
+        oo, bb, cc = diagonal[o], diagonal[b], diagonal[c]
+        ob, oc, bc = gram[o, b], gram[o, c], gram[b, c]
+        uu = bb - 2 * ob + oo
+        uv = bc - ob - oc + oo
+        vv = cc - 2 * oc + oo
+        # The diagonal of the R in u, v = QR, as PlaneBatch gets it
+        r00 = np.sqrt(np.maximum(uu, 0.0))
+        along = uv / np.where(r00 > 0, uu, 1)
+        r11 = np.sqrt(np.maximum(vv - uv * along, 0.0))
+        valid = (r00 >= 1e-10) & (r11 >= 1e-10)
+        separation = r11 / np.sqrt(np.where(vv > 0, vv, 1))
+
+        # Three (K, N) gathers, then everything in place: coordinates along each direction, then residuals
+        rows_o, coord1, coord2 = gram[o], gram[b], gram[c]
+        coord1 -= rows_o
+        coord1 += (oo - ob)[:, None]
+        coord2 -= rows_o
+        coord2 += (oo - oc)[:, None]
+        coord2 -= along[:, None] * coord1
+        coord2 /= np.where(valid, r11, 1)[:, None]
+        coord1 /= np.where(valid, r00, 1)[:, None]
+        residuals = rows_o
+        residuals *= -2
+        residuals += diagonal[None, :]
+        residuals += oo[:, None]
+        coord1 *= coord1
+        residuals -= coord1
+        coord2 *= coord2
+        residuals -= coord2
+        # Rounding can push points lying on the plane very slightly negative
+        distances = np.sqrt(np.maximum(residuals, 0.0, out=residuals), out=residuals)
+        np.put_along_axis(distances, triples, np.nan, axis=1)
+
+        unstable = np.flatnonzero(separation < GRAM_MIN_SEPARATION)
+        if len(unstable):
+            exact = PlaneBatch.from_indices(self.embedding_matrix, triples[unstable], dtype=np.float64)
+            distances[unstable] = exact.distances_to_planes(self.embedding_matrix, diagonal,
+                                                            exclude=triples[unstable])
+            valid = valid.copy()
+            valid[unstable] = exact.valid
+        return valid, distances
@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+
+"""
+Find the words nearest to a plane without measuring the distance to every word.
+
+    python planeindex.py --words kind gentle cruel -k 20
+
+The embeddings are projected once onto a low-rank orthonormal basis (the top
+principal components, or a random one). Projection onto a subspace never
+increases distances, so the distance from a projected word to the projected
+plane is a lower bound on its true distance. Queries rank the whole vocabulary
+by that cheap bound and re-rank the best candidates with the exact Plane
+residual.
+"""
+
+import argparse
+import sqlite3
+from typing import Optional, Sequence, Tuple
+
+import numpy as np
+
+from embeddingstore import load_embedding_matrix
+from plane import Plane
+
+
+def nearest_to_plane(points: np.ndarray, plane: Plane, k: int,
+                     exclude: Sequence[int] = ()) -> Tuple[np.ndarray, np.ndarray]:
+    """The exact k nearest rows to a plane by a full scan: (indices, distances), nearest first."""
+    distances = plane.distances_to_plane(points)
+    distances[list(exclude)] = np.inf
+    return _smallest(np.arange(len(points)), distances, k)
+
+
+def _smallest(indices: np.ndarray, distances: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """The k entries with the smallest distances, sorted, leaving out excluded (infinite) ones."""
+    k = min(k, np.count_nonzero(np.isfinite(distances)))
+    best = np.argpartition(distances, k - 1)[:k] if 0 < k < len(distances) else np.arange(k)
+    best = best[np.argsort(distances[best], kind='stable')]
+    return indices[best], distances[best]
+
+
+class PlaneIndex:
+    def __init__(self, points: np.ndarray, rank: int = 64, method: str = 'pca', seed: int = 0):
+        """
+        Precompute the low-rank projection of an (N, d) embedding matrix.
+
+        Args:
+            points (np.ndarray): Matrix of shape (N, d), one word per row
+            rank (int): Dimension of the projection
+            method (str): 'pca' projects onto the top principal components,
+                'random' onto a random orthonormal basis
+            seed (int): Seed for the random basis
+        """
+        self.points = points
+        rank = min(rank, points.shape[1])
+        self.mean = points.mean(axis=0)
+        centred = points - self.mean
+        if method == 'pca':
+            # Eigenvectors of the d x d covariance: much cheaper than an SVD of the N x d matrix
+            _, eigenvectors = np.linalg.eigh(centred.T @ centred)
+            self.basis = eigenvectors[:, ::-1][:, :rank].T
+        elif method == 'random':
+            gaussian = np.random.default_rng(seed).normal(size=(points.shape[1], rank))
+            self.basis = np.linalg.qr(gaussian)[0].T
+        else:
+            raise ValueError(f"Unknown projection method {method!r}")
+        self.reduced = centred @ self.basis.T
+        self.reduced_norms = np.einsum('ij,ij->i', self.reduced, self.reduced)
+
+    def __len__(self) -> int:
+        return len(self.points)
+
+    def lower_bounds(self, plane: Plane) -> np.ndarray:
+        """
+        A lower bound on the distance from every row to the plane.
+
+        This is the exact distance between the projections, computed in the
+        reduced space. The projected points can be (nearly) collinear even
+        when the originals are not; the plane then projects to a line, which
+        is what the bound is measured against.
+        """
+        reduced = (np.vstack([plane.origin, plane.origin + plane.direction1, plane.origin + plane.direction2])
+                   - self.mean) @ self.basis.T
+        origin = reduced[0]
+        u, s, _ = np.linalg.svd((reduced[1:] - origin).T, full_matrices=False)
+        directions = u[:, s > 1e-10 * max(s.max(), 1.0)]
+        products = self.reduced @ np.column_stack([directions, origin])
+        along = products[:, :-1] - origin @ directions
+        residuals = (self.reduced_norms - 2 * products[:, -1] + origin @ origin
+                     - np.einsum('ij,ij->i', along, along))
+        return np.sqrt(np.maximum(residuals, 0.0))
+
+    def query(self, plane: Plane, k: int = 10, candidates: Optional[int] = 200, exclude: Sequence[int] = (),
+              exact: bool = False) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        The k rows nearest to `plane`.
+
+        The `candidates` rows with the smallest lower bounds are re-ranked
+        exactly; candidates=None bypasses the index and scans every row. With
+        exact=True, every other row whose lower bound does not rule it out is
+        measured too, so the answer is the same as a full scan.
+
+        Returns:
+            tuple: (indices, distances), nearest first
+        """
+        if candidates is None:
+            return nearest_to_plane(self.points, plane, k, exclude)
+        bounds = self.lower_bounds(plane)
+        bounds[list(exclude)] = np.inf
+        count = min(max(candidates, k), np.count_nonzero(np.isfinite(bounds)))
+        chosen = np.argpartition(bounds, count - 1)[:count] if count < len(bounds) else np.arange(count)
+        chosen = chosen[np.isfinite(bounds[chosen])]
+        distances = plane.distances_to_plane(self.points[chosen])
+        indices, distances = _smallest(chosen, distances, k)
+        if exact and len(distances) == k:
+            # Anything that could beat the current k-th best has a bound no larger than it
+            # (give or take rounding, which matters for words lying almost on the plane)
+            bounds[chosen] = np.inf
+            remaining = np.flatnonzero(bounds <= distances[-1] + 1e-6)
+            if len(remaining):
+                extra = plane.distances_to_plane(self.points[remaining])
+                indices, distances = _smallest(np.concatenate([indices, remaining]),
+                                               np.concatenate([distances, extra]), k)
+        return indices, distances
+
+    def query_points(self, point1: np.ndarray, point2: np.ndarray, point3: np.ndarray,
+                     **kwargs) -> Tuple[np.ndarray, np.ndarray]:
+        """query() for the plane through three points."""
+        return self.query(Plane(point1, point2, point3, lightweight=True), **kwargs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='List the words nearest to the plane through three words.')
+    parser.add_argument('--database', default='personality_adjectives.sqlite')
+    parser.add_argument('--embedding-provider', default='openai')
+    parser.add_argument('--gender', default='male')
+    parser.add_argument('--words', nargs=3, required=True)
+    parser.add_argument('-k', type=int, default=10)
+    parser.add_argument('--rank', type=int, default=64)
+    parser.add_argument('--method', choices=['pca', 'random'], default='pca')
+    parser.add_argument('--candidates', type=int, default=200,
+                        help='Words re-ranked exactly after the low-rank filter')
+    parser.add_argument('--exact', action='store_true',
+                        help='Also measure every word the filter cannot rule out')
+    parser.add_argument('--full-scan', action='store_true', help='Bypass the index')
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(args.database)
+    vocab, matrix = load_embedding_matrix(conn, f"{args.embedding_provider}_embeddings", args.gender)
+    conn.close()
+    positions = {word: i for i, word in enumerate(vocab)}
+    missing = [word for word in args.words if word not in positions]
+    if missing:
+        parser.error(f"Not in the {args.embedding_provider} {args.gender} vocabulary: {', '.join(missing)}")
+    triple = [positions[word] for word in args.words]
+
+    if args.full_scan:
+        plane = Plane(*matrix[triple], lightweight=True)
+        indices, distances = nearest_to_plane(matrix, plane, args.k, exclude=triple)
+    else:
+        index = PlaneIndex(matrix, args.rank, args.method)
+        indices, distances = index.query_points(*matrix[triple], k=args.k, candidates=args.candidates,
+                                                exclude=triple, exact=args.exact)
+    for i, distance in zip(indices, distances):
+        print(f"{distance:.6f} {vocab[i]}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+
+"""
+Look for the most planar triples directly instead of sampling them at random.
+
+A beam of the best triples found so far is improved by swapping one word of
+a triple at a time. The words tried as replacements are the ones closest to
+that triple's plane (which keeps the new plane near a good one) plus a few
+random words (which keeps the search from settling too early). All the
+swaps of a round are measured together with triple_distances.
+
+Before that, a swap is skipped if it provably cannot make the beam: in the
+low-rank projection of planeindex.PlaneIndex every word-to-plane distance
+is a lower bound on the real one, so every order statistic and the mean of
+the projected distances bound the real ones from below as well.
+
+The search starts from triples spread along the top principal directions:
+a word near the centroid and words far out along the first and second
+components, the three points that best approximate the best-fitting plane.
+"""
+
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from plane import PlaneBatch, triple_distances
+from planeindex import PlaneIndex
+from planestats import batch_statistics
+from triples import pack_triples
+
+# planar_statistics columns the search can minimise. They are all means or order statistics of the
+# distances, which is what makes the projected lower bounds apply.
+SEARCH_OBJECTIVES = ['how_close', 'mean_distance', 'mili', 'percentile1', 'percentile25', 'percentile50',
+                     'percentile75', 'percentile99', 'furthest']
+
+
+def principal_seeds(index: PlaneIndex, count: int, rng: np.random.Generator) -> np.ndarray:
+    """
+    Up to `count` starting triples: one word near the centroid and one far
+    out along each of the first two principal components.
+    """
+    per_role = int(np.ceil(count ** (1 / 3))) + 1
+    centre = np.argsort(index.reduced_norms)[:per_role]
+    along1 = np.argsort(-np.abs(index.reduced[:, 0]))[:per_role]
+    along2 = np.argsort(-np.abs(index.reduced[:, 1]))[:per_role]
+    triples = np.array(np.meshgrid(centre, along1, along2)).reshape(3, -1).T
+    triples = np.sort(triples, axis=1)
+    distinct = (triples[:, 0] != triples[:, 1]) & (triples[:, 1] != triples[:, 2])
+    triples = np.unique(triples[distinct], axis=0)
+    return triples[rng.permutation(len(triples))[:count]]
+
+
+def random_triples(vocab_size: int, count: int, rng: np.random.Generator) -> np.ndarray:
+    return np.sort(np.array([rng.choice(vocab_size, 3, replace=False) for _ in range(count)],
+                            dtype=np.int64).reshape(-1, 3), axis=1)
+
+
+class BeamSearch:
+    def __init__(self, points: np.ndarray, objective: str = 'mean_distance', beam_width: int = 16,
+                 swap_candidates: int = 24, random_candidates: int = 8, rank: int = 64, seed: int = 0,
+                 row_norms: Optional[np.ndarray] = None, float64_row_norms: Optional[np.ndarray] = None,
+                 distances: Optional[Callable[[np.ndarray], Tuple[np.ndarray, np.ndarray]]] = None):
+        """
+        Beam search over triples of rows of `points` for the lowest `objective`.
+
+        Args:
+            points (np.ndarray): The (N, d) embedding matrix
+            objective (str): The planar_statistics column to minimise (one of SEARCH_OBJECTIVES)
+            beam_width (int): Triples kept and improved each round
+            swap_candidates (int): Words nearest each triple's plane tried as replacements
+            random_candidates (int): Random words also tried as replacements
+            rank (int): Dimension of the projection used to prune swaps (0 disables pruning)
+            seed (int): Seed for the starting triples and the random replacements
+            row_norms, float64_row_norms: As for triple_distances
+            distances: Measures a batch of triples instead of triple_distances
+                (e.g. planegram.GramEngine.triple_distances)
+        """
+        if objective not in SEARCH_OBJECTIVES:
+            raise ValueError(f"Cannot search on {objective}; choose one of {', '.join(SEARCH_OBJECTIVES)}")
+        self.points = points
+        self.objective = objective
+        self.beam_width = beam_width
+        self.swap_candidates = swap_candidates
+        self.random_candidates = random_candidates
+        self.rng = np.random.default_rng(seed)
+        self.row_norms = row_norms
+        self.float64_row_norms = float64_row_norms
+        self.distances = distances
+        self.index = PlaneIndex(np.asarray(points, dtype=np.float64), rank) if rank else None
+        # The beam: (score, triple) pairs, best first
+        self.beam: List[Tuple[float, Tuple[int, int, int]]] = []
+        # Scores of every triple measured so far (by packed triple), and each beam triple's nearest words
+        self.scores: Dict[int, float] = {}
+        self.nearest: Dict[Tuple[int, int, int], np.ndarray] = {}
+        self.pending = np.empty((0, 3), dtype=np.int64)
+        self.pending_bounds = np.empty(0)
+        self.evaluated = 0
+        self.pruned = 0
+
+    def start(self, triples: Optional[np.ndarray] = None, count: int = 64) -> None:
+        """Queue the starting triples: those given (e.g. the best already stored) and `count` principal seeds."""
+        seeds = [np.asarray(triples, dtype=np.int64).reshape(-1, 3)] if triples is not None else []
+        if self.index is not None:
+            seeds.append(principal_seeds(self.index, count, self.rng))
+        else:
+            seeds.append(random_triples(len(self.points), count, self.rng))
+        self._queue(np.concatenate(seeds))
+
+    @property
+    def best(self) -> Optional[Tuple[float, Tuple[int, int, int]]]:
+        return self.beam[0] if self.beam else None
+
+    def _cutoff(self) -> float:
+        """The score a triple has to beat to get into the beam."""
+        return self.beam[-1][0] if len(self.beam) >= self.beam_width else np.inf
+
+    def proposals(self) -> np.ndarray:
+        """Every one-word swap of every beam triple that has not been measured yet."""
+        vocab_size = len(self.points)
+        proposed = []
+        for _, triple in self.beam:
+            replacements = np.concatenate([self.nearest[triple],
+                                           self.rng.integers(vocab_size, size=self.random_candidates)])
+            for position in range(3):
+                kept = [triple[i] for i in range(3) if i != position]
+                swapped = np.column_stack([np.full((len(replacements), 2), kept), replacements])
+                proposed.append(swapped)
+        if not proposed:
+            return np.empty((0, 3), dtype=np.int64)
+        proposed = np.sort(np.concatenate(proposed), axis=1)
+        proposed = proposed[(proposed[:, 0] != proposed[:, 1]) & (proposed[:, 1] != proposed[:, 2])]
+        proposed = np.unique(proposed, axis=0)
+        packed = pack_triples(proposed, vocab_size)
+        return proposed[np.array([key not in self.scores for key in packed], dtype=bool).reshape(-1)]
+
+    def lower_bounds(self, triples: np.ndarray) -> np.ndarray:
+        """A lower bound on each triple's objective, from the projected distances (0 where it is degenerate)."""
+        reduced = self.index.reduced
+        planes = PlaneBatch.from_indices(reduced, triples)
+        bounds = planes.distances_to_planes(reduced, self.index.reduced_norms, exclude=triples)
+        # Leave room for rounding: the bound must never exceed the value it bounds
+        values = batch_statistics(bounds)[self.objective] - 1e-6
+        return np.where(planes.valid, values, 0.0)
+
+    def _queue(self, triples: np.ndarray) -> None:
+        """Queue the triples not measured yet, most promising (lowest lower bound) first."""
+        triples = np.unique(np.sort(np.asarray(triples, dtype=np.int64).reshape(-1, 3), axis=1), axis=0)
+        packed = pack_triples(triples, len(self.points))
+        triples = triples[np.array([int(key) not in self.scores for key in packed], dtype=bool).reshape(-1)]
+        bounds = self.lower_bounds(triples) if self.index is not None and len(triples) else np.zeros(len(triples))
+        order = np.argsort(bounds, kind='stable')
+        self.pending = np.concatenate([self.pending, triples[order]])
+        self.pending_bounds = np.concatenate([self.pending_bounds, bounds[order]])
+
+    def _prune(self) -> None:
+        """Drop queued triples whose lower bound shows they cannot make the beam any more."""
+        keep = self.pending_bounds < self._cutoff()
+        self.pruned += np.count_nonzero(~keep)
+        # The cutoff only ever falls, so a pruned triple never needs trying again
+        for key in pack_triples(self.pending[~keep], len(self.points)):
+            self.scores[int(key)] = np.inf
+        self.pending, self.pending_bounds = self.pending[keep], self.pending_bounds[keep]
+
+    def _update(self, triples: np.ndarray, valid: np.ndarray, distances: np.ndarray,
+                stats: Dict[str, np.ndarray]) -> None:
+        scores = np.where(valid, stats[self.objective], np.inf)
+        for key, score in zip(pack_triples(triples, len(self.points)), scores):
+            self.scores[int(key)] = float(score)
+        beam = dict((triple, score) for score, triple in self.beam)
+        for triple, score, row in zip(map(tuple, triples.tolist()), scores, distances):
+            if not np.isfinite(score) or score >= self._cutoff() or triple in beam:
+                continue
+            beam[triple] = float(score)
+            ranked = np.where(np.isnan(row), np.inf, row)
+            # Only words outside the triple (its own three are NaN, ranked last) are candidates
+            count = min(self.swap_candidates, len(ranked) - 3)
+            self.nearest[triple] = np.argpartition(ranked, count)[:count]
+            self.beam = sorted(((s, t) for t, s in beam.items()))[:self.beam_width]
+            beam = dict((t, s) for s, t in self.beam)
+        for triple in set(self.nearest) - set(beam):
+            del self.nearest[triple]
+
+    def step(self, batch_size: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray, Dict[str, np.ndarray]]:
+        """
+        Measure the next batch of up to `batch_size` triples and update the beam.
+
+        Queued triples are measured in order of their lower bounds. When
+        every neighbour of the beam has been measured or ruled out, random
+        triples are tried; a step only comes back empty when even those are
+        ruled out, i.e. the search has converged.
+
+        Returns:
+            tuple: (triples, valid, distances, stats) as the finder computes them
+        """
+        for _ in range(3):
+            if len(self.pending) == 0:
+                self._queue(self.proposals())
+            self._prune()
+            if len(self.pending):
+                break
+            # Every swap has been measured or ruled out, so try somewhere new
+            self._queue(random_triples(len(self.points), batch_size, self.rng))
+        batch, self.pending = self.pending[:batch_size], self.pending[batch_size:]
+        self.pending_bounds = self.pending_bounds[batch_size:]
+        if len(batch) == 0:
+            return batch, np.zeros(0, dtype=bool), np.empty((0, len(self.points))), {}
+        if self.distances is not None:
+            valid, distances = self.distances(batch)
+        else:
+            valid, distances = triple_distances(self.points, batch, self.row_norms, self.float64_row_norms)
+        stats = batch_statistics(distances)
+        self.evaluated += len(batch)
+        self._update(batch, valid, distances, stats)
+        return batch, valid, distances, stats
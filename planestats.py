@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+
+from typing import Dict
+
+import numpy as np
+
+# Percentiles stored in planar_statistics as mili, percentile1 .. percentile99
+PERCENTILES = [0.1, 1, 25, 50, 75, 99]
+
+
+def batch_statistics(distances: np.ndarray) -> Dict[str, np.ndarray]:
+    """
+    Summarise each row of a (K, N) distance matrix as planar_statistics columns.
+
+    NaN entries (the words defining each plane) are ignored. The results match
+    what pandas and np.percentile give for a single row: sample standard
+    deviation and linearly interpolated percentiles. They are always float64,
+    with the mean and standard deviation accumulated in float64, whatever the
+    precision of the distances.
+
+    Args:
+        distances (np.ndarray): Matrix of shape (K, N), NaN where excluded
+
+    Returns:
+        dict: Column name to array of K values; closest_index holds the
+        index of the closest word rather than the word itself
+    """
+    # np.sort puts NaN last, so each row's valid values form a sorted prefix
+    ordered = np.sort(distances, axis=1)
+    counts = np.count_nonzero(~np.isnan(distances), axis=1)
+    rows = np.arange(len(distances))
+    result = {
+        'closest_index': np.nanargmin(distances, axis=1),
+        'how_close': ordered[:, 0].astype(np.float64),
+        'mean_distance': np.nanmean(distances, axis=1, dtype=np.float64),
+        'stddev_distance': np.nanstd(distances, axis=1, ddof=1, dtype=np.float64),
+        'furthest': ordered[rows, counts - 1].astype(np.float64),
+    }
+    columns = ['mili', 'percentile1', 'percentile25', 'percentile50', 'percentile75', 'percentile99']
+    for column, q in zip(columns, PERCENTILES):
+        position = q / 100 * (counts - 1)
+        lower = np.floor(position).astype(int)
+        upper = np.minimum(lower + 1, counts - 1)
+        fraction = position - lower
+        result[column] = (ordered[rows, lower].astype(np.float64) * (1 - fraction)
+                          + ordered[rows, upper] * fraction)
+    return result
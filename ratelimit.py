@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+
+import asyncio
+import random
+import time
+from typing import Awaitable, Callable, Optional, Tuple, Type, TypeVar
+
+T = TypeVar('T')
+
+
+class TokenBucket:
+    def __init__(self, rate: Optional[float], capacity: Optional[float] = None):
+        """
+        Asynchronous token-bucket rate limiter.
+
+        Args:
+            rate (float): Tokens added per second; None means no limit
+            capacity (float): Largest burst allowed; defaults to one second's worth
+        """
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate or 1.0)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, tokens: float = 1.0) -> None:
+        """Wait until `tokens` are available and take them."""
+        if self.rate is None:
+            return
+        async with self.lock:
+            while True:
+                self._refill()
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                await asyncio.sleep((tokens - self.tokens) / self.rate)
+
+
+async def retry_with_backoff(call: Callable[[], Awaitable[T]], retry_on: Tuple[Type[BaseException], ...],
+                             attempts: int = 5, base_delay: float = 1.0, max_delay: float = 60.0,
+                             throttled_on: Tuple[Type[BaseException], ...] = (),
+                             throttled_attempts: int = 20) -> T:
+    """
+    Await call(), retrying on the given exceptions with exponential backoff and jitter.
+
+    The last exception is re-raised once `attempts` calls have failed.
+    `throttled_on` are the exceptions by which the server asks for less
+    traffic (HTTP 429). Requests in flight together run into them together,
+    while the caller's rate limiter catches up, so they have a budget of
+    their own, `throttled_attempts`, and do not use up `attempts`.
+    """
+    failures = {False: 0, True: 0}
+    while True:
+        try:
+            return await call()
+        except throttled_on + retry_on as e:
+            throttled = isinstance(e, throttled_on)
+            failures[throttled] += 1
+            if failures[throttled] >= (throttled_attempts if throttled else attempts):
+                raise
+            delay = min(max_delay, base_delay * 2 ** (failures[throttled] - 1)) * (0.5 + random.random())
+            print(f"{type(e).__name__}: {e} -- retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+
+class AdaptiveTokenBucket(TokenBucket):
+    def __init__(self, rate: float, min_rate: float = 0.1, max_rate: float = 50.0, increase: float = 0.1,
+                 cooldown: float = 5.0):
+        """
+        Token bucket whose rate adapts to the server: additive increase, multiplicative decrease.
+
+        Call succeeded() after each successful request and throttled() when
+        the server says to slow down (HTTP 429 or similar). Several requests in
+        flight usually hit the same limit together, so the rate is halved at
+        most once per `cooldown` seconds.
+        """
+        super().__init__(rate)
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.cooldown = cooldown
+        self.last_decrease = float('-inf')
+
+    def succeeded(self) -> None:
+        self.rate = min(self.max_rate, self.rate + self.increase)
+        self.capacity = max(1.0, self.rate)
+
+    def throttled(self) -> None:
+        now = time.monotonic()
+        if now - self.last_decrease < self.cooldown:
+            return
+        self.last_decrease = now
+        self.rate = max(self.min_rate, self.rate / 2)
+        self.capacity = max(1.0, self.rate)
+        self.tokens = min(self.tokens, 0.0)
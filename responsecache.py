@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+
+import argparse
+import hashlib
+import json
+import sqlite3
+import time
+from typing import Any, Dict, List, Optional
+
+
+def cache_key(provider: str, model: str, request: Any) -> str:
+    """Content address of one request: a hash of the provider, the model and the exact input."""
+    canonical = json.dumps([provider, model, request], sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+    def __init__(self, path: str, max_bytes: int = 1 << 30):
+        """
+        On-disk cache of API responses, shared by every script and database.
+
+        Entries are keyed by cache_key(provider, model, request) and hold the
+        response as bytes. When the stored responses exceed `max_bytes`, the
+        least recently used entries are evicted.
+
+        Args:
+            path (str): SQLite file holding the cache
+            max_bytes (int): Size bound on the stored responses
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                provider TEXT NOT NULL,
+                model TEXT NOT NULL,
+                response BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                hits INTEGER NOT NULL DEFAULT 0,
+                created REAL NOT NULL,
+                last_used REAL NOT NULL
+            )
+        ''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)')
+        self.conn.commit()
+        # Running estimate of the stored size; only recomputed exactly when it passes max_bytes
+        self.total_bytes = self.size()['bytes']
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_many(self, provider: str, model: str, requests: List[Any]) -> List[Optional[bytes]]:
+        """The cached response for each request, or None where there is none."""
+        keys = [cache_key(provider, model, request) for request in requests]
+        found = {}
+        # Stay well below SQLite's limit on bound parameters
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            found.update(self.conn.execute(
+                f"SELECT key, response FROM responses WHERE key IN ({','.join('?' * len(chunk))})", chunk))
+        if found:
+            with self.conn:
+                self.conn.executemany('UPDATE responses SET hits = hits + 1, last_used = ? WHERE key = ?',
+                                      [(time.time(), key) for key in found])
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return [found.get(key) for key in keys]
+
+    def get(self, provider: str, model: str, request: Any) -> Optional[bytes]:
+        return self.get_many(provider, model, [request])[0]
+
+    def put_many(self, provider: str, model: str, requests: List[Any], responses: List[bytes]) -> None:
+        """Store one response per request, then evict down to max_bytes."""
+        now = time.time()
+        with self.conn:
+            self.conn.executemany('''
+                INSERT OR REPLACE INTO responses (key, provider, model, response, size, created, last_used)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', [(cache_key(provider, model, request), provider, model, response, len(response), now, now)
+                  for request, response in zip(requests, responses)])
+            self.total_bytes += sum(len(response) for response in responses)
+            if self.total_bytes > self.max_bytes:
+                self._evict()
+
+    def put(self, provider: str, model: str, request: Any, response: bytes) -> None:
+        self.put_many(provider, model, [request], [response])
+
+    def get_json(self, provider: str, model: str, request: Any) -> Any:
+        response = self.get(provider, model, request)
+        return None if response is None else json.loads(response)
+
+    def put_json(self, provider: str, model: str, request: Any, response: Any) -> None:
+        self.put(provider, model, request, json.dumps(response).encode('utf-8'))
+
+    def _evict(self) -> None:
+        total = self.conn.execute('SELECT coalesce(sum(size), 0) FROM responses').fetchone()[0]
+        victims = []
+        for key, size in self.conn.execute('SELECT key, size FROM responses ORDER BY last_used'):
+            if total <= self.max_bytes:
+                break
+            victims.append((key,))
+            total -= size
+        self.conn.executemany('DELETE FROM responses WHERE key = ?', victims)
+        self.evictions += len(victims)
+        self.total_bytes = total
+
+    def size(self) -> Dict[str, int]:
+        entries, total = self.conn.execute('SELECT count(*), coalesce(sum(size), 0) FROM responses').fetchone()
+        return {'entries': entries, 'bytes': total}
+
+    def summary(self) -> str:
+        lookups = self.hits + self.misses
+        rate = self.hits / lookups if lookups else 0.0
+        return (f"Response cache {self.path}: {self.hits} hits, {self.misses} misses ({rate:.0%} hit rate), "
+                f"{self.evictions} evicted")
+
+    def close(self) -> None:
+        self.conn.close()
+
+
+def add_cache_arguments(parser: argparse.ArgumentParser) -> None:
+    """The options every script that calls a remote API takes for its response cache."""
+    parser.add_argument("--response-cache", default="api_responses.sqlite",
+                        help="Cache of API responses, consulted before every network call")
+    parser.add_argument("--response-cache-mb", type=float, default=1024,
+                        help="Evict least recently used responses beyond this size")
+    parser.add_argument("--no-response-cache", action="store_true", help="Always call the API")
+
+
+def open_cache(args: argparse.Namespace) -> Optional[ResponseCache]:
+    if args.no_response_cache:
+        return None
+    return ResponseCache(args.response_cache, int(args.response_cache_mb * 1024 * 1024))
+
+
+def stats(args: argparse.Namespace) -> None:
+    cache = ResponseCache(args.response_cache)
+    size = cache.size()
+    print(f"{cache.path}: {size['entries']} entries, {size['bytes'] / 1e6:.1f} MB")
+    for provider, model, entries, total, hits in cache.conn.execute('''
+            SELECT provider, model, count(*), sum(size), sum(hits) FROM responses
+            GROUP BY provider, model ORDER BY provider, model'''):
+        print(f"  {provider} {model}: {entries} entries, {total / 1e6:.1f} MB, {hits} hits")
+    cache.close()
+
+
+def clear(args: argparse.Namespace) -> None:
+    cache = ResponseCache(args.response_cache)
+    with cache.conn:
+        if args.provider:
+            deleted = cache.conn.execute('DELETE FROM responses WHERE provider = ?', [args.provider]).rowcount
+        else:
+            deleted = cache.conn.execute('DELETE FROM responses').rowcount
+    cache.conn.execute('VACUUM')
+    print(f"Deleted {deleted} responses")
+    cache.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Inspect or clear the API response cache.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    stats_parser = subparsers.add_parser('stats', help='Entries, size and hits per provider and model')
+    stats_parser.add_argument('--response-cache', default='api_responses.sqlite')
+    stats_parser.set_defaults(func=stats)
+    clear_parser = subparsers.add_parser('clear', help='Delete cached responses')
+    clear_parser.add_argument('--response-cache', default='api_responses.sqlite')
+    clear_parser.add_argument('--provider', help='Only delete this provider\'s responses')
+    clear_parser.set_defaults(func=clear)
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
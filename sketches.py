@@ -0,0 +1,316 @@
+#!/usr/bin/env python3
+
+"""
+Mergeable summaries of every distance and every plane a search has produced.
+
+    python sketches.py show --embedding-provider openai --gender male
+
+Each (gender, provider) keeps one QuantileSketch and one Moments for the
+distances from all words to all planes evaluated so far, and one of each for
+every planar_statistics column (so the distribution of, say, how_close over
+all planes). They live in the statistics_sketches table, are saved in the
+same transaction as the rows they summarise, and can be merged across worker
+processes and runs.
+"""
+
+import argparse
+import json
+import sqlite3
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+# The planar_statistics columns summarised across planes
+PLANE_COLUMNS = ['how_close', 'mean_distance', 'stddev_distance', 'mili', 'percentile1', 'percentile25',
+                 'percentile50', 'percentile75', 'percentile99', 'furthest']
+
+
+class Moments:
+    def __init__(self, count: int = 0, mean: float = 0.0, m2: float = 0.0,
+                 minimum: float = np.inf, maximum: float = -np.inf):
+        """
+        Count, mean, variance, minimum and maximum of a stream of values.
+
+        Batches are folded in with Chan et al.'s pairwise form of Welford's
+        update, which is also how two Moments merge.
+        """
+        self.count = count
+        self.mean = mean
+        self.m2 = m2
+        self.minimum = minimum
+        self.maximum = maximum
+
+    def update(self, values: np.ndarray) -> None:
+        values = np.asarray(values, dtype=np.float64).ravel()
+        values = values[np.isfinite(values)]
+        if len(values):
+            mean = values.mean()
+            self.merge(Moments(len(values), mean, float(((values - mean) ** 2).sum()),
+                               values.min(), values.max()))
+
+    def merge(self, other: "Moments") -> None:
+        if other.count == 0:
+            return
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta * delta * self.count * other.count / count
+        self.count = count
+        self.minimum = min(self.minimum, other.minimum)
+        self.maximum = max(self.maximum, other.maximum)
+
+    @property
+    def variance(self) -> float:
+        """Sample variance (ddof=1), like the stddev_distance column."""
+        return self.m2 / (self.count - 1) if self.count > 1 else float('nan')
+
+    @property
+    def stddev(self) -> float:
+        return float(np.sqrt(self.variance))
+
+    def to_dict(self) -> Dict:
+        return {'count': self.count, 'mean': self.mean, 'm2': self.m2,
+                'minimum': None if self.count == 0 else self.minimum,
+                'maximum': None if self.count == 0 else self.maximum}
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> "Moments":
+        if data['count'] == 0:
+            return cls()
+        return cls(data['count'], data['mean'], data['m2'], data['minimum'], data['maximum'])
+
+
+class QuantileSketch:
+    def __init__(self, relative_accuracy: float = 0.01, min_value: float = 1e-9):
+        """
+        A DDSketch: a histogram with logarithmically spaced buckets.
+
+        Any quantile it reports is within `relative_accuracy` of a value at
+        that rank. Merging adds bucket counts, so it gives the same sketch
+        whichever way a stream was split up. Values at or below `min_value`
+        are counted in a separate zero bucket.
+        """
+        self.relative_accuracy = relative_accuracy
+        self.min_value = min_value
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = np.log(self.gamma)
+        self.offset = 0
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.zero_count = 0
+
+    @property
+    def count(self) -> int:
+        return int(self.counts.sum()) + self.zero_count
+
+    def _add_buckets(self, offset: int, counts: np.ndarray) -> None:
+        if len(counts) == 0:
+            return
+        if len(self.counts) == 0:
+            self.offset, self.counts = offset, counts.astype(np.int64).copy()
+            return
+        low = min(self.offset, offset)
+        high = max(self.offset + len(self.counts), offset + len(counts))
+        merged = np.zeros(high - low, dtype=np.int64)
+        merged[self.offset - low:self.offset - low + len(self.counts)] += self.counts
+        merged[offset - low:offset - low + len(counts)] += counts
+        self.offset, self.counts = low, merged
+
+    def update(self, values: np.ndarray) -> None:
+        """Add every finite value of an array (NaN entries are ignored)."""
+        values = np.asarray(values, dtype=np.float64).ravel()
+        values = values[np.isfinite(values)]
+        small = values <= self.min_value
+        self.zero_count += int(np.count_nonzero(small))
+        values = values[~small]
+        if len(values):
+            buckets = np.ceil(np.log(values) / self.log_gamma).astype(np.int64)
+            low = int(buckets.min())
+            self._add_buckets(low, np.bincount(buckets - low))
+
+    def merge(self, other: "QuantileSketch") -> None:
+        if other.gamma != self.gamma:
+            raise ValueError("Only sketches with the same relative accuracy can be merged")
+        self.zero_count += other.zero_count
+        self._add_buckets(other.offset, other.counts)
+
+    def bucket_values(self) -> np.ndarray:
+        """The value each bucket stands for, the one within relative_accuracy of all its members."""
+        indices = self.offset + np.arange(len(self.counts))
+        return 2 * self.gamma ** indices / (self.gamma + 1)
+
+    def quantile(self, q: float) -> float:
+        """The q-quantile, 0 <= q <= 1, of everything added so far (NaN if nothing was)."""
+        count = self.count
+        if count == 0:
+            return float('nan')
+        rank = q * (count - 1)
+        if rank < self.zero_count:
+            return 0.0
+        bucket = int(np.searchsorted(np.cumsum(self.counts), rank - self.zero_count, side='right'))
+        return float(self.bucket_values()[min(bucket, len(self.counts) - 1)])
+
+    def histogram(self) -> Tuple[np.ndarray, np.ndarray]:
+        """(edges, counts) of the non-empty range of buckets, ready for matplotlib's stairs()."""
+        indices = self.offset + np.arange(len(self.counts) + 1) - 1
+        return self.gamma ** indices, self.counts.copy()
+
+    def to_dict(self) -> Dict:
+        return {'relative_accuracy': self.relative_accuracy, 'min_value': self.min_value,
+                'offset': self.offset, 'counts': self.counts.tolist(), 'zero_count': self.zero_count}
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> "QuantileSketch":
+        sketch = cls(data['relative_accuracy'], data['min_value'])
+        sketch.offset = data['offset']
+        sketch.counts = np.array(data['counts'], dtype=np.int64)
+        sketch.zero_count = data['zero_count']
+        return sketch
+
+
+class Summary:
+    def __init__(self, relative_accuracy: float = 0.01):
+        """A QuantileSketch and Moments of the same stream."""
+        self.sketch = QuantileSketch(relative_accuracy)
+        self.moments = Moments()
+
+    def update(self, values: np.ndarray) -> None:
+        self.sketch.update(values)
+        self.moments.update(values)
+
+    def merge(self, other: "Summary") -> None:
+        self.sketch.merge(other.sketch)
+        self.moments.merge(other.moments)
+
+    def to_dict(self) -> Dict:
+        return {'sketch': self.sketch.to_dict(), 'moments': self.moments.to_dict()}
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> "Summary":
+        summary = cls()
+        summary.sketch = QuantileSketch.from_dict(data['sketch'])
+        summary.moments = Moments.from_dict(data['moments'])
+        return summary
+
+
+class PlaneSketches:
+    def __init__(self):
+        """
+        Summaries for one (gender, provider): 'distances' covers every word's
+        distance to every plane, and one per PLANE_COLUMNS entry covers that
+        column over all planes.
+        """
+        self.summaries = {name: Summary() for name in ['distances'] + PLANE_COLUMNS}
+
+    def add_distances(self, distances: np.ndarray) -> None:
+        """Add a (K, N) distance matrix; NaN entries, the words defining each plane, are skipped."""
+        self.summaries['distances'].update(distances)
+
+    def add_statistics(self, stats: Dict[str, np.ndarray], rows: Optional[np.ndarray] = None) -> None:
+        """Add the planar_statistics columns of a batch_statistics result, optionally only some rows."""
+        for column in PLANE_COLUMNS:
+            values = np.asarray(stats[column])
+            self.summaries[column].update(values if rows is None else values[rows])
+
+    def merge(self, other: "PlaneSketches") -> None:
+        for name, summary in other.summaries.items():
+            self.summaries[name].merge(summary)
+
+    def __getitem__(self, name: str) -> Summary:
+        return self.summaries[name]
+
+
+def create_sketch_table(cursor: sqlite3.Cursor) -> None:
+    cursor.execute("""create table if not exists statistics_sketches (
+      gender text,
+      embedding_provider text,
+      name text,
+      summary text,
+      primary key (gender, embedding_provider, name)
+    )""")
+
+
+def load_sketches(cursor: sqlite3.Cursor, gender: str, embedding_provider: str) -> PlaneSketches:
+    """The saved summaries for (gender, provider), or empty ones."""
+    sketches = PlaneSketches()
+    cursor.execute("select name, summary from statistics_sketches where gender = ? and embedding_provider = ?",
+                   [gender, embedding_provider])
+    for name, summary in cursor.fetchall():
+        sketches.summaries[name] = Summary.from_dict(json.loads(summary))
+    return sketches
+
+
+def save_sketches(cursor: sqlite3.Cursor, gender: str, embedding_provider: str, sketches: PlaneSketches) -> None:
+    cursor.executemany("""insert or replace into statistics_sketches
+      (gender, embedding_provider, name, summary) values (?,?,?,?)""",
+                       [(gender, embedding_provider, name, json.dumps(summary.to_dict()))
+                        for name, summary in sketches.summaries.items()])
+
+
+def rebuild_column_summaries(cursor: sqlite3.Cursor, gender: str, embedding_provider: str,
+                             sketches: PlaneSketches) -> int:
+    """Replace the per-column summaries with ones computed from planar_statistics; returns the row count."""
+    cursor.execute(f"""select {', '.join(PLANE_COLUMNS)} from planar_statistics
+      where gender = ? and embedding_provider = ?""", [gender, embedding_provider])
+    values = np.array(cursor.fetchall(), dtype=np.float64).reshape(-1, len(PLANE_COLUMNS))
+    for i, column in enumerate(PLANE_COLUMNS):
+        sketches.summaries[column] = Summary()
+        sketches.summaries[column].update(values[:, i])
+    return len(values)
+
+
+def rebuild(args: argparse.Namespace) -> None:
+    """Recreate the per-column summaries from planar_statistics; the distance summary cannot be recovered."""
+    conn = sqlite3.connect(args.database)
+    cursor = conn.cursor()
+    create_sketch_table(cursor)
+    sketches = load_sketches(cursor, args.gender, args.embedding_provider)
+    planes = rebuild_column_summaries(cursor, args.gender, args.embedding_provider, sketches)
+    with conn:
+        save_sketches(cursor, args.gender, args.embedding_provider, sketches)
+    print(f"Summarised {planes} planes")
+    conn.close()
+
+
+def show(args: argparse.Namespace) -> None:
+    conn = sqlite3.connect(args.database)
+    cursor = conn.cursor()
+    create_sketch_table(cursor)
+    sketches = load_sketches(cursor, args.gender, args.embedding_provider)
+    conn.close()
+    quantiles = [0.001, 0.01, 0.25, 0.5, 0.75, 0.99]
+    print(f"{'':16s} {'count':>12s} {'mean':>9s} {'stddev':>9s} {'min':>9s} "
+          + ' '.join(f"{f'q{q:g}':>9s}" for q in quantiles) + f" {'max':>9s}")
+    for name, summary in sketches.summaries.items():
+        moments = summary.moments
+        if moments.count == 0:
+            print(f"{name:16s} {0:12d}")
+            continue
+        print(f"{name:16s} {moments.count:12d} {moments.mean:9.4f} {moments.stddev:9.4f} {moments.minimum:9.4f} "
+              + ' '.join(f"{summary.sketch.quantile(q):9.4f}" for q in quantiles) + f" {moments.maximum:9.4f}")
+    if args.output:
+        import matplotlib.pyplot
+        fig, ax = matplotlib.pyplot.subplots()
+        edges, counts = sketches['distances'].sketch.histogram()
+        ax.stairs(counts, edges, fill=True)
+        ax.set_title(f"Distances from every word to every plane\n{args.embedding_provider}, {args.gender}")
+        ax.set_xlabel("Distance from the plane")
+        fig.savefig(args.output)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Show the running summaries of planar statistics.')
+    parser.add_argument('--database', default='personality_adjectives.sqlite')
+    parser.add_argument('--embedding-provider', default='openai')
+    parser.add_argument('--gender', default='male')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    show_parser = subparsers.add_parser('show', help='Moments and quantiles of every summary')
+    show_parser.add_argument('--output', help='Also save a histogram of all distances to this image')
+    show_parser.set_defaults(func=show)
+    rebuild_parser = subparsers.add_parser('rebuild', help='Recompute the column summaries from planar_statistics')
+    rebuild_parser.set_defaults(func=rebuild)
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
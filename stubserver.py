@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+
+"""
+A local stand-in for the remote APIs, so the scripts can be run without keys or network.
+
+    python stubserver.py --port 8765 &
+    python createembeddings.py --openai-base-url http://localhost:8765/v1 \
+        --ollama-host localhost --ollama-port 8765
+    python personalityadjectives.py --anthropic-base-url http://localhost:8765
+
+Embeddings are deterministic pseudo-random unit vectors derived from the text,
+and Messages API tool calls get deterministic pseudo-random classifications.
+"""
+
+import argparse
+import hashlib
+import json
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import FrozenSet, Iterable, List
+
+import numpy as np
+
+
+def fake_embedding(text: str, dimension: int) -> List[float]:
+    seed = int.from_bytes(hashlib.sha256(text.encode('utf-8')).digest()[:8], 'little')
+    vector = np.random.default_rng(seed).normal(size=dimension)
+    return (vector / np.linalg.norm(vector)).tolist()
+
+
+def fake_is_personality(sentence: str) -> bool:
+    return hashlib.sha256(sentence.encode('utf-8')).digest()[0] % 3 == 0
+
+
+def fake_tool_input(request: dict, omit: FrozenSet[str] = frozenset()) -> dict:
+    """Answer the tool the request forces, using the adjectives found in the prompt (bar any in `omit`)."""
+    prompt = request['messages'][-1]['content']
+    tool = request.get('tool_choice', {}).get('name')
+    if tool == 'classify_personality_adjectives':
+        # Batched prompts list one adjective per line as "- adjective"
+        return {'classifications': [
+            {'adjective': adjective,
+             'he_is_personality': fake_is_personality(f"He is {adjective}"),
+             'she_is_personality': fake_is_personality(f"She is {adjective}")}
+            for adjective in re.findall(r'^- (.+)$', prompt, re.MULTILINE) if adjective not in omit]}
+    sentence = re.search(r"'([^']*)'", prompt).group(1)
+    return {'is_personality': fake_is_personality(sentence)}
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    # Set by make_server
+    dimension = 8
+    fail_every = 0
+    omit = frozenset()
+    reject = frozenset()
+    requests_seen = 0
+    counter_lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status: int, body: dict) -> None:
+        payload = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        request = json.loads(self.rfile.read(length) or b'{}')
+        with self.counter_lock:
+            type(self).requests_seen += 1
+            failing = self.fail_every and type(self).requests_seen % self.fail_every == 0
+        if failing:
+            self._reply(429, {'error': {'message': 'stub rate limit', 'type': 'rate_limit_error'}})
+            return
+        inputs = request.get('input', request.get('prompt'))
+        if self.reject.intersection([inputs] if isinstance(inputs, str) else inputs or []):
+            self._reply(400, {'error': {'message': 'stub rejected an input', 'type': 'invalid_request_error'}})
+            return
+        if self.path.rstrip('/').endswith('/embeddings') and 'prompt' not in request:
+            # OpenAI
+            inputs = request['input']
+            if isinstance(inputs, str):
+                inputs = [inputs]
+            self._reply(200, {
+                'object': 'list',
+                'model': request.get('model', 'stub'),
+                'data': [{'object': 'embedding', 'index': i, 'embedding': fake_embedding(text, self.dimension)}
+                         for i, text in enumerate(inputs)],
+                'usage': {'prompt_tokens': 0, 'total_tokens': 0},
+            })
+        elif self.path == '/v1/messages':
+            # Anthropic Messages API, always answering with the forced tool call
+            self._reply(200, {
+                'id': 'msg_stub', 'type': 'message', 'role': 'assistant',
+                'model': request.get('model', 'stub'),
+                'content': [{'type': 'tool_use', 'id': 'toolu_stub',
+                             'name': request.get('tool_choice', {}).get('name', 'stub'),
+                             'input': fake_tool_input(request, self.omit)}],
+                'stop_reason': 'tool_use', 'stop_sequence': None,
+                'usage': {'input_tokens': 0, 'output_tokens': 0},
+            })
+        elif self.path == '/api/embed':
+            # Ollama, batched
+            inputs = request['input']
+            if isinstance(inputs, str):
+                inputs = [inputs]
+            self._reply(200, {'model': request.get('model', 'stub'),
+                              'embeddings': [fake_embedding(text, self.dimension) for text in inputs]})
+        elif self.path == '/api/embeddings':
+            # Ollama, one prompt at a time
+            self._reply(200, {'embedding': fake_embedding(request['prompt'], self.dimension)})
+        else:
+            self._reply(404, {'error': {'message': f'no stub for {self.path}'}})
+
+
+def make_server(port: int, dimension: int = 8, fail_every: int = 0,
+                omit: Iterable[str] = (), reject: Iterable[str] = ()) -> ThreadingHTTPServer:
+    """
+    Build (but do not start) a stub server; port 0 picks a free port.
+
+    Batched classifications leave out the adjectives in `omit`, as a real
+    model sometimes does. Embedding requests that include a text in
+    `reject` are answered with HTTP 400.
+    """
+    handler = type('ConfiguredStubHandler', (StubHandler,),
+                   {'dimension': dimension, 'fail_every': fail_every, 'omit': frozenset(omit),
+                    'reject': frozenset(reject), 'requests_seen': 0})
+    return ThreadingHTTPServer(('localhost', port), handler)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve fake OpenAI, Ollama and Anthropic endpoints locally.')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--dimension', type=int, default=8)
+    parser.add_argument('--fail-every', type=int, default=0,
+                        help='Answer every Nth request with HTTP 429, to exercise retries')
+    args = parser.parse_args()
+    server = make_server(args.port, args.dimension, args.fail_every)
+    print(f"Stub server listening on http://localhost:{server.server_address[1]}")
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+import json
+import os
+import sqlite3
+import sys
+import threading
+
+import numpy as np
+import pytest
+
+# The modules live at the top of the repository rather than in a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import stubserver  # noqa: E402
+
+
+@pytest.fixture
+def stub_server():
+    """Start stubserver.make_server(0, **options) in a thread; the servers are shut down afterwards."""
+    servers = []
+
+    def start(**options):
+        server = stubserver.make_server(0, **options)
+        threading.Thread(target=server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True).start()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture
+def embeddings_database(tmp_path):
+    """
+    Build a database of random unit embeddings for words w0 .. w{N-1}, every
+    one a personality adjective, for both providers and genders; returns its path.
+    """
+    def build(vocab_size=30, dimension=16, seed=1):
+        path = str(tmp_path / 'embeddings.sqlite')
+        conn = sqlite3.connect(path)
+        rng = np.random.default_rng(seed)
+        for provider in ['openai', 'ollama']:
+            conn.execute(f"""CREATE TABLE {provider}_embeddings (id INTEGER PRIMARY KEY AUTOINCREMENT,
+              adjective TEXT NOT NULL, gender TEXT NOT NULL, embedding TEXT NOT NULL,
+              timestamp DATETIME DEFAULT CURRENT_TIMESTAMP, UNIQUE(adjective, gender))""")
+            for gender in ['male', 'female']:
+                points = rng.normal(size=(vocab_size, dimension))
+                points /= np.linalg.norm(points, axis=1, keepdims=True)
+                conn.executemany(f"INSERT INTO {provider}_embeddings (adjective, gender, embedding) VALUES (?,?,?)",
+                                 [(f"w{i}", gender, json.dumps(point.tolist())) for i, point in enumerate(points)])
+        conn.execute("""CREATE TABLE adjective_analysis (adjective TEXT PRIMARY KEY, he_is_personality BOOLEAN,
+          she_is_personality BOOLEAN, timestamp DATETIME DEFAULT CURRENT_TIMESTAMP)""")
+        conn.executemany("INSERT INTO adjective_analysis (adjective, he_is_personality, she_is_personality) "
+                         "VALUES (?, 1, 1)", [(f"w{i}",) for i in range(vocab_size)])
+        conn.commit()
+        conn.close()
+        return path
+
+    return build
@@ -0,0 +1,46 @@
+import os
+
+import matplotlib.pyplot
+import numpy as np
+import pytest
+
+import artefacts
+from artefacts import ArtefactPipeline
+
+PLANES = [('a', 'b', 'c'), ('a', 'b', 'd'), ('b', 'c', 'd')]
+
+
+def distances(seed):
+    values = np.random.default_rng(seed).random(20)
+    values[[1, 5, 9]] = np.nan
+    return values
+
+
+@pytest.mark.parametrize('workers', [0, 2])
+def test_a_histogram_is_written_for_every_submitted_plane(tmp_path, workers):
+    with ArtefactPipeline(str(tmp_path / 'plots'), fitter=False, workers=workers, queue_size=1) as pipeline:
+        for seed, words in enumerate(PLANES):
+            pipeline.submit(words, distances(seed))
+    assert sorted(os.listdir(tmp_path / 'plots')) == sorted(f"{','.join(words)}.png" for words in PLANES)
+    # Figures made in this process are closed again
+    assert matplotlib.pyplot.get_fignums() == []
+
+
+def test_the_words_defining_a_plane_are_left_out(tmp_path, monkeypatch):
+    submitted = []
+    monkeypatch.setattr(artefacts, 'save_artefacts',
+                        lambda directory, fitter, words, values: submitted.append((words, values)))
+    ArtefactPipeline(str(tmp_path), fitter=False, workers=0).submit(['a', 'b', 'c'], distances(0))
+    ((words, values),) = submitted
+    assert words == ('a', 'b', 'c') and len(values) == 17 and not np.isnan(values).any()
+
+
+def test_a_failing_artefact_does_not_stop_the_workers(tmp_path, capfd):
+    with ArtefactPipeline(str(tmp_path), fitter=False, workers=1) as pipeline:
+        pipeline.submit(('a', 'b', 'c'), distances(0))
+        # A directory in the way of the image
+        os.mkdir(tmp_path / 'a,b,d.png')
+        pipeline.submit(('a', 'b', 'd'), distances(1))
+        pipeline.submit(('b', 'c', 'd'), distances(2))
+    assert os.path.isfile(tmp_path / 'a,b,c.png') and os.path.isfile(tmp_path / 'b,c,d.png')
+    assert "Could not produce artefacts for a,b,d" in capfd.readouterr().out
@@ -0,0 +1,74 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+import benchmarks
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_a_small_suite_run_is_added_to_the_history(tmp_path):
+    history = tmp_path / 'history.json'
+    for label in ['first', 'second']:
+        subprocess.run([sys.executable, os.path.join(REPOSITORY, 'benchmarks.py'), 'suite', '--sizes', '40', '60',
+                        '--dimensions', '8', '--planes', '2', '--queries', '2', '--batch-size', '8',
+                        '--batch-repeats', '1', '--finder-triples', '20', '--history', str(history),
+                        '--label', label], check=True, cwd=tmp_path, capture_output=True)
+    runs = json.loads(history.read_text())['runs']
+    assert [run['label'] for run in runs] == ['first', 'second']
+    cases = runs[-1]['cases']
+    assert [(case['size'], case['dimension']) for case in cases] == [(40, 8), (60, 8)]
+    for case in cases:
+        assert case['finder_triples_per_second'] > 0 and case['peak_rss_mib'] > 0
+        assert case['plane_construction_ms'] > 0 and case['batched_query_ms_per_plane'] > 0
+
+
+def write_history(path, baseline, candidate):
+    def run(label, case):
+        return {'label': label, 'commit': None, 'machine': 'test', 'options': {},
+                'cases': [dict(case, size=1000, dimension=384)]}
+
+    path.write_text(json.dumps({'runs': [run('before', baseline), run('after', candidate)]}))
+
+
+def compare(path, threshold=0.1):
+    benchmarks.compare(argparse.Namespace(history=str(path), baseline='before', candidate='after',
+                                          threshold=threshold, list=False))
+
+
+def test_compare_flags_slower_runs_as_regressions(tmp_path, capsys):
+    write_history(tmp_path / 'history.json', {'single_query_ms': 1.0, 'finder_triples_per_second': 1000.0},
+                  {'single_query_ms': 1.5, 'finder_triples_per_second': 1000.0})
+    with pytest.raises(SystemExit) as exit_info:
+        compare(tmp_path / 'history.json')
+    assert exit_info.value.code == 1
+    assert "1 regressions beyond 10%" in capsys.readouterr().out
+
+
+def test_compare_flags_lower_throughput_but_not_lower_latency(tmp_path, capsys):
+    write_history(tmp_path / 'history.json', {'single_query_ms': 1.0, 'finder_triples_per_second': 1000.0},
+                  {'single_query_ms': 0.5, 'finder_triples_per_second': 800.0})
+    with pytest.raises(SystemExit):
+        compare(tmp_path / 'history.json')
+    output = capsys.readouterr().out
+    assert "improved" in output and "1 regressions" in output
+    # Within the threshold, nothing is flagged
+    write_history(tmp_path / 'history.json', {'single_query_ms': 1.0}, {'single_query_ms': 1.05})
+    compare(tmp_path / 'history.json')
+    assert "0 regressions" in capsys.readouterr().out
+
+
+@pytest.mark.parametrize('arguments', [
+    ['construction', '--dimension', '16', '--planes', '3'],
+    ['index', '--sizes', '200', '--dimension', '16', '--rank', '4', '--candidates', '20', '--queries', '2'],
+    ['precision', '--size', '200', '--dimension', '16', '--triples', '50', '--near-collinear', '3'],
+    ['search', '--size', '60', '--dimension', '16', '--budget', '200', '--beam-width', '4'],
+    ['gram', '--sizes', '100', '--dimensions', '16', '--repeats', '1'],
+])
+def test_each_benchmark_runs_offline_on_small_inputs(tmp_path, arguments):
+    subprocess.run([sys.executable, os.path.join(REPOSITORY, 'benchmarks.py'), *arguments], check=True,
+                   cwd=tmp_path, capture_output=True, timeout=120)
@@ -0,0 +1,132 @@
+import functools
+import sqlite3
+
+import numpy as np
+import pytest
+
+import createembeddings
+import ratelimit
+from createembeddings import EmbeddingGenerator
+from embeddingstore import decode_embedding, table_format
+from stubserver import fake_embedding
+
+ADJECTIVES = [('kind', 1, 1), ('gentle', 1, 0), ('cruel', 0, 1), ('wooden', 0, 0), ('brave', 1, 1),
+              ('shy', 1, 1), ('loud', 1, 0)]
+DIMENSION = 16
+
+
+@pytest.fixture(autouse=True)
+def fast_retries(monkeypatch):
+    monkeypatch.setattr(createembeddings, 'retry_with_backoff',
+                        functools.partial(ratelimit.retry_with_backoff, base_delay=0.01))
+
+
+def make_database(path) -> str:
+    conn = sqlite3.connect(path)
+    conn.execute("""create table adjective_analysis (adjective text primary key, he_is_personality boolean,
+      she_is_personality boolean, timestamp datetime default current_timestamp)""")
+    conn.executemany("insert into adjective_analysis (adjective, he_is_personality, she_is_personality) values (?,?,?)",
+                     ADJECTIVES)
+    conn.commit()
+    conn.close()
+    return str(path)
+
+
+def generate(database: str, server, batch_size: int = 4, stop_after=None) -> None:
+    port = server.server_address[1]
+    generator = EmbeddingGenerator(database, 'localhost', ollama_port=port, openai_api_key='stub',
+                                   openai_base_url=f'http://localhost:{port}/v1', batch_size=batch_size,
+                                   requests_per_second={'openai': None, 'ollama': None}, stop_after=stop_after)
+    try:
+        generator.process_all()
+    finally:
+        generator.close()
+
+
+def stored(database: str, source: str):
+    conn = sqlite3.connect(database)
+    rows = conn.execute(f"select adjective, gender, embedding from {source}_embeddings").fetchall()
+    fmt = table_format(conn, f"{source}_embeddings")
+    conn.close()
+    return rows, fmt
+
+
+def expected_pairs():
+    return {(adjective, gender) for adjective, he, she in ADJECTIVES if he or she for gender in ['male', 'female']}
+
+
+@pytest.mark.parametrize('source', ['openai', 'ollama'])
+def test_every_embedding_is_stored_as_float32(tmp_path, stub_server, source):
+    database = make_database(tmp_path / 'test.sqlite')
+    generate(database, stub_server(dimension=DIMENSION))
+    rows, fmt = stored(database, source)
+    assert {(adjective, gender) for adjective, gender, _ in rows} == expected_pairs()
+    assert fmt == (DIMENSION, np.dtype(np.float32))
+    for adjective, gender, blob in rows:
+        assert isinstance(blob, bytes) and len(blob) == DIMENSION * 4
+        sentence = f"{'He' if gender == 'male' else 'She'} is {adjective}"
+        np.testing.assert_allclose(decode_embedding(blob), fake_embedding(sentence, DIMENSION), rtol=1e-6)
+
+
+def test_rate_limited_requests_are_retried(tmp_path, stub_server):
+    database = make_database(tmp_path / 'test.sqlite')
+    server = stub_server(dimension=DIMENSION, fail_every=3)
+    generate(database, server, batch_size=2)
+    for source in ['openai', 'ollama']:
+        rows, _ = stored(database, source)
+        assert {(adjective, gender) for adjective, gender, _ in rows} == expected_pairs()
+    # One request per two sentences for each provider, plus the retries
+    answered = 2 * ((len(expected_pairs()) + 1) // 2)
+    assert server.RequestHandlerClass.requests_seen > answered
+
+
+def test_each_batch_is_one_request_to_each_provider(tmp_path, stub_server):
+    database = make_database(tmp_path / 'test.sqlite')
+    server = stub_server(dimension=DIMENSION)
+    generate(database, server, batch_size=4)
+    assert server.RequestHandlerClass.requests_seen == 2 * -(-len(expected_pairs()) // 4)
+
+
+def test_a_failing_text_does_not_lose_the_rest_of_its_batch(tmp_path, stub_server):
+    database = make_database(tmp_path / 'test.sqlite')
+    generate(database, stub_server(dimension=DIMENSION, reject=['She is cruel']), batch_size=4)
+    for source in ['openai', 'ollama']:
+        rows, _ = stored(database, source)
+        assert {(adjective, gender) for adjective, gender, _ in rows} == expected_pairs() - {('cruel', 'female')}
+    # The next run only has the failed text left to do
+    server = stub_server(dimension=DIMENSION)
+    generate(database, server)
+    assert server.RequestHandlerClass.requests_seen == 2
+    assert {(adjective, gender) for adjective, gender, _ in stored(database, 'ollama')[0]} == expected_pairs()
+
+
+def test_stop_after_finishes_the_adjective_and_gender_at_hand(tmp_path, stub_server):
+    database = make_database(tmp_path / 'test.sqlite')
+    # The first three embeddings are kind/male from both providers and kind/female from OpenAI
+    generate(database, stub_server(dimension=DIMENSION), stop_after=3)
+    for source in ['openai', 'ollama']:
+        rows, _ = stored(database, source)
+        assert {(adjective, gender) for adjective, gender, _ in rows} == {('kind', 'male'), ('kind', 'female')}
+
+
+def test_a_second_run_requests_nothing(tmp_path, stub_server):
+    database = make_database(tmp_path / 'test.sqlite')
+    generate(database, stub_server(dimension=DIMENSION))
+    server = stub_server(dimension=DIMENSION)
+    generate(database, server)
+    assert server.RequestHandlerClass.requests_seen == 0
+
+
+def test_missing_embeddings_are_found_in_adjective_gender_source_order(tmp_path):
+    database = make_database(tmp_path / 'test.sqlite')
+    generator = EmbeddingGenerator(database, 'localhost')
+    try:
+        generator.store_embeddings('openai', [('kind', 'male', np.ones(3)), ('shy', 'female', np.ones(3))])
+        generator.store_embeddings('ollama', [('kind', 'female', np.ones(3))])
+        missing = generator.missing_embeddings(['openai', 'ollama'], ['male', 'female'])
+    finally:
+        generator.close()
+    expected = [(source, adjective, gender) for adjective, he, she in ADJECTIVES if he or she
+                for gender in ['male', 'female'] for source in ['openai', 'ollama']]
+    done = {('openai', 'kind', 'male'), ('openai', 'shy', 'female'), ('ollama', 'kind', 'female')}
+    assert missing == [work for work in expected if work not in done]
@@ -0,0 +1,107 @@
+import os
+import sqlite3
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+from distancestore import DistanceStore
+
+VOCAB = [f"w{i}" for i in range(12)]
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def planes(count: int, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    triples = np.array([np.sort(rng.choice(len(VOCAB), 3, replace=False)) for _ in range(count)])
+    distances = rng.random((count, len(VOCAB)))
+    np.put_along_axis(distances, triples, np.nan, axis=1)
+    return triples, distances
+
+
+@pytest.mark.parametrize('dtype, tolerance', [('float16', 1e-3), ('float32', 1e-7)])
+def test_stored_distances_read_back(tmp_path, dtype, tolerance):
+    triples, distances = planes(10)
+    with DistanceStore(str(tmp_path), VOCAB, dtype, segment_rows=4) as store:
+        store.append(triples[:6], distances[:6])
+        store.append(triples[6:], distances[6:])
+    reopened = DistanceStore(str(tmp_path))
+    assert reopened.dtype == np.dtype(dtype)
+    unique = {tuple(triple) for triple in triples}
+    assert len(reopened) == len(unique)
+    # Any order of a triple's words finds it
+    stored = reopened.get_many(triples[:, ::-1])
+    assert stored.dtype == np.float32
+    np.testing.assert_allclose(stored, distances, atol=tolerance)
+    assert np.isnan(stored[np.arange(len(triples))[:, None], triples]).all()
+    assert {tuple(triple) for triple in reopened.triples()} == unique
+
+
+def test_missing_triples(tmp_path):
+    triples, distances = planes(3)
+    store = DistanceStore(str(tmp_path), VOCAB)
+    store.append(triples, distances)
+    missing = next(triple for triple in [(0, 1, 2), (0, 1, 3), (0, 1, 4), (0, 1, 5)]
+                   if tuple(triple) not in {tuple(stored) for stored in triples})
+    assert missing not in store
+    assert tuple(triples[0]) in store
+    assert store.find(np.array([missing, triples[1]])).tolist()[0] == -1
+    with pytest.raises(KeyError):
+        store.get_many(np.array([missing]))
+
+
+def test_an_empty_store_is_falsy_but_not_none(tmp_path):
+    store = DistanceStore(str(tmp_path), VOCAB)
+    # Callers must test `store is not None`: an open store with nothing in it yet is falsy
+    assert len(store) == 0 and not store
+    triples, distances = planes(2)
+    store.append(triples, distances)
+    assert len(store) == 2 and store
+
+
+def test_other_writers_show_up_after_refresh(tmp_path):
+    triples, distances = planes(6)
+    reader = DistanceStore(str(tmp_path), VOCAB)
+    assert len(reader) == 0
+    with DistanceStore(str(tmp_path), VOCAB) as writer:
+        writer.append(triples, distances)
+    assert len(reader) == 0
+    reader.refresh()
+    assert len(reader) == len({tuple(triple) for triple in triples})
+
+
+def test_a_torn_last_row_is_ignored(tmp_path):
+    triples, distances = planes(3)
+    with DistanceStore(str(tmp_path), VOCAB) as store:
+        store.append(triples, distances)
+    segment = next(name for name in os.listdir(tmp_path) if name.endswith('.distances'))
+    with open(tmp_path / segment, 'r+b') as f:
+        f.truncate(os.path.getsize(tmp_path / segment) - 1)
+    assert len(DistanceStore(str(tmp_path))) == 2
+
+
+def test_the_vocabulary_must_match(tmp_path):
+    DistanceStore(str(tmp_path), VOCAB)
+    with pytest.raises(ValueError):
+        DistanceStore(str(tmp_path), VOCAB[::-1])
+    with pytest.raises(FileNotFoundError):
+        DistanceStore(str(tmp_path / 'elsewhere'))
+
+
+@pytest.mark.parametrize('schedule', ['enumerate', 'random'])
+def test_search_workers_store_exactly_the_planes_written(tmp_path, embeddings_database, schedule):
+    database = embeddings_database()
+    subprocess.run([sys.executable, os.path.join(REPOSITORY, 'language_plane_finder.py'),
+                    '--database', database, '--embedding-provider', 'openai', '--gender', 'male',
+                    '--workers', '2', '--schedule', schedule, '--random-seed', '1', '--stop-after', '200',
+                    '--distance-store', str(tmp_path / 'store')], check=True, cwd=tmp_path, capture_output=True)
+    (directory,) = [os.path.join(tmp_path / 'store', name) for name in os.listdir(tmp_path / 'store')]
+    store = DistanceStore(directory)
+    index = {word: i for i, word in enumerate(store.vocab)}
+    rows = sqlite3.connect(database).execute('SELECT adjective1, adjective2, adjective3, how_close '
+                                             'FROM planar_statistics').fetchall()
+    # Exactly the planes written, however far the workers got past --stop-after
+    assert len(rows) == 200 and len(store) == 200
+    triples = np.array([[index[word] for word in row[:3]] for row in rows])
+    np.testing.assert_allclose(np.nanmin(store.get_many(triples), axis=1), [row[3] for row in rows], rtol=1e-3)
@@ -0,0 +1,115 @@
+import json
+import os
+import sqlite3
+
+import numpy as np
+import pytest
+
+from embeddingstore import (EMBEDDING_DTYPE, cached_embedding_matrix, create_embedding_table, create_formats_table,
+                            decode_embedding, encode_embedding, load_embedding_matrix, migrate_table, set_table_format,
+                            table_format)
+
+
+def test_embeddings_round_trip_as_little_endian_float32():
+    vector = np.random.default_rng(0).normal(size=7)
+    blob = encode_embedding(vector.tolist())
+    assert len(blob) == 7 * 4
+    assert decode_embedding(blob).dtype == EMBEDDING_DTYPE
+    np.testing.assert_array_equal(decode_embedding(blob), vector.astype(np.float32))
+
+
+def test_table_format_is_recorded_once():
+    conn = sqlite3.connect(':memory:')
+    assert table_format(conn, 'openai_embeddings') is None
+    create_embedding_table(conn, 'openai')
+    assert table_format(conn, 'openai_embeddings') is None
+    set_table_format(conn, 'openai_embeddings', 5)
+    set_table_format(conn, 'openai_embeddings', 5)
+    assert table_format(conn, 'openai_embeddings') == (5, EMBEDDING_DTYPE)
+    with pytest.raises(ValueError):
+        set_table_format(conn, 'openai_embeddings', 6)
+
+
+def json_table(conn, vectors):
+    conn.execute("""CREATE TABLE openai_embeddings (id INTEGER PRIMARY KEY AUTOINCREMENT, adjective TEXT NOT NULL,
+      gender TEXT NOT NULL, embedding TEXT NOT NULL, timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+      UNIQUE(adjective, gender))""")
+    conn.executemany("INSERT INTO openai_embeddings (adjective, gender, embedding) VALUES (?, ?, ?)",
+                     [(f"w{i}", gender, json.dumps(vector.tolist()))
+                      for gender in ['male', 'female'] for i, vector in enumerate(vectors)])
+    create_formats_table(conn)
+    conn.commit()
+
+
+def test_migrate_table_converts_json_rows_to_blobs():
+    conn = sqlite3.connect(':memory:')
+    vectors = np.random.default_rng(1).normal(size=(6, 4))
+    json_table(conn, vectors)
+    vocab, before = load_embedding_matrix(conn, 'openai_embeddings', 'female')
+    assert vocab == [f"w{i}" for i in range(6)]
+    np.testing.assert_array_equal(before, vectors)
+
+    assert migrate_table(conn, 'openai_embeddings') == 12
+    assert table_format(conn, 'openai_embeddings') == (4, EMBEDDING_DTYPE)
+    assert {kind for (kind,) in conn.execute('SELECT typeof(embedding) FROM openai_embeddings')} == {'blob'}
+    vocab, after = load_embedding_matrix(conn, 'openai_embeddings', 'female')
+    assert vocab == [f"w{i}" for i in range(6)] and after.dtype == np.float64
+    np.testing.assert_array_equal(after, vectors.astype(np.float32))
+    assert load_embedding_matrix(conn, 'openai_embeddings', 'male', np.float32)[1].dtype == np.float32
+    # Nothing is left to convert
+    assert migrate_table(conn, 'openai_embeddings') == 0
+
+
+def test_migrate_table_rolls_back_on_a_mismatched_dimension():
+    conn = sqlite3.connect(':memory:')
+    json_table(conn, np.ones((3, 4)))
+    conn.execute("UPDATE openai_embeddings SET embedding = '[1.0, 2.0]' WHERE adjective = 'w2'")
+    conn.commit()
+    with pytest.raises(ValueError):
+        migrate_table(conn, 'openai_embeddings')
+    assert {kind for (kind,) in conn.execute('SELECT typeof(embedding) FROM openai_embeddings')} == {'text'}
+    assert table_format(conn, 'openai_embeddings') is None
+
+
+def test_cached_embedding_matrix_is_rebuilt_when_the_table_changes(tmp_path):
+    conn = sqlite3.connect(':memory:')
+    vectors = np.random.default_rng(2).normal(size=(5, 3))
+    json_table(conn, vectors[:4])
+    cache = str(tmp_path / 'cache')
+
+    def matrix_files():
+        return [name for name in os.listdir(cache) if name.endswith('.npy')]
+
+    vocab, first = cached_embedding_matrix(conn, 'openai_embeddings', 'male', cache)
+    assert vocab == ['w0', 'w1', 'w2', 'w3'] and isinstance(first, np.memmap)
+    np.testing.assert_array_equal(first, vectors[:4])
+    (name,) = matrix_files()
+    assert cached_embedding_matrix(conn, 'openai_embeddings', 'male', cache)[1].filename == first.filename
+
+    # Migrating changes the values (to float32) without adding or replacing a row
+    migrate_table(conn, 'openai_embeddings')
+    _, migrated = cached_embedding_matrix(conn, 'openai_embeddings', 'male', cache)
+    np.testing.assert_array_equal(migrated, vectors[:4].astype(np.float32))
+    # The old file is gone, but a process that mapped it keeps reading what it mapped
+    assert matrix_files() != [name] and len(matrix_files()) == 1
+    np.testing.assert_array_equal(first, vectors[:4])
+
+    with conn:
+        conn.execute("INSERT INTO openai_embeddings (adjective, gender, embedding) VALUES ('w4', 'male', ?)",
+                     [encode_embedding(vectors[4])])
+    vocab, grown = cached_embedding_matrix(conn, 'openai_embeddings', 'male', cache)
+    assert vocab == ['w0', 'w1', 'w2', 'w3', 'w4']
+    np.testing.assert_array_equal(grown, vectors.astype(np.float32))
+
+
+def test_cached_embedding_matrix_rebuilds_a_cache_whose_matrix_is_missing(tmp_path):
+    conn = sqlite3.connect(':memory:')
+    vectors = np.random.default_rng(3).normal(size=(4, 3))
+    json_table(conn, vectors)
+    cache = str(tmp_path)
+    _, matrix = cached_embedding_matrix(conn, 'openai_embeddings', 'female', cache)
+    # As when a concurrent rebuild removes it between reading the sidecar and mapping the file
+    os.remove(matrix.filename)
+    del matrix
+    _, matrix = cached_embedding_matrix(conn, 'openai_embeddings', 'female', cache)
+    np.testing.assert_array_equal(matrix, vectors)
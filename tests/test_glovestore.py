@@ -0,0 +1,86 @@
+import sqlite3
+
+import numpy as np
+import pytest
+
+from embeddingstore import decode_embedding
+from glovestore import GloveLookup, export, ingest, parse_chunk
+
+WORDS = ['kind', 'gentle', 'cruel', 'brave', 'café', 'shy']
+
+
+def write_glove(path, header=False, extra_lines=()):
+    vectors = np.random.default_rng(0).normal(size=(len(WORDS), 4)).astype(np.float32)
+    with open(path, 'w', encoding='utf-8') as f:
+        if header:
+            f.write(f"{len(WORDS)} 4\n")
+        for word, vector in zip(WORDS, vectors):
+            f.write(f"{word} {' '.join(repr(float(value)) for value in vector)}\n")
+        for line in extra_lines:
+            f.write(line)
+    return dict(zip(WORDS, vectors))
+
+
+@pytest.mark.parametrize('header', [False, True])
+def test_ingested_vectors_are_looked_up_by_term(tmp_path, header):
+    vectors = write_glove(tmp_path / 'glove.txt', header)
+    assert ingest(str(tmp_path / 'glove.txt'), str(tmp_path / 'store'), chunk_lines=4) == len(WORDS)
+    lookup = GloveLookup(str(tmp_path / 'store'))
+    assert lookup.dimension == 4 and len(lookup) == len(WORDS)
+    assert list(lookup.iter_terms()) == WORDS
+    terms = ['shy', 'missing', 'kind', 'café', 'kind']
+    found, looked_up = lookup.lookup_many(terms)
+    assert found.tolist() == [True, False, True, True, True]
+    np.testing.assert_array_equal(looked_up, [vectors[term] for term in terms if term != 'missing'])
+    # The second time round they come out of the cache
+    found_again, looked_up_again = lookup.lookup_many(terms)
+    assert lookup.hits >= 3
+    np.testing.assert_array_equal(looked_up_again, looked_up)
+    assert 'missing' not in lookup and 'brave' in lookup
+    with pytest.raises(KeyError):
+        lookup.lookup('missing')
+
+
+def test_awkward_lines_repeats_and_spaces(tmp_path):
+    vectors = write_glove(tmp_path / 'glove.txt', extra_lines=[
+        '\n',
+        'not a vector\n',
+        'kind 9 9 9 9\n',
+        'ice cream 1 2 3 4\n',
+    ])
+    ingest(str(tmp_path / 'glove.txt'), str(tmp_path / 'store'))
+    lookup = GloveLookup(str(tmp_path / 'store'), cache_size=0)
+    assert lookup.metadata['dropped_lines'] == 1
+    # The first copy of a repeated term wins
+    np.testing.assert_array_equal(lookup.lookup('kind'), vectors['kind'])
+    np.testing.assert_array_equal(lookup.lookup('ice cream'), [1, 2, 3, 4])
+
+
+def test_lines_of_the_wrong_length_are_caught_even_when_the_total_fits():
+    # Five numbers then three: eight values, as many as two good lines have
+    terms, vectors, dropped = parse_chunk(['good 1 2 3 4\n', 'long 1 2 3 4 5\n', 'short 6 7 8\n'], 4)
+    assert dropped == 1
+    # A line with too many fields reads as a term containing a space, as 'ice cream' does
+    assert terms == ['good', 'long 1']
+    np.testing.assert_array_equal(vectors, [[1, 2, 3, 4], [2, 3, 4, 5]])
+    assert vectors.dtype == np.float32
+
+
+def test_a_chunk_of_well_formed_lines_is_parsed_whole():
+    terms, vectors, dropped = parse_chunk(['a 1 2.5 -3\n', 'b 1e-3 0 7 \n'], 3)
+    assert (terms, dropped) == (['a', 'b'], 0)
+    np.testing.assert_array_equal(vectors, np.array([[1, 2.5, -3], [1e-3, 0, 7]], dtype=np.float32))
+
+
+def test_export_writes_float32_rows_for_every_gender(tmp_path):
+    vectors = write_glove(tmp_path / 'glove.txt')
+    ingest(str(tmp_path / 'glove.txt'), str(tmp_path / 'store'))
+    conn = sqlite3.connect(str(tmp_path / 'embeddings.sqlite'))
+    exported, missing = export(GloveLookup(str(tmp_path / 'store')), conn, 'glove', ['male', 'female'],
+                               ['kind', 'cruel', 'missing'])
+    assert (exported, missing) == (2, 1)
+    rows = conn.execute('SELECT adjective, gender, embedding FROM glove_embeddings').fetchall()
+    assert sorted((adjective, gender) for adjective, gender, _ in rows) == [
+        ('cruel', 'female'), ('cruel', 'male'), ('kind', 'female'), ('kind', 'male')]
+    for adjective, _, blob in rows:
+        np.testing.assert_array_equal(decode_embedding(blob), vectors[adjective])
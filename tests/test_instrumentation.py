@@ -0,0 +1,47 @@
+import io
+import json
+import time
+
+from instrumentation import Metrics
+
+
+def test_stages_and_counters_add_up():
+    metrics = Metrics(io.StringIO())
+    for _ in range(3):
+        with metrics.stage('distances'):
+            time.sleep(0.01)
+    metrics.count('triples_evaluated', 90)
+    metrics.count('duplicates_rejected', 10)
+    metrics.count('collinear_skipped')
+    record = metrics.record()
+    assert record['stages']['distances']['calls'] == 3
+    assert record['stages']['distances']['seconds'] >= 0.03
+    assert record['counters'] == {'triples_evaluated': 90, 'duplicates_rejected': 10, 'collinear_skipped': 1}
+    assert record['duplicate_rejection_rate'] == 0.1
+
+
+def test_worker_metrics_are_taken_and_merged():
+    worker, writer = Metrics(io.StringIO()), Metrics(io.StringIO())
+    for _ in range(2):
+        with worker.stage('statistics'):
+            pass
+        worker.count('triples_evaluated', 5)
+        writer.merge(worker.take())
+    assert worker.take() == {'seconds': {}, 'calls': {}, 'counters': {}}
+    assert writer.counters['triples_evaluated'] == 10 and writer.calls['statistics'] == 2
+
+
+def test_json_lines_are_written_every_interval():
+    stream = io.StringIO()
+    metrics = Metrics(stream, interval=3600)
+    metrics.count('triples_evaluated', 4)
+    metrics.maybe_emit()
+    assert stream.getvalue() == ''
+    metrics.interval = 0
+    metrics.maybe_emit()
+    metrics.count('triples_evaluated', 6)
+    metrics.emit('summary')
+    first, last = [json.loads(line) for line in stream.getvalue().splitlines()]
+    assert (first['event'], last['event']) == ('progress', 'summary')
+    assert last['counters']['triples_evaluated'] == 10
+    assert 'triples_evaluated' in metrics.summary()
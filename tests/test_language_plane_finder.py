@@ -0,0 +1,431 @@
+import json
+import os
+import pstats
+import queue
+import sqlite3
+import subprocess
+import sys
+import threading
+from itertools import combinations
+
+import numpy as np
+import pytest
+
+import language_plane_finder
+from plane import triple_distances
+from planestats import batch_statistics
+from triples import create_checkpoint_table, load_checkpoint
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TARGETS = [('ollama', 'female'), ('ollama', 'male'), ('openai', 'female'), ('openai', 'male')]
+
+
+def run_finder(database, *arguments, check=True):
+    return subprocess.run([sys.executable, os.path.join(REPOSITORY, 'language_plane_finder.py'),
+                           '--database', database, *arguments],
+                          check=check, cwd=os.path.dirname(database), capture_output=True, text=True)
+
+
+def run_in_process(monkeypatch, database, *arguments):
+    monkeypatch.setattr(sys, 'argv', ['language_plane_finder.py', '--database', database, *arguments])
+    language_plane_finder.run(language_plane_finder.parse_arguments())
+
+
+def rows_by_target(conn):
+    rows = {}
+    for provider, gender, *triple, mean_distance in conn.execute(
+            'SELECT embedding_provider, gender, adjective1, adjective2, adjective3, mean_distance '
+            'FROM planar_statistics'):
+        rows.setdefault((provider, gender), {})[tuple(triple)] = mean_distance
+    return rows
+
+
+def assert_measured_directly(conn, provider, gender, rtol=1e-9):
+    """Check every stored row of (provider, gender) against triple_distances on the table's current embeddings."""
+    vocab, embeddings = zip(*conn.execute(f"SELECT adjective, embedding FROM {provider}_embeddings "
+                                          "WHERE gender = ? ORDER BY id", [gender]))
+    index = {word: i for i, word in enumerate(vocab)}
+    points = np.array([json.loads(embedding) for embedding in embeddings])
+    rows = conn.execute('SELECT adjective1, adjective2, adjective3, closest_adjective, how_close, mean_distance, '
+                        'percentile25 FROM planar_statistics WHERE embedding_provider = ? AND gender = ?',
+                        [provider, gender]).fetchall()
+    _, distances = triple_distances(points, np.array([[index[word] for word in row[:3]] for row in rows]))
+    stats = batch_statistics(distances)
+    assert [row[3] for row in rows] == [vocab[i] for i in stats['closest_index']]
+    for i, column in enumerate(['how_close', 'mean_distance', 'percentile25']):
+        np.testing.assert_allclose([row[4 + i] for row in rows], stats[column], rtol=rtol)
+
+
+def statistics_rows(count):
+    return [[f"a{i}", f"b{i}", f"c{i}", 'male', 'openai', f"a{i}"] + [float(i)] * 10 + ['v'] for i in range(count)]
+
+
+def test_statistics_writer_commits_in_batches_with_its_checkpoint(tmp_path):
+    database = str(tmp_path / 'statistics.sqlite')
+    conn, reader = sqlite3.connect(database), sqlite3.connect(database)
+    language_plane_finder.create_statistics_table(conn.cursor())
+    create_checkpoint_table(conn.cursor())
+    conn.commit()
+    writer = language_plane_finder.StatisticsWriter(conn, commit_every=3, commit_seconds=3600)
+    key = ('male', 'openai', 0, '', 'v')
+
+    def committed():
+        return (reader.execute('SELECT count(*) FROM planar_statistics').fetchone()[0],
+                load_checkpoint(reader.cursor(), key))
+
+    rows = statistics_rows(7)
+    for row in rows[:2]:
+        writer.add(row)
+    writer.checkpoint = (key, 2)
+    assert committed() == (0, 0)
+    writer.add(rows[2])
+    assert committed() == (3, 2)
+    for row in rows[3:]:
+        writer.add(row)
+    assert committed() == (6, 2)
+    writer.flush()
+    assert committed() == (7, 2)
+    # Rows already there are left alone
+    writer.add(statistics_rows(1)[0][:6] + [99.0] * 10 + ['v'])
+    writer.flush()
+    assert reader.execute("SELECT count(*), max(how_close) FROM planar_statistics").fetchone() == (7, 6.0)
+
+
+def test_statistics_writer_commits_after_commit_seconds(tmp_path):
+    database = str(tmp_path / 'statistics.sqlite')
+    conn, reader = sqlite3.connect(database), sqlite3.connect(database)
+    language_plane_finder.create_statistics_table(conn.cursor())
+    conn.commit()
+    writer = language_plane_finder.StatisticsWriter(conn, commit_every=1000, commit_seconds=0)
+    writer.add(statistics_rows(1)[0])
+    assert reader.execute('SELECT count(*) FROM planar_statistics').fetchone()[0] == 1
+
+
+def test_the_finder_switches_the_database_to_wal(embeddings_database):
+    database = embeddings_database()
+    run_finder(database, '--embedding-provider', 'openai', '--gender', 'male', '--stop-after', '5')
+    assert sqlite3.connect(database).execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+
+
+def test_compare_writes_one_row_per_target_for_the_same_triples(embeddings_database):
+    database = embeddings_database()
+    run_finder(database, '--schedule', 'enumerate', '--stop-after', '40', 'compare')
+    conn = sqlite3.connect(database)
+    rows = rows_by_target(conn)
+    assert sorted(rows) == TARGETS
+    triples = set(rows[TARGETS[0]])
+    assert len(triples) == 40
+    assert all(set(target_rows) == triples for target_rows in rows.values())
+
+    # Every pair of targets, once each way round
+    paired = conn.execute('SELECT embedding_provider1, gender1, embedding_provider2, gender2, adjective1, '
+                          'adjective2, adjective3, mean_distance1, mean_distance2, mean_distance_difference '
+                          'FROM paired_statistics').fetchall()
+    assert len(paired) == 40 * len(list(combinations(TARGETS, 2)))
+    for provider1, gender1, provider2, gender2, *rest in paired:
+        triple, (first, second, difference) = tuple(rest[:3]), rest[3:]
+        assert (provider1, gender1) < (provider2, gender2)
+        assert (first, second) == (rows[provider1, gender1][triple], rows[provider2, gender2][triple])
+        assert difference == second - first
+
+    # The rows are those a single-matrix measurement gives
+    assert_measured_directly(conn, 'openai', 'male')
+
+
+def test_compare_resumes_and_keeps_to_the_shared_words(embeddings_database):
+    database = embeddings_database()
+    conn = sqlite3.connect(database)
+    with conn:
+        conn.execute("DELETE FROM ollama_embeddings WHERE adjective = 'w3' AND gender = 'male'")
+    arguments = ['--schedule', 'enumerate', '--stop-after', '30', 'compare',
+                 '--embeddings', 'openai:male', 'ollama:male']
+    result = run_finder(database, *arguments)
+    assert 'shared words' in result.stderr
+    run_finder(database, *arguments)
+    rows = rows_by_target(conn)
+    assert sorted(rows) == [('ollama', 'male'), ('openai', 'male')]
+    assert set(rows['openai', 'male']) == set(rows['ollama', 'male'])
+    # The second run carried on where the first stopped
+    assert len(rows['openai', 'male']) == 60
+    assert not any('w3' in triple for triple in rows['openai', 'male'])
+
+
+def test_compare_leaves_each_tables_vocabulary_and_existing_rows_alone(embeddings_database):
+    database = embeddings_database(vocab_size=8)
+    conn = sqlite3.connect(database)
+    with conn:
+        conn.execute("DELETE FROM ollama_embeddings WHERE adjective = 'w3' AND gender = 'male'")
+    run_finder(database, '--schedule', 'enumerate', '--stop-after', '20',
+               '--embedding-provider', 'openai', '--gender', 'male')
+    before = set(conn.execute("SELECT adjective1, adjective2, adjective3, vocabulary, mean_distance "
+                              "FROM planar_statistics"))
+    (own,) = {row[3] for row in before}
+    run_finder(database, '--schedule', 'enumerate', 'compare', '--embeddings', 'openai:male', 'ollama:male')
+
+    # Neither table's latest vocabulary (which render and refresh go by) is the shared one
+    cursor = conn.cursor()
+    assert language_plane_finder.latest_vocabulary(cursor, 'male', 'openai') == own
+    assert language_plane_finder.latest_vocabulary(cursor, 'male', 'ollama') is None
+    # The rows of the ordinary run are kept as they were, and compare only added the triples they lacked
+    rows = rows_by_target(conn)
+    shared = {triple for triple in rows['ollama', 'male']}
+    assert len(shared) == 35 and not any('w3' in triple for triple in shared)
+    after = set(conn.execute("SELECT adjective1, adjective2, adjective3, vocabulary, mean_distance "
+                             "FROM planar_statistics WHERE embedding_provider = 'openai'"))
+    assert before <= after
+    assert {row[:3] for row in after} == {row[:3] for row in before} | shared
+    assert len(after) == len({row[:3] for row in after})
+    # Every shared triple is paired, whichever run wrote its openai row
+    paired = conn.execute('SELECT adjective1, adjective2, adjective3 FROM paired_statistics').fetchall()
+    assert sorted(paired) == sorted(shared)
+    assert_measured_directly(conn, 'ollama', 'male')
+
+
+def test_compare_keeps_cached_gram_matrices_apart_from_ordinary_runs(tmp_path, embeddings_database):
+    database = embeddings_database(vocab_size=20)
+    conn = sqlite3.connect(database)
+    # ollama's rows in another order than openai's, so compare reorders its matrix
+    rows = conn.execute("SELECT adjective, embedding FROM ollama_embeddings WHERE gender = 'male' "
+                        "ORDER BY id DESC").fetchall()
+    with conn:
+        conn.execute("DELETE FROM ollama_embeddings WHERE gender = 'male'")
+        conn.executemany("INSERT INTO ollama_embeddings (adjective, gender, embedding) VALUES (?, 'male', ?)", rows)
+    cache = ['--embedding-cache', str(tmp_path / 'cache'), '--engine', 'gram', '--schedule', 'enumerate']
+    run_finder(database, *cache, '--embedding-provider', 'ollama', '--gender', 'male', '--stop-after', '20')
+    run_finder(database, *cache, '--stop-after', '30', 'compare', '--embeddings', 'openai:male', 'ollama:male')
+    run_finder(database, *cache, '--embedding-provider', 'ollama', '--gender', 'male', '--stop-after', '20')
+    assert len(rows_by_target(conn)['ollama', 'male']) > 50
+    assert_measured_directly(conn, 'ollama', 'male')
+    assert_measured_directly(conn, 'openai', 'male')
+
+
+def test_compare_needs_two_targets(embeddings_database):
+    result = run_finder(embeddings_database(), 'compare', '--embeddings', 'openai:male', check=False)
+    assert result.returncode == 2
+    assert 'at least two' in result.stderr
+
+
+@pytest.mark.parametrize('command', [[], ['compare', '--embeddings', 'openai:male', 'ollama:male']])
+def test_a_run_interrupted_part_way_through_a_batch_resumes_without_gaps(monkeypatch, embeddings_database,
+                                                                         command):
+    database = embeddings_database(vocab_size=12)
+    arguments = ['--embedding-provider', 'openai', '--gender', 'male', '--schedule', 'enumerate',
+                 '--batch-size', '64', '--commit-every', '10', *command]
+    add = language_plane_finder.StatisticsWriter.add
+    added = []
+
+    def interrupted_add(writer, row):
+        if len(added) == 25:
+            raise KeyboardInterrupt
+        added.append(row)
+        add(writer, row)
+
+    with monkeypatch.context() as patch:
+        patch.setattr(language_plane_finder.StatisticsWriter, 'add', interrupted_add)
+        with pytest.raises(KeyboardInterrupt):
+            run_in_process(patch, database, *arguments)
+    conn = sqlite3.connect(database)
+    assert conn.execute('SELECT count(*) FROM planar_statistics').fetchone()[0] == 25
+
+    run_in_process(monkeypatch, database, *arguments)
+    everything = {frozenset(triple) for triple in combinations([f"w{i}" for i in range(12)], 3)}
+    rows = rows_by_target(conn)
+    assert len(rows) == (2 if command else 1)
+    for target_rows in rows.values():
+        assert {frozenset(triple) for triple in target_rows} == everything
+
+
+class RecordingPipeline:
+    """Stands in for ArtefactPipeline, keeping what render submits."""
+    submitted = {}
+
+    def __init__(self, *args):
+        RecordingPipeline.submitted = {}
+
+    def submit(self, words, distances):
+        RecordingPipeline.submitted[frozenset(words)] = np.asarray(distances)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+def test_render_uses_stored_distances_and_recomputes_the_rest(tmp_path, monkeypatch, embeddings_database):
+    database = embeddings_database()
+    target = ['--embedding-provider', 'openai', '--gender', 'male']
+    run_finder(database, *target, '--stop-after', '6', '--distance-store', str(tmp_path / 'store'))
+    stored = [frozenset(row) for row in sqlite3.connect(database).execute(
+        'SELECT adjective1, adjective2, adjective3 FROM planar_statistics')]
+    monkeypatch.setattr(language_plane_finder, 'ArtefactPipeline', RecordingPipeline)
+    run_in_process(monkeypatch, database, *target, '--output-directory', str(tmp_path / 'plots'), 'render')
+    from_store = RecordingPipeline.submitted
+    assert set(from_store) == set(stored)
+    # The same planes, and one never searched, measured from the embeddings
+    unsearched = next(frozenset(triple) for triple in combinations(['w0', 'w1', 'w2', 'w3', 'w4'], 3)
+                      if frozenset(triple) not in stored)
+    triples = [','.join(triple) for triple in stored + [unsearched]]
+    run_in_process(monkeypatch, database, *target, '--output-directory', str(tmp_path / 'plots'), 'render',
+                   *[argument for triple in triples for argument in ['--triple', triple]])
+    recomputed = RecordingPipeline.submitted
+    assert set(recomputed) == set(stored) | {unsearched}
+    for triple in stored:
+        # NaN for the plane's own words, which the real pipeline drops
+        assert np.count_nonzero(np.isnan(recomputed[triple])) == 3
+        np.testing.assert_allclose(from_store[triple], recomputed[triple], rtol=1e-6)
+
+
+def test_render_writes_a_plot_per_plane(tmp_path, embeddings_database):
+    database = embeddings_database()
+    target = ['--embedding-provider', 'openai', '--gender', 'male']
+    run_finder(database, *target, '--stop-after', '4')
+    run_finder(database, *target, '--output-directory', str(tmp_path / 'plots'), 'render', '--limit', '3')
+    assert len([name for name in os.listdir(tmp_path / 'plots') if name.endswith('.png')]) == 3
+
+
+def test_metrics_and_profile_are_written_next_to_the_results(tmp_path, embeddings_database):
+    database = embeddings_database()
+    run_finder(database, '--embedding-provider', 'openai', '--gender', 'male', '--stop-after', '12',
+               '--batch-size', '5', '--metrics', str(tmp_path / 'metrics.jsonl'), '--metrics-interval', '0',
+               '--profile')
+    with open(tmp_path / 'metrics.jsonl') as f:
+        records = [json.loads(line) for line in f]
+    assert records[-1]['event'] == 'summary' and len(records) > 1
+    assert records[-1]['counters']['triples_evaluated'] == 12
+    assert {'schedule', 'distances', 'statistics', 'sqlite_commit'} <= set(records[-1]['stages'])
+    (profile,) = [name for name in os.listdir(tmp_path) if name.endswith('.prof')]
+    assert pstats.Stats(str(tmp_path / profile)).total_calls > 0
+
+
+def worker_draws(embedding_matrix, workers, seed, batch_size=7):
+    """The triples each search_worker evaluates on the random schedule, run one after another in this process."""
+    source, shm = language_plane_finder.share_matrix(embedding_matrix)
+    draws = []
+    try:
+        for worker_id in range(workers):
+            results = queue.Queue()
+            language_plane_finder.search_worker(source, None, np.zeros(0, dtype=np.int64), worker_id, workers,
+                                                batch_size, (seed, None, 0), None, results, threading.Event())
+            draws.append([tuple(triple) for item in iter(results.get, None) for triple in item[1]])
+    finally:
+        shm.close()
+        shm.unlink()
+    return draws
+
+
+def test_search_workers_draw_disjoint_seeded_slices_of_the_triples():
+    embedding_matrix = np.random.default_rng(0).normal(size=(12, 6))
+    draws = worker_draws(embedding_matrix, 3, seed=5)
+    assert sum(len(triples) for triples in draws) == 220
+    assert set().union(*map(set, draws)) == set(combinations(range(12), 3))
+    assert worker_draws(embedding_matrix, 3, seed=5) == draws
+    assert worker_draws(embedding_matrix, 3, seed=6) != draws
+
+
+def test_random_schedule_workers_stop_once_every_triple_is_evaluated(embeddings_database):
+    database = embeddings_database(vocab_size=12)
+    run_finder(database, '--embedding-provider', 'openai', '--gender', 'male', '--workers', '2',
+               '--batch-size', '16')
+    conn = sqlite3.connect(database)
+    rows = conn.execute('SELECT adjective1, adjective2, adjective3 FROM planar_statistics').fetchall()
+    assert len(rows) == len(set(rows)) == 220
+    assert_measured_directly(conn, 'openai', 'male')
+
+
+def change_vocabulary(conn, add=(), remove=(), replace=None):
+    """Add random words, remove words, and give words (in `replace`) new embeddings, for openai male."""
+    replace = replace or {}
+    with conn:
+        conn.executemany("DELETE FROM openai_embeddings WHERE gender = 'male' AND adjective = ?",
+                         [(word,) for word in [*remove, *replace]])
+        # Seeded by the word, so that words added in different calls differ
+        added = [(word, np.random.default_rng(list(word.encode())).normal(size=16)) for word in add]
+        new = [(word, vector / np.linalg.norm(vector)) for word, vector in added] + list(replace.items())
+        conn.executemany("INSERT INTO openai_embeddings (adjective, gender, embedding) VALUES (?, 'male', ?)",
+                         [(word, json.dumps(vector.tolist())) for word, vector in new])
+
+
+def current_vocabularies(conn):
+    return {row[0] for row in conn.execute("SELECT DISTINCT vocabulary FROM planar_statistics")}
+
+
+SEARCH = ['--embedding-provider', 'openai', '--gender', 'male']
+
+
+@pytest.mark.parametrize('dtype', ['float32', 'float16'])
+def test_refresh_merges_stored_vectors_with_added_and_removed_words(tmp_path, embeddings_database, dtype):
+    database = embeddings_database(vocab_size=20)
+    store = ['--distance-store', str(tmp_path / 'store'), '--distance-store-dtype', dtype]
+    run_finder(database, *SEARCH, *store, '--schedule', 'enumerate', '--stop-after', '300')
+    conn = sqlite3.connect(database)
+    with_w3 = conn.execute("SELECT count(*) FROM planar_statistics WHERE 'w3' IN (adjective1, adjective2, "
+                           "adjective3)").fetchone()[0]
+    assert with_w3 > 0
+    change_vocabulary(conn, add=['w20', 'w21'], remove=['w3'])
+    # A search warns about the stale rows, and adds one row that is current already
+    assert 'refresh' in run_finder(database, *SEARCH, *store, '--stop-after', '1').stderr
+
+    result = run_finder(database, *SEARCH, *store, 'refresh')
+    kept = 300 - with_w3
+    if dtype == 'float32':
+        assert f"Updated {kept} planes incrementally and recomputed 0; deleted {with_w3} " in result.stdout
+        # Only the added words' distances are new; the rest are float32 values carried over
+        assert_measured_directly(conn, 'openai', 'male', rtol=1e-6)
+    else:
+        assert 'too coarse' in result.stderr
+        assert f"Updated 0 planes incrementally and recomputed {kept}; deleted {with_w3} " in result.stdout
+        assert_measured_directly(conn, 'openai', 'male')
+    assert len(current_vocabularies(conn)) == 1
+    assert 'up to date' in run_finder(database, *SEARCH, *store, 'refresh').stdout
+
+    # The refreshed vectors went into the new vocabulary's store, so the next change is incremental again
+    change_vocabulary(conn, add=['w22'])
+    result = run_finder(database, *SEARCH, *store, 'refresh')
+    if dtype == 'float32':
+        assert f"Updated {kept + 1} planes incrementally and recomputed 0; deleted 0 " in result.stdout
+    else:
+        assert f"Updated 0 planes incrementally and recomputed {kept + 1}; deleted 0 " in result.stdout
+    assert_measured_directly(conn, 'openai', 'male', rtol=1e-6)
+
+
+def test_refresh_without_a_store_recomputes_and_drops_planes_now_collinear(embeddings_database):
+    database = embeddings_database(vocab_size=12)
+    run_finder(database, *SEARCH, '--schedule', 'enumerate', '--stop-after', '100')
+    conn = sqlite3.connect(database)
+    first, second, third = conn.execute('SELECT adjective1, adjective2, adjective3 FROM planar_statistics '
+                                        'LIMIT 1').fetchone()
+    points = {word: np.array(json.loads(embedding)) for word, embedding in conn.execute(
+        "SELECT adjective, embedding FROM openai_embeddings WHERE gender = 'male'")}
+    # Re-embedding the third word on the line through the other two leaves the first row collinear
+    change_vocabulary(conn, replace={third: (points[first] + points[second]) / 2})
+    result = run_finder(database, *SEARCH, 'refresh')
+    assert "Updated 0 planes incrementally and recomputed 99; deleted 0 whose words are gone and 1 that are now " \
+           "collinear" in result.stdout
+    assert conn.execute('SELECT count(*) FROM planar_statistics WHERE adjective1 = ? AND adjective2 = ? '
+                        'AND adjective3 = ?', [first, second, third]).fetchone()[0] == 0
+    assert len(current_vocabularies(conn)) == 1
+    assert_measured_directly(conn, 'openai', 'male')
+
+
+@pytest.mark.parametrize('adopt', [False, True])
+def test_refresh_of_rows_without_a_recorded_vocabulary(embeddings_database, adopt):
+    database = embeddings_database(vocab_size=12)
+    run_finder(database, *SEARCH, '--schedule', 'enumerate', '--stop-after', '50')
+    conn = sqlite3.connect(database)
+    (vocabulary,) = current_vocabularies(conn)
+    with conn:
+        # As rows written before vocabularies were recorded, with some of their statistics off
+        conn.execute('UPDATE planar_statistics SET vocabulary = NULL, mean_distance = mean_distance + 1')
+
+    assert 'unrecorded vocabulary' in run_finder(database, *SEARCH, 'refresh', '--dry-run').stdout
+    assert current_vocabularies(conn) == {None}
+    result = run_finder(database, *SEARCH, 'refresh', *(['--adopt'] if adopt else []))
+    assert current_vocabularies(conn) == {vocabulary}
+    if adopt:
+        # Taken to be current as they are
+        assert 'Took 50 rows' in result.stdout
+        assert conn.execute('SELECT min(mean_distance) FROM planar_statistics').fetchone()[0] > 1
+    else:
+        assert 'recomputed 50' in result.stdout
+        assert_measured_directly(conn, 'openai', 'male')
@@ -0,0 +1,96 @@
+import asyncio
+import functools
+
+import anthropic
+import pytest
+
+import personalityadjectives
+import ratelimit
+from personalityadjectives import Classifier, ResultWriter, classify_all, setup_database, unclassified
+from responsecache import ResponseCache
+from stubserver import fake_is_personality
+
+ADJECTIVES = ['kind', 'gentle', 'cruel', 'wooden', 'brave', 'shy', 'loud']
+
+
+@pytest.fixture(autouse=True)
+def fast_retries(monkeypatch):
+    monkeypatch.setattr(personalityadjectives, 'retry_with_backoff',
+                        functools.partial(ratelimit.retry_with_backoff, base_delay=0.01))
+
+
+def classify(conn, server, adjectives, adjectives_per_request=1, cache=None):
+    async def run():
+        client = anthropic.AsyncAnthropic(api_key='stub', base_url=f"http://localhost:{server.server_address[1]}",
+                                          max_retries=0)
+        # A high starting rate, so that the adaptive limiter does not slow the test down
+        classifier = Classifier(client, 4, 1000.0, cache)
+        await classify_all(classifier, adjectives, ResultWriter(conn, 3), adjectives_per_request)
+
+    asyncio.run(run())
+
+
+def analysis(conn):
+    return {adjective: (bool(he), bool(she))
+            for adjective, he, she in conn.execute('select adjective, he_is_personality, she_is_personality '
+                                                   'from adjective_analysis')}
+
+
+def expected(adjectives):
+    return {adjective: (fake_is_personality(f"He is {adjective}"), fake_is_personality(f"She is {adjective}"))
+            for adjective in adjectives}
+
+
+@pytest.mark.parametrize('adjectives_per_request', [1, 3])
+def test_every_adjective_is_classified(tmp_path, stub_server, adjectives_per_request):
+    conn = setup_database(str(tmp_path / 'test.sqlite'))
+    server = stub_server()
+    classify(conn, server, ADJECTIVES, adjectives_per_request)
+    assert analysis(conn) == expected(ADJECTIVES)
+    # Two questions per adjective one at a time, or one request per chunk of three
+    requests = 2 * len(ADJECTIVES) if adjectives_per_request == 1 else 3
+    assert server.RequestHandlerClass.requests_seen == requests
+
+
+@pytest.mark.parametrize('adjectives_per_request', [1, 3])
+def test_rate_limited_requests_are_retried(tmp_path, stub_server, adjectives_per_request):
+    conn = setup_database(str(tmp_path / 'test.sqlite'))
+    # Half of all requests are refused, with four in flight
+    server = stub_server(fail_every=2)
+    classify(conn, server, ADJECTIVES, adjectives_per_request)
+    assert analysis(conn) == expected(ADJECTIVES)
+    requests = 2 * len(ADJECTIVES) if adjectives_per_request == 1 else 3
+    assert server.RequestHandlerClass.requests_seen > requests
+
+
+def test_analysed_adjectives_are_skipped(tmp_path, stub_server):
+    conn = setup_database(str(tmp_path / 'test.sqlite'))
+    classify(conn, stub_server(), ADJECTIVES[:3])
+    remaining = unclassified(conn, ADJECTIVES)
+    assert remaining == ADJECTIVES[3:]
+    server = stub_server()
+    classify(conn, server, remaining)
+    assert analysis(conn) == expected(ADJECTIVES)
+    assert server.RequestHandlerClass.requests_seen == 2 * len(remaining)
+
+
+def test_adjectives_missing_from_a_batched_answer_are_retried_next_run(tmp_path, stub_server):
+    conn = setup_database(str(tmp_path / 'test.sqlite'))
+    classify(conn, stub_server(omit=['cruel']), ADJECTIVES, adjectives_per_request=3)
+    assert 'cruel' not in analysis(conn)
+    assert unclassified(conn, ADJECTIVES) == ['cruel']
+    classify(conn, stub_server(), unclassified(conn, ADJECTIVES), adjectives_per_request=3)
+    assert analysis(conn) == expected(ADJECTIVES)
+
+
+def test_only_complete_batched_answers_are_cached(tmp_path, stub_server):
+    cache = ResponseCache(str(tmp_path / 'cache.sqlite'))
+    classify(setup_database(str(tmp_path / 'first.sqlite')), stub_server(omit=['cruel']), ADJECTIVES,
+             adjectives_per_request=3, cache=cache)
+    # Asking the same questions again only goes to the API for the chunk that came back without cruel
+    conn = setup_database(str(tmp_path / 'second.sqlite'))
+    server = stub_server()
+    classify(conn, server, ADJECTIVES, adjectives_per_request=3, cache=cache)
+    assert server.RequestHandlerClass.requests_seen == 1
+    assert analysis(conn) == expected(ADJECTIVES)
+    cache.close()
@@ -0,0 +1,119 @@
+import numpy as np
+import pytest
+
+from plane import Plane, PlaneBatch, triple_distances
+
+
+def random_points(count: int, dimension: int, seed: int = 0) -> np.ndarray:
+    return np.random.default_rng(seed).normal(size=(count, dimension))
+
+
+def random_triples(count: int, vocab_size: int, seed: int = 0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    return np.sort(np.array([rng.choice(vocab_size, 3, replace=False) for _ in range(count)]), axis=1)
+
+
+def reference_distances(points: np.ndarray, triple) -> np.ndarray:
+    """One Plane per triple, measured point by point, with the triple's own words NaN."""
+    plane = Plane(*points[list(triple)])
+    distances = np.array([plane.distance_to_plane(point)[0] for point in points])
+    distances[list(triple)] = np.nan
+    return distances
+
+
+def test_distances_to_plane_matches_distance_to_plane():
+    points = random_points(50, 12)
+    plane = Plane(points[0], points[1], points[2])
+    expected = [plane.distance_to_plane(point)[0] for point in points]
+    # The subtraction of squares leaves points on the plane about sqrt(eps) away from it
+    np.testing.assert_allclose(plane.distances_to_plane(points), expected, atol=1e-6)
+
+
+def test_lightweight_plane_computes_its_normal_basis_only_when_asked():
+    points = random_points(3, 10)
+    eager, lazy = Plane(*points), Plane(*points, lightweight=True)
+    assert lazy._normal_basis is None
+    basis = lazy.normal_basis
+    assert basis.shape == (8, 10)
+    assert lazy.normal_basis is basis
+    # An orthonormal basis of the complement of the two directions, spanning the same space as the eager one
+    np.testing.assert_allclose(basis @ basis.T, np.eye(8), atol=1e-12)
+    np.testing.assert_allclose(basis @ np.array([lazy.direction1, lazy.direction2]).T, 0, atol=1e-12)
+    np.testing.assert_allclose(basis.T @ basis, eager.normal_basis.T @ eager.normal_basis, atol=1e-12)
+
+
+def test_lightweight_plane_answers_without_the_normal_basis():
+    points = random_points(30, 12)
+    eager, lazy = Plane(*points[:3]), Plane(*points[:3], lightweight=True)
+    for point in points:
+        distance, projected = lazy.distance_to_plane(point)
+        eager_distance, eager_projected = eager.distance_to_plane(point)
+        assert distance == pytest.approx(eager_distance, abs=1e-12)
+        np.testing.assert_allclose(projected, eager_projected, atol=1e-12)
+        coordinates, _ = lazy.project_point(point)
+        np.testing.assert_allclose(eager.project_point(point)[0], coordinates, atol=1e-12)
+        np.testing.assert_allclose(lazy.origin + coordinates @ [lazy.direction1, lazy.direction2], projected,
+                                   atol=1e-12)
+    assert lazy._normal_basis is None
+    # The distance is the length of the point's component in the normal space
+    for point in points:
+        assert lazy.distance_to_plane(point)[0] == pytest.approx(
+            np.linalg.norm(eager.normal_basis @ (point - eager.origin)), abs=1e-12)
+
+
+def test_plane_batch_matches_plane():
+    points = random_points(200, 16)
+    triples = random_triples(40, len(points))
+    valid, distances = triple_distances(points, triples)
+    assert valid.all()
+    for triple, row in zip(triples, distances):
+        np.testing.assert_allclose(row, reference_distances(points, triple), atol=1e-10)
+
+
+def test_collinear_triples_are_invalid_rather_than_raising():
+    points = random_points(20, 8)
+    points[5] = 0.3 * points[3] + 0.7 * points[4]
+    triples = np.array([[3, 4, 5], [0, 1, 2]])
+    with pytest.raises(ValueError):
+        Plane(*points[[3, 4, 5]])
+    valid, _ = triple_distances(points, triples)
+    assert valid.tolist() == [False, True]
+
+
+def test_plane_batch_ignores_how_the_triple_is_ordered():
+    points = random_points(100, 10)
+    triples = random_triples(10, len(points))
+    _, sorted_order = triple_distances(points, triples)
+    _, reversed_order = triple_distances(points, triples[:, ::-1])
+    np.testing.assert_allclose(sorted_order, reversed_order, atol=1e-10)
+    assert PlaneBatch.from_indices(points, triples).valid.all()
+
+
+def near_collinear(count: int, dimension: int, seed: int = 0):
+    """Points with triples (3k, 3k+1, 3k+2) whose third word is ever closer to the second."""
+    rng = np.random.default_rng(seed)
+    points = rng.normal(size=(count, dimension))
+    triples = []
+    for k, offset in enumerate(np.logspace(-1, -6, 12)):
+        points[3 * k + 2] = points[3 * k + 1] + offset * rng.normal(size=dimension)
+        triples.append((3 * k, 3 * k + 1, 3 * k + 2))
+    return points, np.array(triples)
+
+
+def test_float32_falls_back_to_float64_for_nearly_parallel_directions():
+    points, triples = near_collinear(500, 64)
+    points = points.astype(np.float32)
+    # What float64 makes of the very same float32 embeddings
+    exact = PlaneBatch.from_indices(points, triples, dtype=np.float64).distances_to_planes(
+        points.astype(np.float64), exclude=triples)
+    plain = PlaneBatch.from_indices(points, triples).distances_to_planes(points, exclude=triples)
+    valid, distances = triple_distances(points, triples)
+    assert valid.all()
+    assert distances.dtype == np.float32
+    # Distances are around 11 here; without the fallback the last triples are off by up to 1e-2
+    assert np.nanmax(np.abs(plain - exact)) > 1e-3
+    np.testing.assert_allclose(distances, exact, atol=1e-4)
+    # Passing the float64 norms in changes nothing
+    float64_row_norms = np.einsum('ij,ij->i', points, points, dtype=np.float64)
+    _, with_norms = triple_distances(points, triples, float64_row_norms=float64_row_norms)
+    np.testing.assert_allclose(with_norms, distances, atol=1e-6)
@@ -0,0 +1,86 @@
+import sqlite3
+
+import numpy as np
+import pytest
+
+from embeddingstore import create_embedding_table, encode_embedding, set_table_format
+from plane import PlaneBatch, triple_distances
+from planegram import GRAM_MIN_DIMENSION, GramEngine, cached_gram, choose_engine, compute_gram
+
+
+def random_triples(count: int, vocab_size: int, seed: int = 0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    return np.sort(np.array([rng.choice(vocab_size, 3, replace=False) for _ in range(count)]), axis=1)
+
+
+def exact_distances(points: np.ndarray, triples: np.ndarray) -> np.ndarray:
+    return PlaneBatch.from_indices(points, triples, dtype=np.float64).distances_to_planes(
+        np.asarray(points, dtype=np.float64), exclude=triples)
+
+
+@pytest.mark.parametrize('dtype', [np.float64, np.float32])
+def test_gram_distances_match_the_direct_ones(dtype):
+    points = np.random.default_rng(0).normal(size=(300, 48)).astype(dtype)
+    triples = random_triples(50, len(points))
+    valid, distances = GramEngine(points).triple_distances(triples)
+    direct_valid, direct = triple_distances(points, triples)
+    assert distances.dtype == np.float64
+    np.testing.assert_array_equal(valid, direct_valid)
+    np.testing.assert_allclose(distances, exact_distances(points, triples), atol=1e-6)
+    np.testing.assert_allclose(distances, direct, atol=1e-4 if dtype == np.float32 else 1e-8)
+
+
+def test_nearly_collinear_triples_are_measured_directly():
+    rng = np.random.default_rng(1)
+    points = rng.normal(size=(2000, 64))
+    triples = []
+    for k, offset in enumerate(np.logspace(-1, -8, 15)):
+        points[3 * k + 2] = points[3 * k + 1] + offset * rng.normal(size=points.shape[1])
+        triples.append((3 * k, 3 * k + 1, 3 * k + 2))
+    triples = np.array(triples)
+    valid, distances = GramEngine(points).triple_distances(triples)
+    assert valid.all()
+    np.testing.assert_allclose(distances, exact_distances(points, triples), atol=1e-6)
+
+
+def test_collinear_triples_are_invalid():
+    points = np.random.default_rng(2).normal(size=(20, 8))
+    points[5] = 0.3 * points[3] + 0.7 * points[4]
+    valid, _ = GramEngine(points).triple_distances(np.array([[3, 4, 5], [0, 1, 2]]))
+    assert valid.tolist() == [False, True]
+
+
+def test_choosing_an_engine():
+    # 1000 words need 1000 * 1000 * 8 bytes, just under 8 MiB
+    assert choose_engine('auto', 1000, GRAM_MIN_DIMENSION, 8) == 'gram'
+    assert choose_engine('auto', 1000, GRAM_MIN_DIMENSION - 1, 8) == 'direct'
+    assert choose_engine('auto', 1000, GRAM_MIN_DIMENSION, 7) == 'direct'
+    assert choose_engine('direct', 1000, GRAM_MIN_DIMENSION, 8) == 'direct'
+    assert choose_engine('gram', 1000, 4, 8) == 'gram'
+    with pytest.raises(ValueError):
+        choose_engine('gram', 1000, GRAM_MIN_DIMENSION, 7)
+
+
+def test_cached_gram_is_rebuilt_when_the_table_changes(tmp_path):
+    conn = sqlite3.connect(':memory:')
+    create_embedding_table(conn, 'openai')
+    set_table_format(conn, 'openai_embeddings', 4)
+    points = np.random.default_rng(3).normal(size=(5, 4)).astype(np.float32)
+
+    def store(words):
+        with conn:
+            conn.executemany('INSERT OR REPLACE INTO openai_embeddings (adjective, gender, embedding) VALUES (?,?,?)',
+                             [(word, 'male', encode_embedding(points[i])) for i, word in enumerate(words)])
+
+    store(['a', 'b', 'c', 'd'])
+    first = cached_gram(conn, 'openai_embeddings', 'male', str(tmp_path), points[:4], 'abcd')
+    np.testing.assert_allclose(first, compute_gram(points[:4]))
+    assert isinstance(cached_gram(conn, 'openai_embeddings', 'male', str(tmp_path), points[:4], 'abcd'), np.memmap)
+    # The same rows in another order are another vocabulary, with a Gram matrix of their own
+    reordered = cached_gram(conn, 'openai_embeddings', 'male', str(tmp_path), points[3::-1], 'dcba')
+    np.testing.assert_allclose(reordered, compute_gram(points[3::-1]))
+    np.testing.assert_allclose(cached_gram(conn, 'openai_embeddings', 'male', str(tmp_path), points[:4], 'abcd'),
+                               compute_gram(points[:4]))
+    store(['a', 'b', 'c', 'd', 'e'])
+    np.testing.assert_allclose(cached_gram(conn, 'openai_embeddings', 'male', str(tmp_path), points, 'abcd'),
+                               compute_gram(points))
@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+
+from plane import Plane
+from planeindex import PlaneIndex, nearest_to_plane
+
+
+def clustered_points(count: int = 400, dimension: int = 24, seed: int = 0) -> np.ndarray:
+    """Points with a few strong directions, like embeddings, so that low-rank bounds are informative."""
+    rng = np.random.default_rng(seed)
+    scales = np.geomspace(3.0, 0.1, dimension)
+    return rng.normal(size=(count, dimension)) * scales
+
+
+@pytest.mark.parametrize('method', ['pca', 'random'])
+def test_lower_bounds_never_exceed_the_distances(method):
+    points = clustered_points()
+    index = PlaneIndex(points, rank=6, method=method)
+    for triple in [(0, 1, 2), (3, 50, 99), (7, 8, 300)]:
+        plane = Plane(*points[list(triple)], lightweight=True)
+        # Up to the rounding (about sqrt(eps)) that the exact query allows for
+        assert np.all(index.lower_bounds(plane) <= plane.distances_to_plane(points) + 1e-6)
+
+
+@pytest.mark.parametrize('method', ['pca', 'random'])
+@pytest.mark.parametrize('rank', [2, 6, 24])
+def test_exact_queries_match_a_full_scan(method, rank):
+    points = clustered_points()
+    index = PlaneIndex(points, rank=rank, method=method)
+    rng = np.random.default_rng(1)
+    for _ in range(10):
+        triple = list(rng.choice(len(points), 3, replace=False))
+        plane = Plane(*points[triple], lightweight=True)
+        expected = nearest_to_plane(points, plane, 15, exclude=triple)
+        # Far too few candidates on their own; the bounds must bring in the rest
+        indices, distances = index.query(plane, k=15, candidates=5, exclude=triple, exact=True)
+        np.testing.assert_array_equal(indices, expected[0])
+        np.testing.assert_allclose(distances, expected[1], rtol=1e-12)
+        assert not set(triple) & set(indices)
+
+
+def test_a_query_without_candidates_is_a_full_scan():
+    points = clustered_points(100)
+    index = PlaneIndex(points, rank=4)
+    plane = Plane(*points[:3], lightweight=True)
+    indices, distances = index.query(plane, k=100, candidates=None, exclude=[0, 1, 2])
+    assert len(indices) == 97
+    np.testing.assert_allclose(distances, np.sort(np.delete(plane.distances_to_plane(points), [0, 1, 2])))
@@ -0,0 +1,57 @@
+from itertools import combinations
+
+import numpy as np
+import pytest
+
+from plane import triple_distances
+from planesearch import SEARCH_OBJECTIVES, BeamSearch, random_triples
+from planestats import batch_statistics
+
+
+def points(vocab_size: int, dimension: int, seed: int = 0) -> np.ndarray:
+    return np.random.default_rng(seed).normal(size=(vocab_size, dimension))
+
+
+@pytest.mark.parametrize('objective', SEARCH_OBJECTIVES)
+def test_lower_bounds_never_exceed_the_objective(objective):
+    embeddings = points(200, 32)
+    search = BeamSearch(embeddings, objective, rank=8)
+    triples = random_triples(len(embeddings), 100, np.random.default_rng(1))
+    _, distances = triple_distances(embeddings, triples)
+    assert (search.lower_bounds(triples) <= batch_statistics(distances)[objective]).all()
+
+
+@pytest.mark.parametrize('vocab_size', [8, 60])
+def test_swap_candidates_are_never_the_triples_own_words(vocab_size):
+    # With 8 words there are fewer candidates than swap_candidates asks for
+    search = BeamSearch(points(vocab_size, 6), swap_candidates=24, random_candidates=0, rank=3)
+    search.start(count=8)
+    for _ in range(5):
+        search.step(16)
+    assert search.nearest
+    for triple, nearest in search.nearest.items():
+        assert len(nearest) == min(24, vocab_size - 3)
+        assert not set(triple) & set(nearest.tolist())
+    assert all(len(set(triple)) == 3 for triple in search.proposals().tolist())
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_search_converges_on_the_best_triple(seed):
+    embeddings = points(14, 6, seed)
+    everything = np.array(list(combinations(range(len(embeddings)), 3)))
+    _, distances = triple_distances(embeddings, everything)
+    best = batch_statistics(distances)['mean_distance'].min()
+    search = BeamSearch(embeddings, 'mean_distance', beam_width=4, rank=3, seed=seed)
+    search.start(count=8)
+    for _ in range(500):
+        triples, _, _, _ = search.step(16)
+        if len(triples) == 0:
+            break
+    assert search.best[0] == pytest.approx(best, rel=1e-12)
+    scores = [score for score, _ in search.beam]
+    assert scores == sorted(scores) and len(scores) == 4
+
+
+def test_unknown_objectives_are_rejected():
+    with pytest.raises(ValueError):
+        BeamSearch(points(10, 4), 'stddev_distance')
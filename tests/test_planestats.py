@@ -0,0 +1,36 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from planestats import PERCENTILES, batch_statistics
+
+
+def reference_statistics(row: np.ndarray) -> dict:
+    """The statistics of one distance vector, computed the way the finder originally did with pandas."""
+    series = pd.Series(row).dropna()
+    percentiles = np.percentile(series, PERCENTILES)
+    return {
+        'closest_index': series.idxmin(),
+        'how_close': series.min(),
+        'mean_distance': series.mean(),
+        'stddev_distance': series.std(),
+        'furthest': series.max(),
+        **dict(zip(['mili', 'percentile1', 'percentile25', 'percentile50', 'percentile75', 'percentile99'],
+                   percentiles)),
+    }
+
+
+@pytest.mark.parametrize('dtype', [np.float64, np.float32])
+def test_batch_statistics_match_pandas(dtype):
+    rng = np.random.default_rng(0)
+    distances = rng.gamma(2.0, size=(30, 257)).astype(dtype)
+    # Each row's own triple, at different places in each row
+    for k in range(len(distances)):
+        distances[k, rng.choice(distances.shape[1], 3, replace=False)] = np.nan
+    stats = batch_statistics(distances)
+    for k, row in enumerate(distances):
+        expected = reference_statistics(row.astype(np.float64))
+        assert stats['closest_index'][k] == expected.pop('closest_index')
+        for column, value in expected.items():
+            assert stats[column].dtype == np.float64
+            assert stats[column][k] == pytest.approx(value, rel=1e-6 if dtype == np.float32 else 1e-12), column
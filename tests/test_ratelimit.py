@@ -0,0 +1,57 @@
+import asyncio
+
+import pytest
+
+from ratelimit import AdaptiveTokenBucket, retry_with_backoff
+
+
+class Throttled(Exception):
+    pass
+
+
+class Broken(Exception):
+    pass
+
+
+def failing(*failures):
+    """A call that raises each of `failures` in turn and then returns how many calls it took."""
+    calls = []
+
+    async def call():
+        calls.append(None)
+        if len(calls) <= len(failures):
+            raise failures[len(calls) - 1]
+        return len(calls)
+
+    return call
+
+
+def retry(call, **options):
+    return asyncio.run(retry_with_backoff(call, retry_on=(Broken,), throttled_on=(Throttled,), base_delay=0.0001,
+                                          max_delay=0.001, **options))
+
+
+def test_throttling_has_a_budget_of_its_own():
+    # Far more 429s than `attempts`, interleaved with errors that stay within it
+    assert retry(failing(*[Throttled()] * 12, Broken(), *[Throttled()] * 5, Broken()), attempts=3) == 20
+
+
+def test_each_budget_runs_out():
+    with pytest.raises(Broken):
+        retry(failing(Throttled(), Broken(), Broken(), Broken()), attempts=3)
+    with pytest.raises(Throttled):
+        retry(failing(*[Throttled()] * 6), throttled_attempts=6)
+
+
+def test_other_exceptions_are_not_retried():
+    with pytest.raises(KeyError):
+        retry(failing(KeyError()))
+
+
+def test_adaptive_rate_halves_once_per_cooldown_and_creeps_back():
+    bucket = AdaptiveTokenBucket(8.0, increase=0.5, cooldown=60)
+    bucket.throttled()
+    bucket.throttled()
+    assert bucket.rate == 4.0
+    bucket.succeeded()
+    assert bucket.rate == 4.5
@@ -0,0 +1,43 @@
+from responsecache import ResponseCache, cache_key
+
+
+def test_keys_depend_on_provider_model_and_request():
+    keys = {cache_key('openai', 'small', 'He is kind'), cache_key('ollama', 'small', 'He is kind'),
+            cache_key('openai', 'large', 'He is kind'), cache_key('openai', 'small', 'She is kind')}
+    assert len(keys) == 4
+    assert cache_key('anthropic', 'm', {'a': 1, 'b': 2}) == cache_key('anthropic', 'm', {'b': 2, 'a': 1})
+
+
+def test_responses_are_found_again_and_counted(tmp_path):
+    cache = ResponseCache(str(tmp_path / 'cache.sqlite'))
+    cache.put_many('openai', 'small', ['a', 'b'], [b'1', b'22'])
+    cache.put_json('anthropic', 'm', {'prompt': 'x'}, {'answer': True})
+    assert cache.get_many('openai', 'small', ['b', 'c', 'a']) == [b'22', None, b'1']
+    assert cache.get('openai', 'other', 'a') is None
+    assert cache.get_json('anthropic', 'm', {'prompt': 'x'}) == {'answer': True}
+    assert (cache.hits, cache.misses) == (3, 2)
+    assert "3 hits, 2 misses (60% hit rate)" in cache.summary()
+    cache.close()
+    # Another process, or a later run, sees the same entries
+    reopened = ResponseCache(str(tmp_path / 'cache.sqlite'))
+    assert reopened.size()['entries'] == 3
+    assert reopened.conn.execute("SELECT hits FROM responses WHERE key = ?",
+                                 [cache_key('openai', 'small', 'a')]).fetchone()[0] == 1
+    reopened.close()
+
+
+def test_least_recently_used_responses_are_evicted(tmp_path, monkeypatch):
+    clock = iter(range(100))
+    monkeypatch.setattr('responsecache.time.time', lambda: next(clock))
+    cache = ResponseCache(str(tmp_path / 'cache.sqlite'), max_bytes=30)
+    for request in ['a', 'b', 'c']:
+        cache.put('openai', 'small', request, b'x' * 10)
+    # Using 'a' makes 'b' the least recently used
+    assert cache.get('openai', 'small', 'a') is not None
+    cache.put('openai', 'small', 'd', b'x' * 10)
+    assert cache.get_many('openai', 'small', ['a', 'b', 'c', 'd']) == [b'x' * 10, None, b'x' * 10, b'x' * 10]
+    assert cache.evictions == 1 and cache.size() == {'entries': 3, 'bytes': 30}
+    # One large response can push out several
+    cache.put('openai', 'small', 'e', b'y' * 25)
+    assert cache.size() == {'entries': 1, 'bytes': 25} and cache.evictions == 4
+    cache.close()
@@ -0,0 +1,79 @@
+import sqlite3
+
+import numpy as np
+import pytest
+
+from sketches import Moments, PlaneSketches, QuantileSketch, create_sketch_table, load_sketches, save_sketches
+
+
+def distances(seed: int = 0, size: int = 20000) -> np.ndarray:
+    return np.random.default_rng(seed).gamma(3.0, 2.0, size=size)
+
+
+@pytest.mark.parametrize('relative_accuracy', [0.01, 0.05])
+def test_quantiles_are_within_the_relative_accuracy(relative_accuracy):
+    values = distances()
+    sketch = QuantileSketch(relative_accuracy)
+    sketch.update(values)
+    assert sketch.count == len(values)
+    for q in [0, 0.001, 0.01, 0.25, 0.5, 0.75, 0.99, 1]:
+        # The sketch answers with the value at rank floor(q * (n - 1))
+        exact = np.quantile(values, q, method='lower')
+        assert abs(sketch.quantile(q) - exact) <= relative_accuracy * exact * (1 + 1e-9)
+
+
+def test_quantile_sketch_ignores_nan_and_counts_zeros():
+    sketch = QuantileSketch()
+    assert np.isnan(sketch.quantile(0.5))
+    sketch.update(np.array([np.nan, 0.0, 0.0, 0.0, 5.0, np.nan]))
+    assert sketch.count == 4
+    assert sketch.quantile(0.5) == 0.0
+    assert sketch.quantile(1) == pytest.approx(5.0, rel=0.01)
+
+
+def test_merged_quantile_sketches_equal_one_sketch_of_everything():
+    values = distances()
+    whole = QuantileSketch()
+    whole.update(values)
+    merged = QuantileSketch()
+    for part in np.array_split(values, 7):
+        sketch = QuantileSketch()
+        sketch.update(part)
+        merged.merge(sketch)
+    assert (merged.offset, merged.counts.tolist()) == (whole.offset, whole.counts.tolist())
+    with pytest.raises(ValueError):
+        merged.merge(QuantileSketch(0.05))
+
+
+def test_moments_match_numpy_however_the_stream_is_split():
+    values = distances(1) + 1e6
+    moments = Moments()
+    for part in np.array_split(values, 13):
+        half = Moments()
+        half.update(part)
+        moments.merge(half)
+    assert moments.count == len(values)
+    assert moments.mean == pytest.approx(values.mean(), rel=1e-12)
+    # The offset would wreck the variance of a naive sum of squares
+    assert moments.variance == pytest.approx(values.var(ddof=1), rel=1e-9)
+    assert (moments.minimum, moments.maximum) == (values.min(), values.max())
+
+
+def test_moments_of_nothing():
+    moments = Moments()
+    moments.update(np.array([np.nan]))
+    assert moments.count == 0 and np.isnan(moments.variance)
+    assert Moments.from_dict(moments.to_dict()).count == 0
+
+
+def test_sketches_round_trip_through_the_database():
+    sketches = PlaneSketches()
+    sketches.add_distances(distances().reshape(20, -1))
+    conn = sqlite3.connect(':memory:')
+    cursor = conn.cursor()
+    create_sketch_table(cursor)
+    save_sketches(cursor, 'male', 'openai', sketches)
+    loaded = load_sketches(cursor, 'male', 'openai')['distances']
+    assert loaded.sketch.quantile(0.5) == sketches['distances'].sketch.quantile(0.5)
+    assert loaded.moments.variance == sketches['distances'].moments.variance
+    assert load_sketches(cursor, 'female', 'openai')['distances'].moments.count == 0
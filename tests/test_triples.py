@@ -0,0 +1,94 @@
+import sqlite3
+from itertools import combinations
+
+import numpy as np
+import pytest
+
+from triples import (CompletedTriples, FeistelPermutation, TripleScheduler, pack_triple, pack_triples, rank_triple,
+                     unrank_pairs, unrank_triples)
+
+
+@pytest.mark.parametrize('size', [1, 2, 3, 5, 16, 17, 1000, 4097])
+@pytest.mark.parametrize('seed', [0, 1, 12345])
+def test_feistel_permutation_is_a_bijection(size, seed):
+    permuted = FeistelPermutation(size, seed)(np.arange(size))
+    assert sorted(permuted.tolist()) == list(range(size))
+
+
+def test_feistel_permutation_depends_on_the_seed():
+    positions = np.arange(1000)
+    assert not np.array_equal(FeistelPermutation(1000, 0)(positions), FeistelPermutation(1000, 1)(positions))
+    np.testing.assert_array_equal(FeistelPermutation(1000, 7)(positions), FeistelPermutation(1000, 7)(positions))
+
+
+def test_unranking_follows_the_combinatorial_number_system():
+    # Ranks in order are the triples ordered by k, then j, then i
+    expected = sorted(combinations(range(12), 3), key=lambda triple: triple[::-1])
+    assert [tuple(triple) for triple in unrank_triples(np.arange(len(expected)))] == expected
+    expected_pairs = sorted(combinations(range(12), 2), key=lambda pair: pair[::-1])
+    assert [tuple(pair) for pair in unrank_pairs(np.arange(len(expected_pairs)))] == expected_pairs
+
+
+def test_unranking_round_trips_for_large_vocabularies():
+    vocab_size = 400000
+    total = vocab_size * (vocab_size - 1) * (vocab_size - 2) // 6
+    ranks = np.concatenate([np.arange(5), np.random.default_rng(0).integers(0, total, 2000),
+                            np.arange(total - 5, total)])
+    triples = unrank_triples(ranks)
+    assert (triples[:, 0] < triples[:, 1]).all() and (triples[:, 1] < triples[:, 2]).all()
+    assert triples[:, 2].max() == vocab_size - 1
+    assert [rank_triple(triple) for triple in triples] == ranks.tolist()
+
+
+@pytest.mark.parametrize('vocab_size', [3, 4, 7, 20, 41])
+@pytest.mark.parametrize('seed', [0, 3])
+def test_scheduler_visits_every_triple_once(vocab_size, seed):
+    scheduler = TripleScheduler(vocab_size, seed)
+    assert scheduler.size == len(list(combinations(range(vocab_size), 3)))
+    # Resuming part way through gives the same schedule as one pass
+    middle = scheduler.size // 3
+    scheduled = np.vstack([scheduler.triples(0, middle), scheduler.triples(middle, scheduler.size + 10)])
+    assert len(scheduled) == scheduler.size
+    assert {tuple(triple) for triple in scheduled} == set(combinations(range(vocab_size), 3))
+
+
+@pytest.mark.parametrize('vocab_size, anchor', [(3, 0), (5, 4), (20, 0), (20, 7), (41, 40)])
+def test_anchored_scheduler_visits_every_triple_with_the_anchor_once(vocab_size, anchor):
+    scheduler = TripleScheduler(vocab_size, seed=1, anchor=anchor)
+    expected = {triple for triple in combinations(range(vocab_size), 3) if anchor in triple}
+    assert scheduler.size == len(expected)
+    scheduled = scheduler.triples(0, scheduler.size)
+    assert len(scheduled) == scheduler.size
+    assert {tuple(triple) for triple in scheduled} == expected
+
+
+def test_scheduler_order_depends_on_the_seed():
+    first, second = TripleScheduler(30, seed=0), TripleScheduler(30, seed=1)
+    assert not np.array_equal(first.triples(0, 100), second.triples(0, 100))
+    np.testing.assert_array_equal(first.triples(0, 100), TripleScheduler(30, seed=0).triples(0, 100))
+
+
+def test_packing_ignores_the_order_of_the_indices():
+    triples = np.array([[3, 1, 2], [0, 9, 4], [7, 8, 6]])
+    assert pack_triple((3, 1, 2), 10) == pack_triple((1, 2, 3), 10) == 123
+    np.testing.assert_array_equal(pack_triples(triples, 10), [pack_triple(triple, 10) for triple in triples])
+
+
+def test_completed_triples_combine_loaded_and_added_ones():
+    completed = CompletedTriples(10, pack_triples(np.array([[1, 2, 3], [4, 5, 6], [1, 2, 3]]), 10))
+    assert len(completed) == 2
+    assert (3, 2, 1) in completed and (4, 5, 6) in completed and (1, 2, 4) not in completed
+    completed.add((4, 2, 1))
+    assert (1, 2, 4) in completed and len(completed) == 3
+    np.testing.assert_array_equal(completed.packed(), [123, 124, 456])
+    np.testing.assert_array_equal(CompletedTriples(10).packed(), [])
+
+
+def test_completed_triples_from_the_database_skip_words_outside_the_vocabulary():
+    conn = sqlite3.connect(':memory:')
+    conn.execute('CREATE TABLE planar_statistics (adjective1, adjective2, adjective3, gender, embedding_provider)')
+    conn.executemany('INSERT INTO planar_statistics VALUES (?, ?, ?, ?, ?)',
+                     [('a', 'b', 'c', 'male', 'openai'), ('a', 'b', 'gone', 'male', 'openai'),
+                      ('b', 'c', 'd', 'female', 'openai'), ('b', 'c', 'd', 'male', 'ollama')])
+    completed = CompletedTriples.from_database(conn.cursor(), 'male', 'openai', {'d': 0, 'c': 1, 'b': 2, 'a': 3})
+    assert len(completed) == 1 and (1, 2, 3) in completed
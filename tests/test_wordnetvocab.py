@@ -0,0 +1,86 @@
+import gzip
+import os
+
+import pytest
+
+import wordnetvocab
+from wordnetvocab import load_snapshot, wordnet_adjectives
+
+ADJECTIVES = ['kind', 'able', 'kind', 'brave', 'able']
+
+
+@pytest.fixture
+def corpus(tmp_path, monkeypatch):
+    """A stand-in WordNet corpus in NLTK_DATA: (its adjective data file, a list of reads, its adjectives)."""
+    data = tmp_path / 'nltk_data' / 'corpora' / 'wordnet' / 'data.adj'
+    data.parent.mkdir(parents=True)
+    data.write_text('version 1')
+    monkeypatch.setenv('NLTK_DATA', str(tmp_path / 'nltk_data'))
+    reads = []
+    adjectives = list(ADJECTIVES)
+
+    def stream_adjectives():
+        reads.append(1)
+        return iter(adjectives)
+
+    monkeypatch.setattr(wordnetvocab, 'stream_adjectives', stream_adjectives)
+    monkeypatch.setattr(wordnetvocab, 'wordnet_version', lambda: '3.0')
+    return data, reads, adjectives
+
+
+def test_the_snapshot_is_reused_while_the_corpus_is_unchanged(tmp_path, corpus):
+    data, reads, _ = corpus
+    snapshot = str(tmp_path / 'adjectives.txt.gz')
+    assert wordnet_adjectives(snapshot) == ['able', 'brave', 'kind']
+    header, words = load_snapshot(snapshot)
+    assert words == ['able', 'brave', 'kind'] and header['count'] == 3
+    assert header['key']['path'] == str(data) and header['wordnet_version'] == '3.0'
+    assert wordnet_adjectives(snapshot) == ['able', 'brave', 'kind']
+    assert len(reads) == 1
+    assert wordnet_adjectives(snapshot, refresh=True) == ['able', 'brave', 'kind']
+    assert len(reads) == 2
+
+
+def test_a_changed_corpus_makes_the_snapshot_stale(tmp_path, corpus):
+    data, reads, adjectives = corpus
+    snapshot = str(tmp_path / 'adjectives.txt.gz')
+    wordnet_adjectives(snapshot)
+    data.write_text('version 2, a little longer')
+    adjectives.append('new')
+    assert wordnet_adjectives(snapshot) == ['able', 'brave', 'kind', 'new']
+    assert len(reads) == 2
+
+
+def test_an_unreadable_snapshot_is_rebuilt(tmp_path, corpus):
+    _, reads, _ = corpus
+    snapshot = tmp_path / 'adjectives.txt.gz'
+    snapshot.write_bytes(b'not gzip')
+    assert wordnet_adjectives(str(snapshot)) == ['able', 'brave', 'kind']
+    with gzip.open(snapshot, 'rt') as f:
+        assert f.read().endswith('able\nbrave\nkind\n')
+    assert len(reads) == 1
+
+
+def test_any_snapshot_is_used_when_the_corpus_cannot_be_found(tmp_path, corpus, monkeypatch):
+    _, reads, _ = corpus
+    snapshot = str(tmp_path / 'adjectives.txt.gz')
+    wordnet_adjectives(snapshot)
+    monkeypatch.setattr(wordnetvocab, 'nltk_data_directories', lambda: [str(tmp_path / 'elsewhere')])
+    assert wordnet_adjectives(snapshot) == ['able', 'brave', 'kind']
+    assert len(reads) == 1
+
+
+def test_the_snapshot_matches_wordnet(tmp_path):
+    nltk = pytest.importorskip('nltk')
+    try:
+        nltk.data.find('corpora/wordnet')
+    except LookupError:
+        pytest.skip("the WordNet corpus is not installed")
+    from nltk.corpus import wordnet as wn
+    expected = sorted({name for synset in wn.all_synsets(pos=wn.ADJ)
+                       for name in [synset.name().split('.')[0]] + synset.lemma_names()})
+    snapshot = str(tmp_path / 'adjectives.txt.gz')
+    assert wordnet_adjectives(snapshot) == expected
+    header, _ = load_snapshot(snapshot)
+    assert header['key'] is not None and os.path.exists(header['key']['path'])
+    assert wordnet_adjectives(snapshot) == expected
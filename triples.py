@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+
+import hashlib
+import sqlite3
+from typing import Dict, Iterable, Optional, Tuple
+
+import numpy as np
+
+
+def pack_triple(triple: Iterable[int], vocab_size: int) -> int:
+    """Encode three vocabulary indices, in any order, as one integer i*N^2 + j*N + k with i < j < k."""
+    i, j, k = sorted(int(index) for index in triple)
+    return (i * vocab_size + j) * vocab_size + k
+
+
+def pack_triples(triples: np.ndarray, vocab_size: int) -> np.ndarray:
+    """Vectorised pack_triple for a (K, 3) array of indices."""
+    ordered = np.sort(np.asarray(triples, dtype=np.int64), axis=1)
+    return (ordered[:, 0] * vocab_size + ordered[:, 1]) * vocab_size + ordered[:, 2]
+
+
+class CompletedTriples:
+    def __init__(self, vocab_size: int, packed: Optional[np.ndarray] = None):
+        """
+        The set of triples that already have planar_statistics rows.
+
+        Triples loaded up front sit in a sorted int64 array (8 bytes each,
+        searched with np.searchsorted); triples added while running go into
+        an ordinary set.
+
+        Args:
+            vocab_size (int): Number of words the indices refer to
+            packed (np.ndarray): Packed triples to start with
+        """
+        self.vocab_size = vocab_size
+        if packed is None:
+            packed = np.empty(0, dtype=np.int64)
+        self._loaded = np.unique(np.asarray(packed, dtype=np.int64))
+        self._added = set()
+
+    @classmethod
+    def from_database(cls, cursor: sqlite3.Cursor, gender: str, embedding_provider: str,
+                      vocab_index: Dict[str, int]) -> "CompletedTriples":
+        """Load the triples stored for one gender and provider, ignoring words no longer in the vocabulary."""
+        cursor.execute("""select adjective1, adjective2, adjective3 from planar_statistics
+          where gender = ? and embedding_provider = ?""", [gender, embedding_provider])
+        vocab_size = len(vocab_index)
+        packed = [pack_triple((vocab_index[word1], vocab_index[word2], vocab_index[word3]), vocab_size)
+                  for word1, word2, word3 in cursor
+                  if word1 in vocab_index and word2 in vocab_index and word3 in vocab_index]
+        return cls(vocab_size, np.array(packed, dtype=np.int64))
+
+    def _contains_packed(self, key: int) -> bool:
+        if key in self._added:
+            return True
+        position = np.searchsorted(self._loaded, key)
+        return position < len(self._loaded) and self._loaded[position] == key
+
+    def __contains__(self, triple: Tuple[int, int, int]) -> bool:
+        return self._contains_packed(pack_triple(triple, self.vocab_size))
+
+    def add(self, triple: Tuple[int, int, int]) -> None:
+        self._added.add(pack_triple(triple, self.vocab_size))
+
+    def __len__(self) -> int:
+        return len(self._loaded) + len(self._added)
+
+    def packed(self) -> np.ndarray:
+        """All triples as one sorted packed array, e.g. to hand to another process."""
+        return np.union1d(self._loaded, np.fromiter(self._added, dtype=np.int64, count=len(self._added)))
+
+
+def _choose3(c: np.ndarray) -> np.ndarray:
+    return c * (c - 1) * (c - 2) // 6
+
+
+def _choose2(c: np.ndarray) -> np.ndarray:
+    return c * (c - 1) // 2
+
+
+def _largest_below(estimate: np.ndarray, ranks: np.ndarray, choose) -> np.ndarray:
+    """Correct a floating-point estimate to the largest c with choose(c) <= rank, exactly."""
+    c = np.maximum(estimate.astype(np.int64), 0)
+    while True:
+        too_small = choose(c + 1) <= ranks
+        too_big = choose(c) > ranks
+        if not (too_small.any() or too_big.any()):
+            return c
+        c = c + too_small - too_big
+
+
+def unrank_pairs(ranks: np.ndarray) -> np.ndarray:
+    """Map ranks 0 .. C(N, 2)-1 to the index pairs (i, j), i < j, of the combinatorial number system."""
+    ranks = np.asarray(ranks, dtype=np.int64)
+    j = _largest_below(np.sqrt(2.0 * ranks), ranks, _choose2)
+    i = ranks - _choose2(j)
+    return np.stack([i, j], axis=1)
+
+
+def unrank_triples(ranks: np.ndarray) -> np.ndarray:
+    """
+    Map ranks 0 .. C(N, 3)-1 to index triples (i, j, k), i < j < k.
+
+    This is the combinatorial number system: rank = C(k, 3) + C(j, 2) + i.
+    """
+    ranks = np.asarray(ranks, dtype=np.int64)
+    k = _largest_below(np.cbrt(6.0 * ranks), ranks, _choose3)
+    pairs = unrank_pairs(ranks - _choose3(k))
+    return np.column_stack([pairs, k])
+
+
+def rank_triple(triple: Iterable[int]) -> int:
+    """Inverse of unrank_triples for a single triple."""
+    i, j, k = sorted(int(index) for index in triple)
+    return k * (k - 1) * (k - 2) // 6 + j * (j - 1) // 2 + i
+
+
+class FeistelPermutation:
+    def __init__(self, size: int, seed: int, rounds: int = 4):
+        """
+        A seeded pseudo-random permutation of 0 .. size-1 that needs no storage.
+
+        A balanced Feistel network permutes the smallest even-bit-width range
+        covering `size`; values that land outside the range are fed through
+        again (cycle walking) until they fall inside it.
+        """
+        self.size = size
+        bits = max(2, int(size - 1).bit_length())
+        self.half_bits = (bits + 1) // 2
+        self.mask = np.uint64((1 << self.half_bits) - 1)
+        rng = np.random.default_rng(seed)
+        self.keys = rng.integers(0, 2**63, size=rounds, dtype=np.uint64)
+
+    def _round_function(self, right: np.ndarray, key: np.uint64) -> np.ndarray:
+        # splitmix64 finaliser
+        z = right + key
+        z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        return (z ^ (z >> np.uint64(31))) & self.mask
+
+    def _encrypt(self, values: np.ndarray) -> np.ndarray:
+        shift = np.uint64(self.half_bits)
+        left = values >> shift
+        right = values & self.mask
+        for key in self.keys:
+            left, right = right, left ^ self._round_function(right, key)
+        return (left << shift) | right
+
+    def __call__(self, positions: np.ndarray) -> np.ndarray:
+        with np.errstate(over='ignore'):
+            values = self._encrypt(np.asarray(positions, dtype=np.uint64))
+            outside = values >= self.size
+            while outside.any():
+                values[outside] = self._encrypt(values[outside])
+                outside = values >= self.size
+        return values.astype(np.int64)
+
+
+class TripleScheduler:
+    def __init__(self, vocab_size: int, seed: int = 0, anchor: Optional[int] = None):
+        """
+        Enumerates every triple exactly once, in a seeded random order.
+
+        Position p of the schedule is the triple unranked from permutation(p),
+        so the schedule can be resumed from nothing more than the next
+        position to process. With an anchor, only the C(N-1, 2) triples
+        containing that word are enumerated.
+
+        Args:
+            vocab_size (int): Number of words
+            seed (int): Seed for the permutation
+            anchor (int): Index of a word that every triple must contain
+        """
+        self.vocab_size = vocab_size
+        self.anchor = anchor
+        self.permutation_seed = seed
+        if anchor is None:
+            self.size = vocab_size * (vocab_size - 1) * (vocab_size - 2) // 6
+        else:
+            self.size = (vocab_size - 1) * (vocab_size - 2) // 2
+        self.permutation = FeistelPermutation(self.size, seed)
+
+    def triples(self, start: int, stop: int) -> np.ndarray:
+        """The (K, 3) sorted index triples at schedule positions start .. stop-1."""
+        positions = np.arange(start, min(stop, self.size), dtype=np.int64)
+        ranks = self.permutation(positions)
+        if self.anchor is None:
+            return unrank_triples(ranks)
+        others = unrank_pairs(ranks)
+        others += others >= self.anchor
+        anchors = np.full((len(others), 1), self.anchor, dtype=np.int64)
+        return np.sort(np.hstack([anchors, others]), axis=1)
+
+
+def vocab_fingerprint(vocab: Iterable[str]) -> str:
+    """Short hash of an ordered vocabulary; schedules only make sense against the same one."""
+    return hashlib.sha1('\n'.join(vocab).encode('utf-8')).hexdigest()
+
+
+def create_checkpoint_table(cursor: sqlite3.Cursor) -> None:
+    cursor.execute("""create table if not exists schedule_checkpoints (
+      gender text,
+      embedding_provider text,
+      seed integer,
+      anchor text,
+      vocabulary text,
+      next_position integer,
+      primary key (gender, embedding_provider, seed, anchor, vocabulary)
+    )""")
+
+
+def load_checkpoint(cursor: sqlite3.Cursor, key: Tuple[str, str, int, str, str]) -> int:
+    """The next schedule position to process for (gender, provider, seed, anchor, vocabulary), or 0."""
+    cursor.execute("""select next_position from schedule_checkpoints where
+      gender = ? and embedding_provider = ? and seed = ? and anchor = ? and vocabulary = ?""", list(key))
+    row = cursor.fetchone()
+    return 0 if row is None else row[0]
+
+
+def save_checkpoint(cursor: sqlite3.Cursor, key: Tuple[str, str, int, str, str], next_position: int) -> None:
+    cursor.execute("""insert or replace into schedule_checkpoints
+      (gender, embedding_provider, seed, anchor, vocabulary, next_position) values (?,?,?,?,?,?)""",
+                   list(key) + [next_position])
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+
+import json
+import sqlite3
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from triples import vocab_fingerprint
+
+
+def create_vocabulary_table(cursor: sqlite3.Cursor) -> None:
+    """Create the table of every vocabulary planar_statistics rows have been computed against."""
+    cursor.execute("""create table if not exists vocabularies (
+      vocabulary text,
+      gender text,
+      embedding_provider text,
+      words text,
+      primary key (vocabulary, gender, embedding_provider)
+    )""")
+
+
+def register_vocabulary(cursor: sqlite3.Cursor, gender: str, embedding_provider: str, vocab: List[str]) -> str:
+    """Record an ordered vocabulary, making it the latest for (gender, provider), and return its fingerprint."""
+    fingerprint = vocab_fingerprint(vocab)
+    # Replacing the row gives it a new rowid, which is what latest_vocabulary goes by
+    cursor.execute("""insert or replace into vocabularies (vocabulary, gender, embedding_provider, words)
+      values (?,?,?,?)""", [fingerprint, gender, embedding_provider, json.dumps(vocab)])
+    return fingerprint
+
+
+def load_vocabulary(cursor: sqlite3.Cursor, fingerprint: str) -> Optional[List[str]]:
+    cursor.execute("select words from vocabularies where vocabulary = ? limit 1", [fingerprint])
+    row = cursor.fetchone()
+    return None if row is None else json.loads(row[0])
+
+
+def latest_vocabulary(cursor: sqlite3.Cursor, gender: str, embedding_provider: str) -> Optional[str]:
+    """Fingerprint of the vocabulary most recently registered for (gender, provider)."""
+    cursor.execute("""select vocabulary from vocabularies where gender = ? and embedding_provider = ?
+      order by rowid desc limit 1""", [gender, embedding_provider])
+    row = cursor.fetchone()
+    return None if row is None else row[0]
+
+
+def stale_counts(cursor: sqlite3.Cursor, gender: str, embedding_provider: str,
+                 fingerprint: str) -> Dict[Optional[str], int]:
+    """Rows computed against any other vocabulary than `fingerprint`, by vocabulary (None where unrecorded)."""
+    cursor.execute("""select vocabulary, count(*) from planar_statistics
+      where gender = ? and embedding_provider = ? and (vocabulary is null or vocabulary != ?)
+      group by vocabulary""", [gender, embedding_provider, fingerprint])
+    return dict(cursor.fetchall())
+
+
+class VocabularyChange:
+    def __init__(self, old: List[str], new: List[str]):
+        """
+        How to turn a distance vector over one vocabulary into one over another.
+
+        Words in both keep their distances (which do not depend on the rest
+        of the vocabulary); only the `added` ones, given as indices into
+        `new`, need measuring. `removed` words are simply dropped.
+        """
+        old_index = {word: i for i, word in enumerate(old)}
+        new_index = {word: i for i, word in enumerate(new)}
+        kept = [word for word in new if word in old_index]
+        self.old = old
+        self.new = new
+        self.kept_old = np.array([old_index[word] for word in kept], dtype=np.int64)
+        self.kept_new = np.array([new_index[word] for word in kept], dtype=np.int64)
+        self.added = np.array([i for i, word in enumerate(new) if word not in old_index], dtype=np.int64)
+        self.removed = [word for word in old if word not in new_index]
+
+    def old_to_new(self, triples: np.ndarray) -> np.ndarray:
+        """Re-index (K, 3) triples over the old vocabulary; -1 wherever a word has been removed."""
+        mapping = np.full(len(self.old), -1, dtype=np.int64)
+        mapping[self.kept_old] = self.kept_new
+        return mapping[np.asarray(triples, dtype=np.int64)]
+
+    def carry_over(self, distances: np.ndarray) -> np.ndarray:
+        """(K, len(old)) distances as (K, len(new)) ones, NaN in the columns of the added words."""
+        result = np.full((len(distances), len(self.new)), np.nan, dtype=np.float64)
+        result[:, self.kept_new] = distances[:, self.kept_old]
+        return result
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+
+"""
+WordNet's adjectives, kept in a snapshot file so that most runs never load NLTK.
+
+    python wordnetvocab.py info
+    python wordnetvocab.py build
+
+The snapshot (wordnet_adjectives.txt.gz by default) is gzipped text: a JSON
+header line, then the sorted, deduplicated adjectives one per line. The
+header holds the key it was built for: where the WordNet corpus lives and
+the size and modification time of its adjective data, which can be
+checked with a couple of stat calls. Only when that key changes (or there
+is no snapshot) is NLTK imported and the corpus read again.
+"""
+
+import argparse
+import gzip
+import json
+import os
+import sys
+import tempfile
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+# Bump when the extraction below changes, so that old snapshots are rebuilt
+SNAPSHOT_FORMAT = 1
+DEFAULT_SNAPSHOT = 'wordnet_adjectives.txt.gz'
+
+
+def nltk_data_directories() -> List[str]:
+    """The directories NLTK searches for corpora, worked out without importing it."""
+    directories = [directory for directory in os.environ.get('NLTK_DATA', '').split(os.pathsep) if directory]
+    directories.append(os.path.expanduser('~/nltk_data'))
+    directories += [os.path.join(sys.prefix, 'nltk_data'), os.path.join(sys.prefix, 'share', 'nltk_data'),
+                    os.path.join(sys.prefix, 'lib', 'nltk_data'), '/usr/share/nltk_data',
+                    '/usr/local/share/nltk_data', '/usr/lib/nltk_data', '/usr/local/lib/nltk_data']
+    return directories
+
+
+def wordnet_corpus_key() -> Optional[Dict[str, Any]]:
+    """Identify the WordNet corpus NLTK would load, or None if it is not in any of the usual places."""
+    for directory in nltk_data_directories():
+        for path in [os.path.join(directory, 'corpora', 'wordnet', 'data.adj'),
+                     os.path.join(directory, 'corpora', 'wordnet.zip')]:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            return {'format': SNAPSHOT_FORMAT, 'path': os.path.abspath(path), 'size': stat.st_size,
+                    'mtime_ns': stat.st_mtime_ns}
+    return None
+
+
+def stream_adjectives() -> Iterator[str]:
+    """
+    Yield the name of every adjective synset and all its lemma names, with repeats.
+
+    Synsets are read one at a time from NLTK's generator rather than
+    collected into a list first.
+    """
+    from nltk.corpus import wordnet as wn
+    # Download required NLTK data if not already present
+    #nltk.download('wordnet')
+    for synset in wn.all_synsets(pos=wn.ADJ):
+        yield synset.name().split('.')[0]
+        yield from synset.lemma_names()
+
+
+def wordnet_version() -> Optional[str]:
+    from nltk.corpus import wordnet as wn
+    return wn.get_version()
+
+
+def load_snapshot(path: str) -> Optional[Tuple[Dict[str, Any], List[str]]]:
+    """(header, words) from a snapshot file, or None if there is no readable one."""
+    try:
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            header = json.loads(f.readline())
+            words = f.read().split('\n')
+    except (OSError, ValueError, EOFError):
+        return None
+    return header, [word for word in words if word]
+
+
+def save_snapshot(path: str, header: Dict[str, Any], words: List[str]) -> None:
+    directory = os.path.dirname(os.path.abspath(path))
+    with tempfile.NamedTemporaryFile(dir=directory, suffix='.gz', delete=False) as f:
+        with gzip.open(f, 'wt', encoding='utf-8') as g:
+            g.write(json.dumps(header) + '\n')
+            g.write('\n'.join(words) + '\n')
+    os.replace(f.name, path)
+
+
+def build_snapshot(path: str) -> List[str]:
+    """Read every adjective from WordNet and save the sorted, deduplicated list."""
+    words = sorted(set(stream_adjectives()))
+    header = {'key': wordnet_corpus_key(), 'wordnet_version': wordnet_version(), 'count': len(words)}
+    save_snapshot(path, header, words)
+    return words
+
+
+def wordnet_adjectives(path: str = DEFAULT_SNAPSHOT, refresh: bool = False) -> List[str]:
+    """
+    Every WordNet adjective, sorted: from the snapshot if it is current, otherwise from NLTK.
+
+    A snapshot is current if it was built from the corpus that is installed
+    now. If the corpus cannot be found without NLTK's help, any snapshot is
+    taken to be current; `refresh` rebuilds it regardless.
+    """
+    snapshot = None if refresh else load_snapshot(path)
+    if snapshot is not None:
+        header, words = snapshot
+        key = wordnet_corpus_key()
+        if key is None or header.get('key') == key:
+            return words
+    return build_snapshot(path)
+
+
+def info(args: argparse.Namespace) -> None:
+    snapshot = load_snapshot(args.snapshot)
+    key = wordnet_corpus_key()
+    print(f"Installed corpus: {key['path'] if key else 'not found in the usual places'}")
+    if snapshot is None:
+        print(f"No snapshot at {args.snapshot}")
+        return
+    header, words = snapshot
+    current = key is None or header.get('key') == key
+    print(f"{args.snapshot}: {len(words)} adjectives from WordNet {header.get('wordnet_version')}, "
+          f"{'current' if current else 'stale'}")
+
+
+def build(args: argparse.Namespace) -> None:
+    words = build_snapshot(args.snapshot)
+    print(f"Saved {len(words)} adjectives to {args.snapshot}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Snapshot of the WordNet adjectives.')
+    parser.add_argument('--snapshot', default=DEFAULT_SNAPSHOT)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    info_parser = subparsers.add_parser('info', help='Whether the snapshot matches the installed corpus')
+    info_parser.set_defaults(func=info)
+    build_parser = subparsers.add_parser('build', help='Read the adjectives from WordNet and save them')
+    build_parser.set_defaults(func=build)
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()